@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Бенчмарк экранирования MarkdownV2.
+# Сравнивает старую реализацию (19 цепочечных str.replace) с text_render:
+#   - таблица (символ, замена) без кэша (replace только для символов, что есть в строке),
+#   - escape_markdown_v2 с прогретым LRU-кэшем статических текстов.
+# Входные строки - статические тексты config и тестов (то, что реально экранирует бот)
+# плюс немного "динамики" (форматированные строки, которых нет в кэше).
+# Перед замером проверяет, что результаты совпадают со старой реализацией.
+#
+#   python bench_escape_markdown.py
+#   python bench_escape_markdown.py --rounds 2000
+
+import argparse
+import logging
+import time
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.WARNING
+)
+
+
+def legacy_escape_markdown_v2(text: str) -> str:
+    """Прежняя bot.escape_markdown_v2."""
+    if not isinstance(text, str): text = str(text)
+    escape_chars = r'_*[]()~`>#+-=|{}.!'
+    text = text.replace('\\', '\\\\')
+    for char in escape_chars:
+        text = text.replace(char, f'\\{char}')
+    return text
+
+
+def timed(label: str, func, texts, rounds: int, baseline: float = None) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            func(text)
+    elapsed = time.perf_counter() - started
+    per_call = elapsed / (rounds * len(texts)) * 1e9
+    speedup = f"  x{baseline / elapsed:.1f}" if baseline else ""
+    print(f"  {label:<36} {elapsed:8.3f} s  {per_call:7.0f} ns/call{speedup}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк экранирования MarkdownV2")
+    parser.add_argument("--rounds", type=int, default=500, help="проходов по набору строк")
+    args = parser.parse_args()
+
+    import text_render
+
+    static_texts = sorted(set(text_render._config_texts()) | set(text_render._test_texts()))
+    dynamic_texts = [f"Ответ {i}: email_{i}@example.com (день {i % 14 + 1})!" for i in range(50)]
+    texts = static_texts + dynamic_texts + [12345, "\\ уже_экранированное \\*"]
+
+    mismatches = [text for text in texts
+                  if text_render.escape_markdown_v2(text) != legacy_escape_markdown_v2(text)
+                  or text_render.escape_markdown_v2_uncached(text) != legacy_escape_markdown_v2(text)]
+    if mismatches:
+        raise SystemExit(f"Output differs from the legacy implementation for: {mismatches[:3]!r}")
+
+    text_render.prewarm()
+    print(f"{len(static_texts)} static + {len(dynamic_texts)} dynamic texts x {args.rounds} rounds:")
+    baseline = timed("legacy chained str.replace", legacy_escape_markdown_v2, texts, args.rounds)
+    timed("escape table (no cache)", text_render.escape_markdown_v2_uncached, texts, args.rounds, baseline)
+    timed("escape_markdown_v2 (LRU, prewarmed)", text_render.escape_markdown_v2, texts, args.rounds, baseline)
+    print(f"  cache: {text_render.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Бенчмарк старта планировщика практик.
+# Генерирует N подписчиков во временном каталоге и меряет:
+#   - загрузку хранилища пользователей (с построением индексов),
+#   - регистрацию минутного тикера в JobQueue (_schedule_practice_ticker),
+#   - сводку минутных корзин расписания (у части пользователей свой часовой пояс и время),
+#   - для сравнения - старую схему "две run_daily-задачи на пользователя
+#     с обходом всех задач на каждого" на меньшем числе пользователей.
+# Бот не запускается и в Telegram ничего не отправляется.
+#
+#   python bench_startup_scheduling.py
+#   python bench_startup_scheduling.py --users 100000 --legacy-users 3000
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.WARNING
+)
+logger = logging.getLogger(__name__)
+
+MODES = ("both", "both", "both", "morning_only", "dual")
+# Часть пользователей с личным расписанием: (часовой пояс, утро, вечер)
+SCHEDULES = (
+    (None, None, None), (None, None, None), (None, None, None),
+    ("Europe/Berlin", "07:30", None), ("Asia/Yekaterinburg", None, "20:00"), ("America/New_York", "08:15", "21:45"),
+)
+
+
+def make_users(count: int) -> dict:
+    users = {}
+    for chat_id in range(1, count + 1):
+        users[str(chat_id)] = {
+            "chat_id": chat_id,
+            "username": f"user{chat_id}",
+            "first_name": "Тест",
+            "subscribed_to_daily": True,
+            "daily_practice_mode": MODES[chat_id % len(MODES)],
+            "current_daily_day": chat_id % 14 + 1,
+            "stage": "daily_subscribed",
+            "created_at": "2025-01-01T00:00:00+00:00",
+        }
+        timezone, morning_time, evening_time = SCHEDULES[chat_id % len(SCHEDULES)]
+        if timezone:
+            users[str(chat_id)].update(timezone=timezone, morning_time=morning_time, evening_time=evening_time)
+    return users
+
+
+def timed(label: str, func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<44} {elapsed:8.3f} s")
+    return result, elapsed
+
+
+def legacy_schedule(job_queue, users: dict, callback):
+    """Старая схема: на каждого пользователя - обход всех задач и две run_daily."""
+    import config
+    for chat_id_str, user_data in users.items():
+        prefix = chat_id_str
+        for job in job_queue.jobs():
+            if job.name and job.name.startswith(prefix):
+                job.schedule_removal()
+        mode = user_data["daily_practice_mode"]
+        if mode in ("both", "morning_only"):
+            job_queue.run_daily(callback, config.MORNING_PRACTICE_TIME_UTC, chat_id=int(prefix),
+                                name=f"{prefix}_morning", data={"pt": "morning"})
+        if mode in ("both", "dual"):
+            job_queue.run_daily(callback, config.EVENING_PRACTICE_TIME_UTC, chat_id=int(prefix),
+                                name=f"{prefix}_evening", data={"pt": "evening"})
+        [j for j in job_queue.jobs() if j.name and j.name.startswith(prefix)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк старта планировщика практик")
+    parser.add_argument("--users", type=int, default=50000, help="подписчиков для новой схемы")
+    parser.add_argument("--legacy-users", type=int, default=2000,
+                        help="подписчиков для старой схемы (0 - не мерить)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_sched_")
+    origin = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with open("users.json", "w", encoding="utf-8") as f:
+            json.dump(make_users(args.users), f, ensure_ascii=False)
+
+        import config
+        config.USER_STORAGE_BACKEND = "json"
+        import user_data_manager as udm
+        import practice_scheduler
+        import bot
+        from telegram.ext import Application
+
+        print(f"New scheme, {args.users} subscribers:")
+        _, load_time = timed("load users + build indexes", udm.get_user_stats)
+        application = Application.builder().token("123456:bench").build()
+        _, schedule_time = timed("register practice ticker", bot._schedule_practice_ticker, application.job_queue)
+        plan, plan_time = timed("summarize minute buckets", practice_scheduler.plan_slots)
+        print(f"  jobs in queue: {len(application.job_queue.jobs())}; {practice_scheduler.format_plan(plan)}")
+        minute = practice_scheduler.PracticeSlot("morning", 360)
+        _, tick_time = timed("resolve recipients of one minute (tick)", practice_scheduler.due_chat_ids, minute)
+        print(f"  total startup scheduling: {load_time + schedule_time + plan_time:.3f} s")
+
+        if args.legacy_users:
+            legacy_users = make_users(args.legacy_users)
+            legacy_app = Application.builder().token("123456:bench").build()
+            print(f"Legacy per-user jobs, {args.legacy_users} subscribers:")
+            _, legacy_time = timed("schedule per user (O(N^2) job scans)", legacy_schedule,
+                                   legacy_app.job_queue, legacy_users, bot.send_daily_practice_job)
+            print(f"  jobs in queue: {len(legacy_app.job_queue.jobs())}")
+            # Время растёт квадратично: экстраполяция на полный объём
+            estimate = legacy_time * (args.users / args.legacy_users) ** 2
+            print(f"  extrapolated to {args.users} subscribers: ~{estimate:.0f} s")
+        udm.close_store()
+    finally:
+        os.chdir(origin)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
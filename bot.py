@@ -1,7 +1,6 @@
 # bot.py
 import logging
 import datetime
-import pytz
 import re
 import asyncio
 import html
@@ -10,6 +9,7 @@ import json
 import importlib
 import signal
 import sys
+import time
 
 from telegram import (
     Update,
@@ -34,6 +34,7 @@ from telegram.ext import (
     ContextTypes,
     filters,
     ApplicationBuilder,
+    BaseUpdateProcessor,
     JobQueue
 )
 
@@ -42,6 +43,15 @@ import daily_content
 import test_engine
 import user_data_manager as udm
 import email_sender
+import practice_scheduler
+import delivery
+import schedule_store
+import send_ledger
+import media_registry
+import text_render
+import keyboards
+from text_render import escape_markdown_v2
+from keyboards import get_main_menu_keyboard
 from admin_commands import force_send_practice_command
 
 logging.basicConfig(
@@ -57,7 +67,7 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 
 # Callback data constants
-MENU_CALLBACK_MAIN = "menu_main"
+MENU_CALLBACK_MAIN = daily_content.MENU_CALLBACK_MAIN
 MENU_CALLBACK_BACK = "menu_back"
 
 # Notification and pin constants
@@ -80,36 +90,15 @@ PIN_HELP_MSG = (
     "2. Выберите \"Закрепить чат\"\n\n"
     "После закрепления нажмите кнопку \"Готово\""
 )
-def escape_markdown_v2(text: str) -> str:
-    if not isinstance(text, str): text = str(text)
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    text = text.replace('\\', '\\\\')
-    for char in escape_chars:
-        text = text.replace(char, f'\\{char}')
-    return text
 
 async def update_user_and_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user: udm.create_or_update_user(user.id, user.username, user.first_name)
+    if user: await udm.acreate_or_update_user(user.id, user.username, user.first_name)
     return user
 
-def get_main_menu_keyboard(user_data: dict = None) -> InlineKeyboardMarkup:
-    keyboard = []
-    if user_data and user_data.get("subscribed_to_daily"):
-        keyboard.append([InlineKeyboardButton("⏸️ Остановить практики", callback_data="menu_stop_daily")])
-    else:
-        keyboard.append([InlineKeyboardButton(config.SUBSCRIBE_BUTTON_TEXT, callback_data="menu_subscribe_daily")])
-    
-    keyboard.append([InlineKeyboardButton(config.MAIN_CHANNEL_BUTTON_TEXT, url=config.MAIN_CHANNEL_LINK)])
-
-    # "Купить консультацию" теперь третья кнопка
-    keyboard.append([InlineKeyboardButton("Купить консультацию", callback_data="post_email_consult_yes_menu")])
-    
-    return InlineKeyboardMarkup(keyboard)
-
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = await update_user_and_log(update, context)
-    chat_id = user.id; user_data = udm.get_user_data(chat_id)
+    chat_id = user.id; user_data = await udm.aget_user(chat_id)
     reply_markup = get_main_menu_keyboard(user_data)
     text_to_send = escape_markdown_v2(config.MENU_TEXT)
     if update.callback_query:
@@ -119,9 +108,9 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = await update_user_and_log(update, context)
-    udm.get_user_data(user.id) # Ensure user data is loaded/created
+    await udm.aget_user(user.id) # Ensure user data is loaded/created
     keyboard = []
-    user_data = udm.get_user_data(user.id) # Get fresh user data
+    user_data = await udm.aget_user(user.id) # Get fresh user data
 
     # Send the first video note
     try:
@@ -141,7 +130,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     keyboard.append([InlineKeyboardButton(config.MAIN_CHANNEL_BUTTON_TEXT, url=config.MAIN_CHANNEL_LINK)])
 
     await update.message.reply_text(escape_markdown_v2(config.WELCOME_TEXT), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
-    udm.set_user_stage(user.id, "greeted")
+    await udm.aset_user_stage(user.id, "greeted")
 
 async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Check if user is subscribed to the main channel"""
@@ -150,7 +139,7 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     user = await update_user_and_log(update, context)
     chat_id = user.id
-    user_data = udm.get_user_data(chat_id)
+    user_data = await udm.aget_user(chat_id)
     
     if not user_data:
         await query.edit_message_text("Ошибка: данные пользователя не найдены.")
@@ -188,7 +177,7 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if 'channel_subscription' not in user_data or user_data['channel_subscription'] != is_subscribed:
             user_data['channel_subscription'] = is_subscribed
             user_data['channel_subscription_checked'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            udm.update_user_data(chat_id, {'channel_subscription': is_subscribed, 'channel_subscription_checked': user_data['channel_subscription_checked']})
+            await udm.aupdate_user(chat_id, {'channel_subscription': is_subscribed, 'channel_subscription_checked': user_data['channel_subscription_checked']})
         
         if is_subscribed:
             # User is subscribed to the channel
@@ -218,12 +207,11 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def stopdaily_command(update: Update, context: ContextTypes.DEFAULT_TYPE, from_menu: bool = False) -> None:
     user = await update_user_and_log(update, context)
-    chat_id = user.id; user_data = udm.get_user_data(chat_id)
+    chat_id = user.id; user_data = await udm.aget_user(chat_id)
     if user_data and user_data.get("subscribed_to_daily"):
-        _remove_daily_jobs_for_user(str(chat_id), context.job_queue)
-        udm.update_user_data(chat_id, {"subscribed_to_daily": False, "daily_practice_mode": "none", "stage": "unsubscribed_daily"})
+        await udm.aupdate_user(chat_id, {"subscribed_to_daily": False, "daily_practice_mode": "none", "stage": "unsubscribed_daily"})
         msg_text = escape_markdown_v2(config.UNSUBSCRIBE_TEXT)
-        reply_m = get_main_menu_keyboard(udm.get_user_data(chat_id))
+        reply_m = get_main_menu_keyboard(await udm.aget_user(chat_id))
         if from_menu and update.callback_query: await update.callback_query.edit_message_text(text=msg_text, reply_markup=reply_m, parse_mode=ParseMode.MARKDOWN_V2)
         else: await context.bot.send_message(chat_id, text=msg_text, reply_markup=reply_m, parse_mode=ParseMode.MARKDOWN_V2)
     else:
@@ -232,201 +220,196 @@ async def stopdaily_command(update: Update, context: ContextTypes.DEFAULT_TYPE,
         if from_menu and update.callback_query: await update.callback_query.edit_message_text(text=msg_text, reply_markup=reply_m, parse_mode=ParseMode.MARKDOWN_V2)
         else: await context.bot.send_message(chat_id, text=msg_text, reply_markup=reply_m, parse_mode=ParseMode.MARKDOWN_V2)
 
-def _remove_daily_jobs_for_user(job_name_prefix: str, job_queue_instance):
-    for type_suffix in ["morning", "evening"]:
-        for job in job_queue_instance.get_jobs_by_name(f"{job_name_prefix}_{type_suffix}"):
-            job.schedule_removal(); logger.info(f"Removed job: {job.name}")
-
 async def send_daily_practice_job(context: ContextTypes.DEFAULT_TYPE):
-    """Отправка ежедневной практики по расписанию"""
+    """Отправка ежедневной практики одному пользователю по задаче "{chat_id}_{morning|evening}" (ручной запуск)"""
     job = context.job
     if not job or not job.name:
         logger.error(f"Invalid job: {getattr(job, 'name', 'No job name')}")
         return
-        
-    logger.info(f"===== Запуск задачи: {job.name} =====")
-    logger.info(f"Job data: {job.data}")
-    
     try:
-        # Исправление: используем job.data для получения типа практики
         user_id = int(job.name.split('_')[0])  # Извлекаем ID пользователя из имени задачи
         practice_type = job.data.get('pt', 'morning')  # Используем данные из job.data
-        
-        # Получаем данные пользователя
-        user_data = udm.get_user_data(user_id)
-        if not user_data:
-            logger.warning(f"User {user_id} not found in database")
-            return
-            
-        # Проверяем, не отправляли ли уже сегодня практику этого типа
-        from datetime import datetime  # Добавляем импорт datetime
-        today = datetime.now().date().isoformat()
-        last_sent_date = user_data.get(f'last_{practice_type}_sent_date')
-        if last_sent_date == today:
-            logger.info(f"Already sent {practice_type} practice to user {user_id} today")
-            return
-            
-        current_day = user_data.get("current_daily_day", 1)
-        if user_data.get("daily_practice_mode") == "morning_only" and practice_type == "evening":
-            logger.info(f"Skipping evening practice for user {user_id} in morning_only mode")
-            return
-            
-        # Определяем chat_id для дальнейшего использования
-        chat_id = user_id
-        
-    except Exception as e:
+    except (ValueError, AttributeError) as e:
         logger.error(f"Error in send_daily_practice_job: {e}", exc_info=True)
-        return  # Добавляем return, чтобы прервать выполнение при ошибке
+        return
+    try:
+        result = await deliver_daily_practice(context, user_id, practice_type)
+        if result.completed_day is not None:
+            await udm.aadvance_daily_days({user_id: result.completed_day}, daily_content.TOTAL_DAYS)
+    except Exception as e:
+        reason = delivery.permanent_failure(e)
+        if not reason:
+            raise
+        logger.warning(f"User {user_id} is unreachable ({reason}), unsubscribing: {e}")
+        await practice_scheduler.aprune_unreachable({user_id: reason})
 
-    # Получаем контент для текущего дня и типа практики
-    day_content = daily_content.DAILY_CONTENT.get(current_day)
-    practice_data = day_content.get(practice_type) if day_content else None
+async def _run_practice_slot(context: ContextTypes.DEFAULT_TYPE, slot, chat_ids, spread_seconds: float = 0):
+    try:
+        await practice_scheduler.run_slot(
+            slot,
+            lambda chat_id, part: deliver_daily_practice(context, chat_id, part),
+            runner=delivery.get_engine().run,
+            spread_seconds=spread_seconds,
+            chat_ids=chat_ids,
+        )
+    except Exception as e:
+        logger.error(f"{slot}: delivery run failed: {e}", exc_info=True)
+
+async def practice_tick_job(context: ContextTypes.DEFAULT_TYPE):
+    """Раз в минуту: рассылка по минутным корзинам наступивших минут (и пропущенных тиков)"""
+    shard = context.job.data.get("shard")
+    state_name = practice_scheduler.tick_state_name(shard)
+    store = schedule_store.get_store()
+    state = await asyncio.to_thread(store.get, state_name)
+    minutes = practice_scheduler.minutes_between(state["last_completed"] if state else None,
+                                                 datetime.datetime.now(datetime.timezone.utc))
+    for minute in minutes:
+        for slot, chat_ids in await practice_scheduler.aslots_at(practice_scheduler.minute_of_day(minute), shard):
+            # Рассылка длится всё окно доставки - тикер её не ждёт
+            context.application.create_task(_run_practice_slot(context, slot, chat_ids))
+    if minutes:
+        await asyncio.to_thread(store.mark_completed, state_name,
+                                minutes[-1], minutes[-1] + datetime.timedelta(minutes=1))
+
+async def practice_catchup_job(context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка по корзинам минут, пропущенных пока бот был выключен"""
+    spread_seconds = context.job.data.get("spread_seconds", 0)
+    shard = context.job.data.get("shard")
+    for slot, chat_ids in await practice_scheduler.amissed_slots(context.job.data["minutes"], shard):
+        logger.info(f"{slot}: catching up {len(chat_ids)} recipients")
+        context.application.create_task(_run_practice_slot(context, slot, chat_ids, spread_seconds))
+
+def _schedule_practice_ticker(job_queue_instance, shard: practice_scheduler.Shard = None):
+    """Один минутный тикер на все практики; не зависит от числа подписчиков и их времён.
+
+    shard - тикер воркера доставки, который обслуживает только свою долю подписчиков.
+    """
+    for job in job_queue_instance.jobs():
+        if job.name and job.name.startswith(("practice_slot_", "practice_tick", "practice_catchup")):
+            job.schedule_removal()
+    _schedule_catchup(job_queue_instance, shard)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Тикаем в начале каждой минуты
+    job_queue_instance.run_repeating(
+        practice_tick_job,
+        interval=60,
+        first=60 - now.second - now.microsecond / 1e6 + 1,
+        name="practice_tick",
+        data={"shard": shard},
+        job_kwargs={'misfire_grace_time': 30}
+    )
+
+def _schedule_catchup(job_queue_instance, shard: practice_scheduler.Shard = None):
+    """Минуты, пропущенные пока бот был выключен, - по config.PRACTICE_CATCHUP_POLICY"""
+    store = schedule_store.get_store()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    policy = config.PRACTICE_CATCHUP_POLICY
+    if policy not in schedule_store.CATCHUP_POLICIES:
+        logger.warning(f"Unknown PRACTICE_CATCHUP_POLICY '{policy}', using '{schedule_store.CATCHUP_LATE}'.")
+        policy = schedule_store.CATCHUP_LATE
+    missed = practice_scheduler.find_missed(store, now, practice_scheduler.tick_state_name(shard))
+    if not missed:
+        return
+    span = f"{missed[0].strftime('%H:%M')}-{missed[-1].strftime('%H:%M')} UTC"
+    if policy == schedule_store.CATCHUP_SKIP:
+        logger.info(f"Skipping practices missed at {span}")
+        return
+    spread_seconds = config.PRACTICE_CATCHUP_SPREAD_MINUTES * 60 if policy == schedule_store.CATCHUP_SPREAD else 0
+    job_queue_instance.run_once(
+        practice_catchup_job,
+        when=5,
+        name="practice_catchup",
+        data={"minutes": missed, "spread_seconds": spread_seconds, "shard": shard},
+    )
+    logger.info(f"Catching up practices missed at {span} (policy: {policy})")
+
+async def deliver_daily_practice(context: ContextTypes.DEFAULT_TYPE, chat_id: int, practice_type: str):
+    """Отправка ежедневной практики одному подписчику.
+
+    Ошибки отправки пробрасываются: движок доставки повторит RetryAfter и сетевые сбои,
+    а недоступных (заблокировали бота, удалили аккаунт) отпишет одной пачкой после рассылки. Дубли исключает send_ledger: практика
+    захватывается перед отправкой, подтверждается после неё и освобождается при ошибке.
+    Возвращает practice_scheduler.PracticeDelivery: ушло ли сообщение (пропуски - PRACTICE_SKIPPED)
+    и current_daily_day, если эта практика завершила день получателя (см. run_slot).
+    """
+    user_data = await udm.aget_user(chat_id)
+    if not user_data:
+        logger.warning(f"User {chat_id} not found in database")
+        return practice_scheduler.PRACTICE_SKIPPED
+    if not user_data.get("subscribed_to_daily"):
+        return practice_scheduler.PRACTICE_SKIPPED
+
+    current_day = user_data.get("current_daily_day", 1)
+    if user_data.get("daily_practice_mode") == "morning_only" and practice_type == "evening":
+        logger.info(f"Skipping evening practice for user {chat_id} in morning_only mode")
+        return practice_scheduler.PRACTICE_SKIPPED
+
+    today = send_ledger.utc_today()
+    # Отправки, сделанные до появления журнала, видны только по last_*_sent_date
+    if user_data.get(f'last_{practice_type}_sent_date') == today:
+        logger.info(f"Already sent {practice_type} practice to user {chat_id} today")
+        return practice_scheduler.PRACTICE_SKIPPED
+    ledger = send_ledger.get_ledger()
+    if not await asyncio.to_thread(ledger.claim, chat_id, practice_type, current_day, today):
+        logger.info(f"Already sent {practice_type} practice to user {chat_id} today (send ledger)")
+        return practice_scheduler.PRACTICE_SKIPPED
+
+    # Готовое сообщение (текст и клавиатура) для текущего дня и типа практики
+    bundle = daily_content.get_practice_bundle(current_day, practice_type)
     
     logger.info(f"Sending {practice_type} practice for day {current_day} to user {chat_id}")
 
-    if not practice_data:
-        if practice_type == "morning" and current_day == 14 and not (day_content and day_content.get("morning")):
+    if not bundle:
+        if practice_type == "morning" and current_day == 14:
             logger.info(f"No morning practice content for day 14, user {chat_id}, offering test.")
-            await offer_test_if_not_taken(context, chat_id, user_data, config.KEY_TEST_ID, is_day14=True, test_for_day=current_day)
-            udm.update_last_sent_date(chat_id, "morning")
-        else:
-            logger.warning(f"No practice_data for day {current_day}, type {practice_type}, user {chat_id}.")
-        return
+            try:
+                offered = await offer_test_if_not_taken(context, chat_id, user_data, config.KEY_TEST_ID, is_day14=True, test_for_day=current_day)
+            except Exception:
+                await asyncio.to_thread(ledger.release, chat_id, practice_type, today)
+                raise
+            await asyncio.to_thread(ledger.confirm, chat_id, practice_type, today)
+            await udm.aupdate_last_sent_date(chat_id, "morning")
+            return practice_scheduler.PracticeDelivery(bool(offered), None)
+        logger.warning(f"No practice_data for day {current_day}, type {practice_type}, user {chat_id}.")
+        await asyncio.to_thread(ledger.release, chat_id, practice_type, today)
+        return practice_scheduler.PRACTICE_SKIPPED
 
-    # Main practice message
-    # Send practice message
-    kb = [
-        [InlineKeyboardButton(practice_data["button_text"], callback_data=f"daily_ack_{current_day}_{practice_type}")],
-        [
-            InlineKeyboardButton("Купить консультацию", callback_data="post_email_consult_yes_practice"),
-            InlineKeyboardButton("📖 В меню", callback_data=MENU_CALLBACK_MAIN)
-        ]
-    ]
     try:
         # Send practice with a longer timeout
-        await context.bot.send_message(
+        await delivery.get_engine().send(chat_id, lambda: context.bot.send_message(
             chat_id=chat_id,
-            text=practice_data["text"],
-            reply_markup=InlineKeyboardMarkup(kb),
-            parse_mode=ParseMode.HTML,
+            text=bundle.text,
+            reply_markup=bundle.reply_markup,
+            parse_mode=bundle.parse_mode,
             write_timeout=30
-        )
-        udm.update_last_sent_date(chat_id, practice_type)
-
-        # Предложение о консультации теперь встроено в клавиатуру
-        
-
-
-        if practice_type == "evening":
-            if current_day in config.TEST_OFFER_DAYS or current_day == 14:
-                await offer_test_if_not_taken(context, chat_id, user_data, config.KEY_TEST_ID, is_day14=(current_day==14), test_for_day=current_day)
-
-        if (practice_type == "evening" and user_data.get("daily_practice_mode") in ["dual", "both"]) or \
-           (practice_type == "morning" and user_data.get("daily_practice_mode") == "morning_only"):
-            udm.increment_user_daily_day(chat_id, daily_content.TOTAL_DAYS)
+        ))
     except Exception as e:
-        logger.error(f"Error sending daily practice: {e}")
-        if "bot was blocked" in str(e).lower() or "user is deactivated" in str(e).lower():
-            _remove_daily_jobs_for_user(str(chat_id), context.job_queue)
-            udm.update_user_data(chat_id, {"subscribed_to_daily": False, "daily_practice_mode": "none", "stage": "bot_blocked"})
-
-def _schedule_daily_jobs_for_user(chat_id: int, job_queue_instance, user_data: dict):
-    job_name_prefix = str(chat_id)
-    
-    # 0. Запускаем отладочную информацию - сколько задач уже есть в планировщике
-    all_jobs = job_queue_instance.jobs()
-    logger.info(f"[SCHEDULER DEBUG] Всего задач при входе: {len(all_jobs)}")
-    for j in all_jobs:
-        logger.info(f"[SCHEDULER DEBUG] Существующая задача: {j.name}, следующий запуск: {j.next_t}")
-    
-    # 1. Принудительно удаляем все старые задачи для этого пользователя
-    removed_jobs = 0
-    for job in job_queue_instance.jobs():
-        if job.name and job.name.startswith(job_name_prefix):
-            job.schedule_removal()
-            removed_jobs += 1
-            logger.info(f"Удалена старая задача: {job.name}")
-    logger.info(f"[SCHEDULER DEBUG] Удалено задач для пользователя {chat_id}: {removed_jobs}")
-    
-    current_day = user_data.get("current_daily_day", 0)
-    
-    # 2. Устанавливаем время по умолчанию
-    morning_time_to_use = config.MORNING_PRACTICE_TIME_UTC
-    evening_time_to_use = config.EVENING_PRACTICE_TIME_UTC
-
-    # 3. Проверяем, есть ли особое время для текущего дня (например, День 3)
-    if current_day == 3: 
-        try:
-            morning_time_val = config.DAY3_KEY_TEST_OFFER_MORNING_UTC
-            evening_time_val = config.DAY3_KEY_TEST_OFFER_EVENING_UTC
-
-            # Обрабатываем и str ('HH:MM'), и datetime.time из конфига
-            if isinstance(morning_time_val, str):
-                h, m = map(int, morning_time_val.split(':'))
-                morning_time_to_use = datetime.time(hour=h, minute=m, tzinfo=pytz.UTC)
-            else:
-                morning_time_to_use = morning_time_val
+        # Не отправлено - освобождаем захват, чтобы повтор мог отправить
+        await asyncio.to_thread(ledger.release, chat_id, practice_type, today)
+        # Постоянные ошибки (бот заблокирован и т.п.) движок доставки собирает и отписывает пачкой
+        if not delivery.permanent_failure(e):
+            logger.error(f"Error sending daily practice to {chat_id}: {e}")
+        raise
+    await asyncio.to_thread(ledger.confirm, chat_id, practice_type, today)
+    await udm.aupdate_last_sent_date(chat_id, practice_type)
+
+    # Практика уже доставлена: ошибка предложения теста не должна приводить к повтору
+    # (повтор упрётся в журнал и пропустит переход на следующий день)
+    if practice_type == "evening":
+        if current_day in config.TEST_OFFER_DAYS or current_day == 14:
+            try:
+                await offer_test_if_not_taken(context, chat_id, user_data, config.KEY_TEST_ID, is_day14=(current_day==14), test_for_day=current_day)
+            except Exception as e:
+                logger.error(f"Error offering test to {chat_id} after evening practice: {e}")
 
-            if isinstance(evening_time_val, str):
-                h, m = map(int, evening_time_val.split(':'))
-                evening_time_to_use = datetime.time(hour=h, minute=m, tzinfo=pytz.UTC)
-            else:
-                evening_time_to_use = evening_time_val
-            
-            logger.info(f"День 3 (тест.предложение): Используем специальное время: {morning_time_to_use.strftime('%H:%M:%S%z')}, {evening_time_to_use.strftime('%H:%M:%S%z')}")
-        
-        except Exception as e:
-            logger.error(f"Ошибка при использовании времени для Дня 3 из config: {e}. Используем стандартное время.")
-            morning_time_to_use = config.MORNING_PRACTICE_TIME_UTC
-            evening_time_to_use = config.EVENING_PRACTICE_TIME_UTC
-            logger.info(f"День 3 (тест.предложение): Откат к стандартному времени: {morning_time_to_use.strftime('%H:%M:%S%z')}, {evening_time_to_use.strftime('%H:%M:%S%z')}")
-
-    # 4. Логируем итоговое время, которое будет использоваться
-    logger.info(f"=== ВРЕМЯ ДЛЯ ПОЛЬЗОВАТЕЛЯ {chat_id} (День {current_day}) ===")
-    logger.info(f"Утром: {morning_time_to_use.strftime('%H:%M:%S%z')}")
-    logger.info(f"Вечером: {evening_time_to_use.strftime('%H:%M:%S%z')}")
-    
-    # 5. Создаем новые задачи с актуальным временем
-    mode = user_data.get("daily_practice_mode", "both")
-    logger.info(f"[DEBUG] Режим практики пользователя {chat_id}: {mode}")
-    logger.info(f"[DEBUG] user_data: {user_data}")
-    
-    # Упрощаем логику проверки режимов
-    logger.info(f"[DEBUG] Checking morning job condition: mode={mode}, condition={mode in ['both', 'morning_only']}")
-    if mode in ["both", "morning_only"]:
-        job_queue_instance.run_daily(
-            send_daily_practice_job, 
-            morning_time_to_use,
-            chat_id=chat_id, 
-            name=f"{job_name_prefix}_morning", 
-            data={"pt": "morning"},
-            job_kwargs={'misfire_grace_time': 60}
-        )
-        logger.info(f"✅ Создана утренняя задача на {morning_time_to_use.strftime('%H:%M:%S%z')}")
-    
-    if mode in ["both", "dual"]:
-        job_queue_instance.run_daily(
-            send_daily_practice_job, 
-            evening_time_to_use,
-            chat_id=chat_id, 
-            name=f"{job_name_prefix}_evening", 
-            data={"pt": "evening"},
-            job_kwargs={'misfire_grace_time': 60}
-        )
-        logger.info(f"✅ Создана вечерняя задача на {evening_time_to_use.strftime('%H:%M:%S%z')}")
-    
-    # Проверка успешного создания задач - должны быть видны в планировщике
-    final_jobs = job_queue_instance.jobs()
-    logger.info(f"[SCHEDULER DEBUG] Итоговое количество задач: {len(final_jobs)}")
-    user_jobs = [j for j in final_jobs if j.name and j.name.startswith(job_name_prefix)]
-    logger.info(f"[SCHEDULER DEBUG] Создано задач для пользователя {chat_id}: {len(user_jobs)}")
-    
-    for j in user_jobs:
-        logger.info(f"[SCHEDULER DEBUG] Итоговая задача: {j.name}")
-    
-    return len(user_jobs) > 0 # Возвращаем True если задачи созданы
+    # Переход на следующий день делает вызывающий - одной пачкой после рассылки
+    if (practice_type == "evening" and user_data.get("daily_practice_mode") in ["dual", "both"]) or \
+       (practice_type == "morning" and user_data.get("daily_practice_mode") == "morning_only"):
+        return practice_scheduler.PracticeDelivery(True, current_day)
+    return practice_scheduler.PracticeDelivery(True, None)
 
 async def offer_test_if_not_taken(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_data: dict, test_id: str, is_day14: bool = False, test_for_day: int = None):
+    """Предлагает тест; True, если сообщение с предложением отправлено."""
     test_info = test_engine.get_test_by_id(test_id)
     if not test_info: logger.error(f"Test {test_id} not found in test_engine."); return
 
@@ -451,8 +434,9 @@ async def offer_test_if_not_taken(context: ContextTypes.DEFAULT_TYPE, chat_id: i
         keyboard_rows.append([InlineKeyboardButton(config.TEST_BUTTON_NO_TEXT, callback_data=f"offer_test_no_{test_id}")])
     keyboard_rows.append([InlineKeyboardButton("📖 В меню", callback_data=MENU_CALLBACK_MAIN)])
 
-    await context.bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(keyboard_rows), parse_mode=ParseMode.MARKDOWN_V2)
-    udm.set_user_stage(chat_id, f"day14_forced_test_offered_{test_id}" if is_day14 else f"daily_test_offered_{test_id}")
+    await delivery.get_engine().send(chat_id, lambda: context.bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(keyboard_rows), parse_mode=ParseMode.MARKDOWN_V2))
+    await udm.aset_user_stage(chat_id, f"day14_forced_test_offered_{test_id}" if is_day14 else f"daily_test_offered_{test_id}")
+    return True
 
 
 async def _start_test_logic(query_object_or_message, context: ContextTypes.DEFAULT_TYPE, chat_id: int, test_id: str, user_data: dict, is_forced: bool = False, test_for_day_arg: int = None):
@@ -475,7 +459,7 @@ async def _start_test_logic(query_object_or_message, context: ContextTypes.DEFAU
     active_test_payload = {"id": test_id, "current_question_idx": 0, "answers": []}
     if is_forced: active_test_payload["is_forced_day14"] = True
     if test_for_day_arg is not None: active_test_payload["test_for_day"] = test_for_day_arg
-    udm.update_user_data(chat_id, {"active_test": active_test_payload, "stage": f"in_test_{test_id}"})
+    await udm.aupdate_user(chat_id, {"active_test": active_test_payload, "stage": f"in_test_{test_id}"})
     
     # Edit the message that triggered the test start, if it was a callback query
     if isinstance(query_object_or_message, CallbackQuery):
@@ -488,7 +472,7 @@ async def _start_test_logic(query_object_or_message, context: ContextTypes.DEFAU
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query; await query.answer()
     user = await update_user_and_log(update, context)
-    chat_id = user.id; user_data = udm.get_user_data(chat_id)
+    chat_id = user.id; user_data = await udm.aget_user(chat_id)
     if not user_data: await query.edit_message_text("Ошибка пользователя."); return
     data = query.data
 
@@ -631,7 +615,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             # Update stored status
             user_data['channel_subscription'] = is_subscribed
             user_data['channel_subscription_checked'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            udm.update_user_data(chat_id, {
+            await udm.aupdate_user(chat_id, {
                 'channel_subscription': is_subscribed,
                 'channel_subscription_checked': user_data['channel_subscription_checked']
             })
@@ -650,9 +634,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 return
                 
             # If we get here, user is subscribed to the channel
-            udm.set_user_subscribed(chat_id, True)
-            user_data = udm.get_user_data(chat_id)  # Refresh user_data
-            _schedule_daily_jobs_for_user(chat_id, context.job_queue, user_data)
+            await udm.aset_user_subscribed(chat_id, True)
+            user_data = await udm.aget_user(chat_id)  # Refresh user_data
             
             # Создаем клавиатуру с кнопками для нового пользователя
             keyboard = [
@@ -676,9 +659,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
             
         # User is subscribed to the channel, proceed with subscription
-        udm.set_user_subscribed(chat_id, True)
-        user_data = udm.get_user_data(chat_id)  # Refresh user_data
-        _schedule_daily_jobs_for_user(chat_id, context.job_queue, user_data)
+        await udm.aset_user_subscribed(chat_id, True)
+        user_data = await udm.aget_user(chat_id)  # Refresh user_data
         await query.edit_message_text(
             text=escape_markdown_v2(config.SUBSCRIPTION_SUCCESS_TEXT.format(button_ack_text=daily_content.COMMON_BUTTON_TEXT)),
             reply_markup=get_main_menu_keyboard(user_data),
@@ -686,16 +668,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    elif data.startswith("daily_ack_"):
+    elif data.startswith(daily_content.DAILY_ACK_PREFIX):
         parts = query.data.rsplit('_', 2); day_acked = int(parts[1]); type_acked = parts[2]
-        udm.set_user_stage(chat_id, f"daily_practice_day{day_acked}_{type_acked}_ack")
+        is_extended = data.startswith(f"{daily_content.DAILY_ACK_PREFIX}ext_")
+        await udm.aset_user_stage(chat_id, f"daily_practice_{'ext_' if is_extended else ''}day{day_acked}_{type_acked}_ack")
+        bundle = daily_content.get_practice_bundle(
+            day_acked, type_acked, daily_content.EXTENDED_CYCLE if is_extended else daily_content.MAIN_CYCLE)
         try:
-            current_markup = query.message.reply_markup; new_keyboard_rows = []
-            if current_markup:
-                for row in current_markup.inline_keyboard:
-                    new_row = [btn for btn in row if btn.callback_data != data]
-                    if new_row: new_keyboard_rows.append(new_row)
-            new_reply_markup = InlineKeyboardMarkup(new_keyboard_rows) if new_keyboard_rows else None
+            current_markup = query.message.reply_markup
+            if bundle and current_markup == bundle.reply_markup:
+                # Сообщение рассылки - готовая клавиатура без кнопки подтверждения
+                new_reply_markup = bundle.acked_markup
+            else:
+                new_keyboard_rows = []
+                if current_markup:
+                    for row in current_markup.inline_keyboard:
+                        new_row = [btn for btn in row if btn.callback_data != data]
+                        if new_row: new_keyboard_rows.append(new_row)
+                new_reply_markup = InlineKeyboardMarkup(new_keyboard_rows) if new_keyboard_rows else None
             original_text_html = query.message.text_html if hasattr(query.message, 'text_html') else query.message.text
             await query.edit_message_text(text=original_text_html, reply_markup=new_reply_markup, parse_mode=ParseMode.HTML if hasattr(query.message, 'text_html') else None)
         except Exception as e: logger.warning(f"Could not edit markup for daily_ack: {e}"); await query.edit_message_reply_markup(reply_markup=None) # Try to remove markup at least
@@ -714,7 +704,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         test_day_for_offer = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
         await _start_test_logic(query, context, chat_id, test_id, user_data, test_for_day_arg=test_day_for_offer)
     elif data.startswith("offer_test_no_"):
-        udm.set_user_stage(chat_id, f"daily_test_declined_{data.replace('offer_test_no_', '')}")
+        await udm.aset_user_stage(chat_id, f"daily_test_declined_{data.replace('offer_test_no_', '')}")
         await query.edit_message_text(text=escape_markdown_v2(config.TEST_BUTTON_NO_TEXT) + "\n\nПрактики продолжатся\\. 😊", reply_markup=get_main_menu_keyboard(user_data), parse_mode=ParseMode.MARKDOWN_V2)
     elif data.startswith("testans_"):
         data_payload = data[len("testans_"):]; parts = data_payload.rsplit("_", 2)
@@ -730,12 +720,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     elif data.startswith("post_email_consult_yes_"):
         await send_payment_info(update, context)
     elif data.startswith("post_email_consult_no_"):
-        udm.set_user_stage(chat_id, f"consult_declined_after_email_{data.replace('post_email_consult_no_', '')}")
+        await udm.aset_user_stage(chat_id, f"consult_declined_after_email_{data.replace('post_email_consult_no_', '')}")
         await query.edit_message_text(text=escape_markdown_v2(config.CONSULTATION_DECLINED_TEXT), reply_markup=get_main_menu_keyboard(user_data),parse_mode=ParseMode.MARKDOWN_V2)
     elif data.startswith("post_email_consult_think_"):
         test_id_from_cb = data.replace("post_email_consult_think_", "")
-        udm.update_user_data(chat_id, {"stage": f"consult_thinking_day14_{test_id_from_cb}", "daily_practice_mode": "morning_only"})
-        user_data = udm.get_user_data(chat_id); _schedule_daily_jobs_for_user(chat_id, context.job_queue, user_data)
+        await udm.aupdate_user(chat_id, {"stage": f"consult_thinking_day14_{test_id_from_cb}", "daily_practice_mode": "morning_only"})
+        user_data = await udm.aget_user(chat_id)
         think_text = escape_markdown_v2(config.CONSULTATION_THINK_LATER_TEXT.format(admin_username=config.ADMIN_CONTACT_USERNAME))
         await query.edit_message_text(text=think_text, reply_markup=get_main_menu_keyboard(user_data), parse_mode=ParseMode.MARKDOWN_V2)
     elif data == "offer_consultation":
@@ -746,16 +736,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def _send_test_question(context: ContextTypes.DEFAULT_TYPE, chat_id: int, test_data: dict, question_idx: int, test_id_for_callback: str):
     question = test_data["questions"][question_idx]
     text = escape_markdown_v2(question["text"])
-    keyboard_rows = []
-    for i, option in enumerate(question["options"]):
-        option_text = escape_markdown_v2(option["text"]) # Escape option text as well
-        keyboard_rows.append([InlineKeyboardButton(option_text, callback_data=f"testans_{test_id_for_callback}_{question_idx}_{i}")])
-    keyboard_rows.append([InlineKeyboardButton("📖 В меню", callback_data=MENU_CALLBACK_MAIN)]) # Add menu button
-    reply_markup = InlineKeyboardMarkup(keyboard_rows)
+    reply_markup = keyboards.get_test_question_keyboard(test_id_for_callback, test_data, question_idx)
     if "image_path" in question:
         try:
-            with open(question["image_path"], 'rb') as photo_file:
-                await context.bot.send_photo(chat_id, photo_file)
+            await media_registry.send_photo(context.bot, chat_id, question["image_path"])
             logger.info(f"Sent image {question['image_path']} for question {question_idx} to chat_id {chat_id}")
         except Exception as e:
             logger.error(f"Error sending image {question['image_path']}: {e}")
@@ -778,7 +762,7 @@ async def _handle_test_answer(query: CallbackQuery, context: ContextTypes.DEFAUL
     logger.info(f"Saving answer: ans_idx={ans_idx} for question {q_idx} of test {test_id}")
     active_test_data["answers"].append(ans_idx)  # Сохраняем индекс выбранного ответа
     active_test_data["current_question_idx"] += 1
-    udm.update_user_data(chat_id, {"active_test": active_test_data})
+    await udm.aupdate_user(chat_id, {"active_test": active_test_data})
 
     original_question_text_escaped = escape_markdown_v2(test_definition["questions"][q_idx]["text"])
     selected_answer_text_escaped = escape_markdown_v2(test_definition["questions"][q_idx]["options"][ans_idx]["text"])
@@ -798,7 +782,7 @@ async def _handle_test_answer(query: CallbackQuery, context: ContextTypes.DEFAUL
             logger.info(f"Gender selector completed for user {chat_id}, starting test: {next_test_id}")
             
             # Сбрасываем активный тест и запускаем новый
-            udm.update_user_data(chat_id, {"active_test": None})
+            await udm.aupdate_user(chat_id, {"active_test": None})
             
             # Запускаем выбранный тест
             test_for_day = active_test_data.get("test_for_day", user_data.get("current_daily_day", 0))
@@ -851,21 +835,24 @@ async def _handle_test_answer(query: CallbackQuery, context: ContextTypes.DEFAUL
                     reply_markup=get_main_menu_keyboard(user_data)
                 )
             
-            # Записываем, что тест пройден (один раз)
-            udm.record_test_taken(chat_id, test_id, summary=result_summary, answers=active_test_data["answers"])
-            
             is_forced_day14_test = active_test_data.get("is_forced_day14", False)
             
-            # Обновляем данные пользователя: сбрасываем активный тест, устанавливаем стадию для ввода email,
-            # и сохраняем данные, необходимые для отправки email.
-            udm.update_user_data(chat_id, {
-                "active_test": None, 
-                "stage": f"awaiting_email_input_for_{test_id}",
-                "pending_email_test_id": test_id, 
-                "pending_email_test_score": score,
-                "pending_email_test_answers_indices": active_test_data["answers"],
-                "pending_email_test_is_forced_day14": is_forced_day14_test
-            })
+            # Записываем, что тест пройден, сбрасываем активный тест, устанавливаем стадию для ввода email
+            # и сохраняем данные, необходимые для отправки email - одной записью.
+            def record_finished_test(txn_user):
+                tests_taken = txn_user.get("tests_taken") or {}
+                tests_taken[test_id] = udm.make_test_taken_entry(active_test_data["answers"], score)
+                txn_user.update({
+                    "tests_taken": tests_taken,
+                    "active_test": None, 
+                    "stage": f"awaiting_email_input_for_{test_id}",
+                    "pending_email_test_id": test_id, 
+                    "pending_email_test_score": score,
+                    "pending_email_test_answers_indices": active_test_data["answers"],
+                    "pending_email_test_is_forced_day14": is_forced_day14_test
+                })
+
+            await udm.atransaction(chat_id, record_finished_test)
 
             # Отправляем пользователю запрос на ввод email с кнопкой консультации
             await context.bot.send_message(
@@ -902,25 +889,20 @@ async def _handle_consultation_request(query: CallbackQuery, context: ContextTyp
 
     consultation_focus_text = "глубокое понимание себя и своих уникальных особенностей"
     
-    if "answers" in test_taken_info and test_taken_info["answers"] is not None:
-        try:
-            # Используем новый формат для получения результатов
-            user_answer_indices = test_taken_info["answers"]  # Уже сохранены как индексы
-            test_result = test_engine.get_test_result(test_id, sum(user_answer_indices), user_answer_indices)
-            result_text = test_result["summary"]
-            
-            if not is_next_test:  # Обычный тест, не селектор пола
-                result_details = test_engine.get_test_result(test_id, score, user_answer_indices)
-                consultation_focus_text = result_details.get("consultation_focus", consultation_focus_text)
-        except Exception as e:  
-            logger.error(f"Error getting consultation_focus for test {test_id}, user {chat_id}: {e}")
+    # Сохранённый результат теста (балл) -> фокус консультации из test_engine
+    stored_result = udm.stored_test_result(test_id, test_taken_info)
+    if stored_result and stored_result.get("consultation_focus"):
+        consultation_focus_text = stored_result["consultation_focus"]
 
-    current_tests_taken = user_data.get("tests_taken", {})
-    if test_id in current_tests_taken:
-        current_tests_taken[test_id]['consult_interest_shown'] = True
-        udm.update_user_data(chat_id, {"tests_taken": current_tests_taken})
+    # Отметка об интересе к консультации и стадия - одной записью по свежей записи пользователя
+    def record_consult_interest(txn_user):
+        tests_taken = txn_user.get("tests_taken") or {}
+        if test_id in tests_taken:
+            tests_taken[test_id]["consult_interest_shown"] = True
+            txn_user["tests_taken"] = tests_taken
+        txn_user["stage"] = f"consult_5000_requested_{test_id}"
 
-    udm.set_user_stage(chat_id, f"consult_5000_requested_{test_id}")
+    await udm.atransaction(chat_id, record_consult_interest)
 
     price_str = f"*{escape_markdown_v2(str(config.CONSULTATION_PRICE_RUB))} рублей*"
     admin_contact_str = f"@{config.ADMIN_CONTACT_USERNAME}"
@@ -961,7 +943,7 @@ async def _handle_consultation_request(query: CallbackQuery, context: ContextTyp
 
 async def handle_potential_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_obj = await update_user_and_log(update, context); chat_id = user_obj.id
-    email_text = update.message.text.strip(); user_data = udm.get_user_data(chat_id)
+    email_text = update.message.text.strip(); user_data = await udm.aget_user(chat_id)
 
     if not user_data or not user_data.get("stage", "").startswith("awaiting_email_input_for_"): return
 
@@ -972,16 +954,12 @@ async def handle_potential_email(update: Update, context: ContextTypes.DEFAULT_T
 
     if not test_id or score is None or user_answers_indices is None:
         await update.message.reply_text("Ошибка данных теста. Попробуйте снова из /menu.", reply_markup=get_main_menu_keyboard(user_data))
-        udm.update_user_data(chat_id, {"stage": "test_email_data_error", "pending_email_test_id": None, "pending_email_test_score": None, "pending_email_test_answers_indices": None, "pending_email_test_is_forced_day14": False})
+        await udm.aupdate_user(chat_id, {"stage": "test_email_data_error", "pending_email_test_id": None, "pending_email_test_score": None, "pending_email_test_answers_indices": None, "pending_email_test_is_forced_day14": False})
         return
 
     if "@" not in email_text or "." not in email_text.split("@")[-1]: # Basic email validation
         await update.message.reply_text(escape_markdown_v2(config.EMAIL_INVALID_TEXT), parse_mode=ParseMode.MARKDOWN_V2); return
 
-    udm.set_user_email(chat_id, email_text)
-    # Refresh user_data after setting email
-    user_data = udm.get_user_data(chat_id)
-
     test_result_details = test_engine.get_test_result(test_id, score, user_answers_indices)
     full_html_result = test_result_details.get("full_html_result", "<p>Результаты не найдены.</p>")
     test_def_subj = test_engine.get_test_by_id(test_id)
@@ -991,24 +969,27 @@ async def handle_potential_email(update: Update, context: ContextTypes.DEFAULT_T
     email_sent_successfully = email_sender.send_email(recipient_email=email_text, subject=subject, html_body=full_html_result)
     email_status_key = "success" if email_sent_successfully else "failure"
 
-    # Update tests_taken with email status
-    tests_taken_data = user_data.get("tests_taken", {})
-    if test_id not in tests_taken_data:
-        logger.warning(f"Test {test_id} not found in tests_taken for user {chat_id} when trying to log email status. Creating a minimal entry for email logging.")
-        tests_taken_data[test_id] = { 
-            "summary": f"Entry for {test_id} created during email status update.",
-            "answers": [],
-            "date_taken": datetime.datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S'),
-            "consult_interest_shown": False
-        }
-    
-    if test_id not in tests_taken_data: 
-         tests_taken_data[test_id] = {}
-
-    tests_taken_data[test_id].update({
-        "email_recipient": email_text, 
-        "email_sent_status": email_status_key
-    })
+    # Email, статус отправки в tests_taken, очистка временного состояния и итоговая стадия - одной записью
+    def record_email_result(txn_user):
+        tests_taken_data = txn_user.get("tests_taken") or {}
+        if test_id not in tests_taken_data:
+            logger.warning(f"Test {test_id} not found in tests_taken for user {chat_id} when trying to log email status. Creating a minimal entry for email logging.")
+            tests_taken_data[test_id] = udm.make_test_taken_entry(user_answers_indices, score)
+        tests_taken_data[test_id].update({
+            "email_recipient": email_text, 
+            "email_sent_status": email_status_key
+        })
+        txn_user.update({
+            "email": email_text,
+            "tests_taken": tests_taken_data,
+            "pending_email_test_id": None,
+            "pending_email_test_score": None,
+            "pending_email_test_answers_indices": None,
+            "pending_email_test_is_forced_day14": False,
+            "stage": f"post_test_offer_email_sent_{test_id}"
+        })
+
+    user_data = await udm.atransaction(chat_id, record_email_result) or user_data
 
     # Отправляем подтверждение пользователю
     if email_sent_successfully:
@@ -1031,16 +1012,6 @@ async def handle_potential_email(update: Update, context: ContextTypes.DEFAULT_T
         except Exception as e_admin_notify:
             logger.error(f"Failed to send admin notification about email status: {e_admin_notify}")
 
-    # Очищаем временное состояние
-    udm.update_user_data(chat_id, {
-        "tests_taken": tests_taken_data,
-        "pending_email_test_id": None,
-        "pending_email_test_score": None,
-        "pending_email_test_answers_indices": None,
-        "pending_email_test_is_forced_day14": False,
-        "stage": None
-    })
-
     escaped_email_md = escape_markdown_v2(email_text)
     if email_sent_successfully:
         email_feedback_part1 = f"💌 Ура\\! Подробные результаты теста уже летят к тебе на _{escaped_email_md}_\\!"
@@ -1072,13 +1043,43 @@ async def handle_potential_email(update: Update, context: ContextTypes.DEFAULT_T
     reply_markup = InlineKeyboardMarkup(buttons)
 
     await update.message.reply_text(consult_offer_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
-    udm.set_user_stage(chat_id, f"post_test_offer_email_sent_{test_id}")
 
 async def myid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in config.ADMIN_USER_IDS: await update.message.reply_text("Эта команда доступна только администраторам."); return
     await update.message.reply_text(f"Ваш User ID: `{user_id}`", parse_mode=ParseMode.MARKDOWN_V2)
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in config.ADMIN_USER_IDS: await update.message.reply_text("Только для админов."); return
+    stats = await udm.aget_user_stats()
+    modes_str = ", ".join(f"{mode}: {count}" for mode, count in stats["by_mode"].items()) or "—"
+    days_str = ", ".join(f"{day}: {count}" for day, count in stats["by_day"].items()) or "—"
+    sent_today = await asyncio.to_thread(send_ledger.get_ledger().stats)
+    pruned_today = await asyncio.to_thread(practice_scheduler.pruned_today)
+    pruned_str = ", ".join(f"{reason}: {count}" for reason, count in pruned_today.items()) or "—"
+    sent_str = ", ".join(f"{part}: {counts['sent']}" + (f" (+{counts['claimed']} в процессе)" if counts['claimed'] else "")
+                         for part, counts in sorted(sent_today.items())) or "—"
+    await update.message.reply_text(
+        f"Подписчиков: {stats['subscribed']}\n"
+        f"По режимам: {modes_str}\n"
+        f"По дням: {days_str}\n"
+        f"Ждут ввода email: {stats['awaiting_email']}\n"
+        f"Практик отправлено сегодня (UTC): {sent_str}\n"
+        f"Отписано недоступных сегодня: {pruned_str}\n"
+        f"Активных блокировок чатов: {udm.chat_locks_in_use()}"
+        f"{_delivery_stats_text()}"
+    )
+
+def _delivery_stats_text() -> str:
+    last_run = delivery.get_engine().stats()["last_run"]
+    if not last_run:
+        return ""
+    return (f"\nПоследняя рассылка ({last_run['label']}): {last_run['sent']}/{last_run['total']}, "
+            f"пропущено {last_run['skipped']}, "
+            f"ошибок {last_run['failed']}, недоступных {last_run['pruned']}, повторов {last_run['retried']}, "
+            f"{last_run['throughput']} сообщ./с за {last_run['elapsed']} с")
+
 async def setday_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id; args = context.args
     if user_id not in config.ADMIN_USER_IDS: await update.message.reply_text("Только для админов."); return
@@ -1086,15 +1087,48 @@ async def setday_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try: target_user_id = int(args[0]); day_number = int(args[1])
     except ValueError: await update.message.reply_text("ID и день должны быть числами."); return
     if not (1 <= day_number <= daily_content.TOTAL_DAYS): await update.message.reply_text(f"День от 1 до {daily_content.TOTAL_DAYS}."); return
-    target_user_data = udm.get_user_data(target_user_id)
+    target_user_data = await udm.aget_user(target_user_id)
     if not target_user_data: await update.message.reply_text(f"Юзер {target_user_id} не найден."); return
-    if udm.update_user_data(target_user_id, {"current_daily_day": day_number, "last_morning_sent_date": None, "last_evening_sent_date": None, "stage": f"admin_set_day_{day_number}"}):
-        target_user_data_updated = udm.get_user_data(target_user_id)
-        if target_user_data_updated and target_user_data_updated.get("subscribed_to_daily"):
-            _schedule_daily_jobs_for_user(target_user_id, context.job_queue, target_user_data_updated)
+    if await udm.aupdate_user(target_user_id, {"current_daily_day": day_number, "last_morning_sent_date": None, "last_evening_sent_date": None, "stage": f"admin_set_day_{day_number}"}):
+        # Новый день можно получить уже сегодня - снимаем сегодняшние отметки журнала отправок
+        for part in practice_scheduler.PRACTICE_PARTS:
+            await asyncio.to_thread(send_ledger.get_ledger().release, target_user_id, part, sent=True)
         await update.message.reply_text(f"Для {target_user_id} день {day_number} установлен.")
     else: await update.message.reply_text(f"Не удалось обновить день для {target_user_id}.")
 
+async def settime_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/settime [утро] [вечер] [часовой пояс] - личное время практик; /settime reset - как у всех"""
+    user = await update_user_and_log(update, context)
+    chat_id = user.id; args = context.args or []
+    if not args:
+        user_data = await udm.aget_user(chat_id) or {}
+        await update.message.reply_text(
+            f"Утренняя практика: {user_data.get('morning_time') or config.MORNING_PRACTICE_TIME_MSK_STR}\n"
+            f"Вечерняя практика: {user_data.get('evening_time') or config.EVENING_PRACTICE_TIME_MSK_STR}\n"
+            f"Часовой пояс: {user_data.get('timezone') or config.DEFAULT_USER_TIMEZONE}\n"
+            "Изменить: /settime 08:30 20:00 Europe/Moscow (любую часть можно опустить), сбросить: /settime reset"
+        )
+        return
+    if args == ["reset"]:
+        schedule = {"timezone": None, "morning_time": None, "evening_time": None}
+    else:
+        times = [arg for arg in args if ":" in arg]
+        zones = [arg for arg in args if ":" not in arg]
+        if len(times) > 2 or len(zones) > 1:
+            await update.message.reply_text("Нужно: /settime [HH:MM утро] [HH:MM вечер] [часовой пояс]"); return
+        schedule = dict(zip(("morning_time", "evening_time"), times))
+        if zones:
+            schedule["timezone"] = zones[0]
+    try:
+        updated = await udm.aset_user_schedule(chat_id, **schedule)
+    except ValueError as e:
+        logger.info(f"User {chat_id} sent invalid /settime {args}: {e}")
+        await update.message.reply_text("Не понял время или часовой пояс. Пример: /settime 08:30 20:00 Europe/Moscow"); return
+    if not updated:
+        await update.message.reply_text("Сначала нажмите /start."); return
+    logger.info(f"User {chat_id} set practice schedule: {schedule}")
+    await update.message.reply_text("Готово, время практик обновлено.")
+
 async def forcesend_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id; args = context.args
     if user_id not in config.ADMIN_USER_IDS: await update.message.reply_text("Только для админов."); return
@@ -1104,16 +1138,13 @@ async def forcesend_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     type_to_send = args[2] if len(args) > 2 else "morning"
     if not (1 <= day_to_send <= daily_content.TOTAL_DAYS): await update.message.reply_text(f"День от 1 до {daily_content.TOTAL_DAYS}."); return
     if type_to_send not in ["morning", "evening"]: await update.message.reply_text("Тип: 'morning' или 'evening'."); return
-    target_user_data = udm.get_user_data(target_user_id)
+    target_user_data = await udm.aget_user(target_user_id)
     if not target_user_data: await update.message.reply_text(f"Юзер {target_user_id} не найден."); return
-    day_content_data = daily_content.DAILY_CONTENT.get(day_to_send)
-    if not day_content_data: await update.message.reply_text(f"Нет контента дня {day_to_send}."); return
-    practice_data = day_content_data.get(type_to_send)
-    if not practice_data: await update.message.reply_text(f"Нет {type_to_send} практики дня {day_to_send}."); return
+    bundle = daily_content.get_practice_bundle(day_to_send, type_to_send)
+    if not bundle: await update.message.reply_text(f"Нет {type_to_send} практики дня {day_to_send}."); return
 
-    kb = [[InlineKeyboardButton(practice_data["button_text"], callback_data=f"daily_ack_{day_to_send}_{type_to_send}")], [InlineKeyboardButton("📖 В меню", callback_data=MENU_CALLBACK_MAIN)]]
     try:
-        await context.bot.send_message(target_user_id, practice_data["text"], reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+        await delivery.get_engine().send(target_user_id, lambda: context.bot.send_message(target_user_id, bundle.text, reply_markup=bundle.reply_markup, parse_mode=bundle.parse_mode))
         await update.message.reply_text(f"Отправлена {type_to_send} практика дня {day_to_send} юзеру {target_user_id}.")
         if type_to_send == "evening":
             if day_to_send in config.TEST_OFFER_DAYS or day_to_send == 14:
@@ -1135,7 +1166,7 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     if isinstance(update, Update) and update.effective_message:
         try:
             user_id_for_menu = update.effective_user.id if update.effective_user else None
-            user_data_for_menu = udm.get_user_data(user_id_for_menu) if user_id_for_menu else None
+            user_data_for_menu = await udm.aget_user(user_id_for_menu) if user_id_for_menu else None
             await update.effective_message.reply_text(
                 escape_markdown_v2("Ой, что-то пошло не так... 😥 Попробуйте, пожалуйста, немного позже или вернитесь в /menu."),
                 reply_markup=get_main_menu_keyboard(user_data_for_menu),
@@ -1191,14 +1222,14 @@ async def send_payment_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     try:
-        with open(qr_code_path, 'rb') as photo:
-            await context.bot.send_photo(
-                chat_id=chat_id,
-                photo=photo,
-                caption=text,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.MARKDOWN
-            )
+        await media_registry.send_photo(
+            context.bot,
+            chat_id,
+            qr_code_path,
+            caption=text,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.MARKDOWN
+        )
         logger.info(f"Отправлена информация для оплаты с QR-кодом пользователю {chat_id}")
     except FileNotFoundError:
         logger.warning(f"Файл QR-кода не найден по пути: {qr_code_path}. Отправляется текстовая версия.")
@@ -1233,24 +1264,61 @@ async def payment_confirmed_handler(update: Update, context: ContextTypes.DEFAUL
     logger.info(f"Пользователь {user.id} сообщил об оплате консультации.")
 
 
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Конкурентная обработка апдейтов: разные чаты параллельно (не больше max_concurrent_updates),
+    апдейты одного чата - по очереди под udm.chat_lock.
+
+    Слот обработки берётся уже под chat_lock, а не до него: иначе пачка апдейтов одного чата
+    (быстрые нажатия, пересланный альбом) заняла бы все слоты в ожидании своей блокировки
+    и остановила бы остальные чаты. Поэтому лимит держит свой семафор, а семафор
+    BaseUpdateProcessor.process_update (он берётся до do_process_update) не ограничивает.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(sys.maxsize)
+        # Базовый семафор уже создан на sys.maxsize; наружу (application.concurrent_updates) - настоящий лимит
+        self._max_concurrent_updates = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        async with udm.chat_lock(chat.id), self._slots:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+async def flush_users_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодический сброс изменённых записей пользователей на диск"""
+    flushed = await udm.aflush_users()
+    if flushed:
+        logger.debug(f"Flushed {flushed} user records")
+
 # Функция для грациозного завершения и сохранения данных
 def shutdown_handler(signum, frame):
     logger.info("Получен сигнал остановки. Сохраняю данные перед выходом...")
     try:
-        # Загружаем текущие данные из user_data_manager и сохраняем их
-        current_users_data = udm.load_users()
-        if current_users_data:
-            udm.save_users(current_users_data)
-            logger.info("Данные пользователей успешно сохранены.")
-        else:
-            logger.warning("Нет данных для сохранения.")
+        # Сбрасываем на диск все изменения, накопленные в кэше user_data_manager
+        flushed = udm.flush_users()
+        logger.info(f"Данные пользователей успешно сохранены (записей: {flushed}).")
     except Exception as e:
         logger.error(f"Ошибка при сохранении данных: {e}")
     finally:
         logger.info("Завершение работы бота.")
         sys.exit(0)
 
-async def main() -> None:
+async def main(deliver_practices: bool = True) -> None:
+    """deliver_practices=False - процесс только опрашивает Telegram и обрабатывает апдейты,
+    а ежедневные практики рассылают воркеры доставки (delivery_worker, запускаются лаунчером)."""
     # Регистрируем обработчик для сигналов SIGINT (Ctrl+C) и SIGTERM
     signal.signal(signal.SIGINT, shutdown_handler)
     signal.signal(signal.SIGTERM, shutdown_handler)
@@ -1267,8 +1335,18 @@ async def main() -> None:
     # Создание приложения с увеличенными таймаутами
     logger.info("=== Создание приложения ===")
     request = HTTPXRequest(connection_pool_size=20, read_timeout=60.0, write_timeout=60.0, connect_timeout=60.0)
-    application = Application.builder().token(config.BOT_TOKEN).request(request).build()
+    application = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .request(request)
+        .concurrent_updates(ChatUpdateProcessor(config.MAX_CONCURRENT_UPDATES))
+        .build()
+    )
     
+    # Экранированные статические тексты и клавиатуры - в кэш заранее
+    text_render.prewarm()
+    keyboards.prebuild()
+
     # Инициализируем job_queue
     job_queue = application.job_queue
     
@@ -1278,14 +1356,22 @@ async def main() -> None:
         job.schedule_removal()
     logger.info("=== ВСЕ ЗАДАЧИ ОЧИЩЕНЫ ===")
 
-    # Загружаем существующих пользователей и планируем задачи
-    logger.info("Loading existing users and scheduling jobs...")
-    for user_id, user_data in udm.load_users().items():
-        if user_data.get("subscribed_to_daily"):
-            logger.info(f"=== ВРЕМЯ ДЛЯ ПОЛЬЗОВАТЕЛЯ {user_id} ===")
-            logger.info(f"Утром: {config.MORNING_PRACTICE_TIME_UTC}")
-            logger.info(f"Вечером: {config.EVENING_PRACTICE_TIME_UTC}")
-            _schedule_daily_jobs_for_user(int(user_id), job_queue, user_data)
+    # Фоновый сброс кэша пользователей на диск
+    job_queue.run_repeating(flush_users_job, interval=config.USERS_FLUSH_INTERVAL_SECONDS, name="users_flush")
+
+    # Минутный тикер ежедневных практик (получатели - минутные корзины индекса хранилища).
+    # Никаких задач на пользователя: стоимость старта - загрузка хранилища и O(1) задач.
+    if deliver_practices:
+        schedule_started = time.perf_counter()
+        subscribers_count = (await udm.aget_user_stats())["subscribed"]
+        _schedule_practice_ticker(job_queue)
+        plan = await practice_scheduler.aplan_slots()
+        logger.info(
+            f"Practice ticker scheduled for {subscribers_count} subscribers in {len(plan)} minute buckets "
+            f"in {time.perf_counter() - schedule_started:.2f}s: {practice_scheduler.format_plan(plan)}"
+        )
+    else:
+        logger.info("Daily practices are delivered by delivery worker processes; this process only polls updates.")
 
     # Обработчики команд
     logger.info("=== Добавление обработчиков команд ===")
@@ -1294,6 +1380,8 @@ async def main() -> None:
     application.add_handler(CommandHandler("stopdaily", stopdaily_command))
     application.add_handler(CommandHandler("myid", myid_command))
     application.add_handler(CommandHandler("setday", setday_command))
+    application.add_handler(CommandHandler("settime", settime_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("forcesend", forcesend_command))
     application.add_handler(CommandHandler("forcepractice", force_send_practice_command))
 
@@ -1337,6 +1425,7 @@ async def main() -> None:
             logger.info("Application остановлен.")
         logger.info("Вызов application.shutdown()...")
         await application_for_shutdown.shutdown()
+        await udm.aflush_users()
         logger.info("=== Бот полностью остановлен. ===")
 
 
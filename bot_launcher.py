@@ -15,14 +15,19 @@ logger = logging.getLogger(__name__)
 
 async def run_bot():
     logger.info("=== Запуск бота ===")
+    import delivery_worker
+    # Воркеры рассылки практик (config.DELIVERY_WORKERS); без них рассылает сам процесс бота
+    workers = delivery_worker.start_workers()
     try:
         from bot import main
-        await main()
+        await main(deliver_practices=not workers)
         logger.info("=== Бот запущен успешно ===")
     except Exception as e:
         logger.error(f"=== Критическая ошибка при запуске бота: {str(e)} ===")
         logger.error(f"=== Подробный трейсбэк: ===\n{traceback.format_exc()}")
         raise
+    finally:
+        delivery_worker.stop_workers(workers)
 
 if __name__ == "__main__":
     import asyncio
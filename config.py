@@ -29,8 +29,12 @@ ADMIN_CONTACT_USERNAME = "GoidaSegun"
 MORNING_PRACTICE_TIME_MSK_STR = "09:00"
 # Время отправки вечерней практики (MSK)
 EVENING_PRACTICE_TIME_MSK_STR = "18:00"
+# Часовой пояс пользователей, не выбравших свой (/settime). Время выше - локальное время
+# в этом поясе; в UTC оно переводится на каждую дату отдельно (см. practice_times).
+DEFAULT_USER_TIMEZONE = "Europe/Moscow"
 
-# Конвертируем время в UTC для планировщика
+# Конвертируем время в UTC (на сегодня) - для логов и ручных задач admin_commands;
+# планировщик практик считает время каждого пользователя сам
 morning_time = datetime.datetime.strptime(MORNING_PRACTICE_TIME_MSK_STR, '%H:%M').time()
 evening_time = datetime.datetime.strptime(EVENING_PRACTICE_TIME_MSK_STR, '%H:%M').time()
 
@@ -54,6 +58,54 @@ CONSULTATION_PRICE = 5000  # Цена в рублях
 PAYMENT_LINK = "https://www.tinkoff.ru/rm/r_YlujHwdHxX.WmqISDwRzN/a5XDV14317"
 PAYMENT_QR_CODE_PATH = "payment_qr.png"
 
+# === User Storage ===
+# "json" - users.json целиком в памяти, изменения дописываются в журнал пачками
+# "sqlite" - users.db (WAL), одна строка на пользователя; при первом запуске импортирует users.json
+USER_STORAGE_BACKEND = "json"
+USERS_DB_FILE = "users.db"
+USERS_FLUSH_INTERVAL_SECONDS = 5  # Период фонового сброса изменений на диск
+USERS_FLUSH_DIRTY_THRESHOLD = 200  # Сброс вне очереди, если накопилось столько изменённых записей
+USERS_JOURNAL_FILE = "users.json.journal"  # Журнал изменений поверх снапшота users.json
+USERS_JOURNAL_COMPACT_BYTES = 5 * 1024 * 1024  # После этого размера журнал сворачивается в новый снапшот
+# "group" - один fsync на пачку изменений раз в USERS_FLUSH_INTERVAL_SECONDS (можно потерять последние секунды)
+# "always" - fsync на каждое изменение (медленнее, но без потерь)
+USERS_DURABILITY = "group"
+# Формат users.json и журнала: "auto" (orjson -> msgpack -> json), "json", "orjson", "msgpack".
+# При чтении формат определяется автоматически; перевести файл вручную: python convert_users.py <codec>
+USERS_CODEC = "auto"
+# Сколько апдейтов обрабатывается одновременно (апдейты одного чата всё равно идут по очереди)
+MAX_CONCURRENT_UPDATES = 32
+
+# === Delivery (массовая рассылка) ===
+# Окно доставки: каждый получает практику в своё (стабильное) время в [его время практики, + окно)
+MORNING_DELIVERY_WINDOW_MINUTES = 15  # по умолчанию 09:00-09:15 МСК
+EVENING_DELIVERY_WINDOW_MINUTES = 15  # по умолчанию 18:00-18:15 МСК
+DELIVERY_GLOBAL_RATE = 25  # сообщений в секунду на весь бот (лимит Telegram ~30)
+DELIVERY_PER_CHAT_RATE = 1  # сообщений в секунду в один чат
+DELIVERY_CONCURRENCY = 20  # одновременных доставок
+DELIVERY_MAX_ATTEMPTS = 4  # попыток на RetryAfter/сетевые ошибки
+# Отдельные процессы-воркеры рассылки практик (0 - всё в одном процессе с опросом Telegram).
+# Каждый воркер обслуживает свою долю chat_id и делит DELIVERY_GLOBAL_RATE с остальными.
+# Нужен общий для процессов бэкенд: USER_STORAGE_BACKEND = "sqlite".
+DELIVERY_WORKERS = 0
+
+# === Schedule state ===
+SCHEDULE_DB_FILE = "schedule.db"  # до какой минуты расписание практик уже отработано
+# Минуты, пропущенные пока бот был выключен (только в пределах текущих суток UTC):
+# "late" - отправить сразу после старта, "skip" - пропустить, "spread" - растянуть отправку
+PRACTICE_CATCHUP_POLICY = "late"
+PRACTICE_CATCHUP_SPREAD_MINUTES = 30
+# Журнал отправок практик (захват перед отправкой, подтверждение после) - защита от дублей
+SEND_LEDGER_DB_FILE = "send_ledger.db"
+# Через сколько секунд неподтверждённый захват (упавший воркер) можно перехватить
+SEND_CLAIM_TIMEOUT_SECONDS = 600
+
+# Реестр загруженных картинок: file_id Telegram по хэшу содержимого файла (см. media_registry)
+MEDIA_REGISTRY_DB_FILE = "media_registry.db"
+
+# Сколько экранированных для MarkdownV2 строк держать в кэше (см. text_render)
+ESCAPE_CACHE_SIZE = 2048
+
 # === Other Settings ===
 ONBOARDING_VIDEO_NOTE_FILE_ID = "DQACAgIAAxkBAAIJ_GZgB2Pz82u9v0gWBb0s4u8yBAwvAAJgPQAC9GZBSAMj3YJp6qGYNQQ"
 ONBOARDING_VIDEO_DURATION_SECONDS = 55
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Перевод users.json (снапшот + журнал) в другой формат хранения.
+# Запускать при остановленном боте:
+#   python convert_users.py msgpack
+#   python convert_users.py json --path users.json --journal users.json.journal
+#   python convert_users.py --info
+
+import argparse
+import logging
+import os
+import time
+
+import config
+import user_codec
+from user_storage import JsonUserStore
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def describe(path: str):
+    if not os.path.exists(path):
+        return "нет файла"
+    with open(path, 'rb') as f:
+        head = f.read(len(user_codec.MSGPACK_MAGIC))
+    return f"{user_codec.detect_format(head)}, {os.path.getsize(path)} байт"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Конвертация хранилища пользователей между форматами")
+    parser.add_argument("codec", nargs="?", choices=["json", "orjson", "msgpack", "auto"],
+                        help="целевой формат")
+    parser.add_argument("--path", default="users.json", help="файл снапшота")
+    parser.add_argument("--journal", default=config.USERS_JOURNAL_FILE, help="файл журнала")
+    parser.add_argument("--info", action="store_true", help="только показать текущий формат файлов")
+    args = parser.parse_args()
+
+    logger.info(f"Доступные кодеки: {', '.join(user_codec.available_codecs())}")
+    logger.info(f"{args.path}: {describe(args.path)}")
+    logger.info(f"{args.journal}: {describe(args.journal)}")
+    if args.info or not args.codec:
+        return
+
+    started = time.perf_counter()
+    store = JsonUserStore(args.path, journal_path=args.journal, codec=args.codec)
+    users_count = store.load()
+    loaded = time.perf_counter()
+    # Компакция пишет снапшот целевым кодеком и удаляет проигранный журнал
+    store.compact()
+    store.close()
+    finished = time.perf_counter()
+
+    logger.info(f"Загружено {users_count} пользователей за {loaded - started:.3f} с, "
+                f"записано в формате {store.codec.name} за {finished - loaded:.3f} с")
+    logger.info(f"{args.path}: {describe(args.path)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,10 @@
 # daily_content.py
+import collections
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+
+from text_render import escape_markdown_v2
 
 # Общий текст для кнопки подтверждения
 COMMON_BUTTON_TEXT = "👍 Сделаю с удовольствием!"
@@ -118,4 +124,64 @@ def get_extended_morning_content(day_number_in_extended_cycle: int):
     if raw_text:
         # Для расширенного цикла также добавляем префикс
         return f"☀️ <b>Утренняя магия (Продолжение, день {day_number_in_extended_cycle})</b> ✨\n\n{raw_text}"
-    return "Контент для этого утра в дополнительном цикле еще не готов."
\ No newline at end of file
+    return "Контент для этого утра в дополнительном цикле еще не готов."
+
+
+# --- Готовые сообщения практик ---
+# Для каждой (цикл, день, часть дня) один раз при импорте собирается сообщение:
+# текст, parse_mode и клавиатура. Объекты telegram неизменяемы, поэтому одна и та же
+# клавиатура переиспользуется во всех отправках рассылки - на сообщение ничего не создаётся.
+
+MAIN_CYCLE = "main"
+EXTENDED_CYCLE = "extended"
+
+# Общие callback_data с bot.py
+MENU_CALLBACK_MAIN = "menu_main"
+PRACTICE_CONSULT_CALLBACK = "post_email_consult_yes_practice"
+DAILY_ACK_PREFIX = "daily_ack_"
+
+# acked_markup - клавиатура после нажатия кнопки подтверждения (без неё)
+PracticeBundle = collections.namedtuple("PracticeBundle", "text parse_mode reply_markup acked_markup ack_callback")
+
+PRACTICE_FOOTER_ROW = (
+    InlineKeyboardButton("Купить консультацию", callback_data=PRACTICE_CONSULT_CALLBACK),
+    InlineKeyboardButton("📖 В меню", callback_data=MENU_CALLBACK_MAIN),
+)
+_ACKED_MARKUP = InlineKeyboardMarkup((PRACTICE_FOOTER_ROW,))
+
+
+def daily_ack_callback(day: int, part: str, cycle: str = MAIN_CYCLE) -> str:
+    # "daily_ack_3_morning" / "daily_ack_ext_3_morning": день и часть - два последних поля
+    prefix = DAILY_ACK_PREFIX if cycle == MAIN_CYCLE else f"{DAILY_ACK_PREFIX}ext_"
+    return f"{prefix}{day}_{part}"
+
+
+def _build_bundle(text: str, button_text: str, ack_callback: str) -> PracticeBundle:
+    reply_markup = InlineKeyboardMarkup((
+        (InlineKeyboardButton(button_text, callback_data=ack_callback),),
+        PRACTICE_FOOTER_ROW,
+    ))
+    return PracticeBundle(text, ParseMode.HTML, reply_markup, _ACKED_MARKUP, ack_callback)
+
+
+def _build_practice_bundles() -> dict:
+    bundles = {}
+    for day, parts in DAILY_CONTENT.items():
+        for part, content in parts.items():
+            if content:
+                bundles[(MAIN_CYCLE, day, part)] = _build_bundle(
+                    content["text"], content["button_text"], daily_ack_callback(day, part))
+    for day, day_data in PRACTICES_EXTENDED_CYCLE_DATA.items():
+        if day_data.get("morning_text"):
+            bundles[(EXTENDED_CYCLE, day, "morning")] = _build_bundle(
+                get_extended_morning_content(day), COMMON_BUTTON_TEXT,
+                daily_ack_callback(day, "morning", EXTENDED_CYCLE))
+    return bundles
+
+
+PRACTICE_BUNDLES = _build_practice_bundles()
+
+
+def get_practice_bundle(day: int, part: str, cycle: str = MAIN_CYCLE):
+    """Готовое сообщение практики или None, если для этого дня/части контента нет."""
+    return PRACTICE_BUNDLES.get((cycle, day, part))
@@ -0,0 +1,326 @@
+# delivery.py
+# Массовая отправка сообщений с учётом лимитов Telegram.
+#
+# Telegram допускает ~30 сообщений в секунду на бота и ~1 в секунду в один чат;
+# при превышении он отвечает RetryAfter. Движок:
+#   - пропускает каждую отправку через token bucket (общий и на чат),
+#   - ограничивает число одновременных доставок,
+#   - на RetryAfter приостанавливает все отправки на указанное время
+#     и возвращает доставку в очередь повторов,
+#   - на сетевые ошибки/таймауты повторяет с экспоненциальной паузой,
+#   - постоянные ошибки (бот заблокирован, аккаунт удалён, чат не найден) не повторяет,
+#     а собирает в отчёт, чтобы вызывающий одной пачкой отписал недоступных,
+#   - считает пропускную способность и пишет итог в лог.
+#
+# Используется рассылкой ежедневных практик (practice_scheduler) и админскими отправками.
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Постоянные ошибки отправки: причина -> фрагменты текста ошибки Telegram
+PERMANENT_FAILURES = (
+    ("blocked", ("bot was blocked by the user", "bot was kicked")),
+    ("deactivated", ("user is deactivated",)),
+    ("chat_not_found", ("chat not found",)),
+)
+
+
+def permanent_failure(error):
+    """Причина постоянной ошибки ("blocked", "deactivated", "chat_not_found") или None.
+
+    Такому чату слать бессмысленно: повтор только тратит лимит отправки.
+    """
+    if not isinstance(error, (Forbidden, BadRequest)):
+        return None
+    message = str(error).lower()
+    for reason, fragments in PERMANENT_FAILURES:
+        if any(fragment in message for fragment in fragments):
+            return reason
+    return None
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity подряд."""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float = None) -> float:
+        """Забирает токен (возможно, в долг) и возвращает, сколько секунд подождать до отправки."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class DeliveryReport:
+    __slots__ = ("label", "total", "sent", "skipped", "failed", "retried", "rate_limited", "started", "finished",
+                 "sent_per_second", "permanent")
+
+    def __init__(self, label: str, total: int):
+        self.label = label
+        self.total = total
+        self.sent = 0
+        # deliver вернул False: отправлять было нечего (уже отправлено, отписан и т.п.)
+        self.skipped = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.started = time.monotonic()
+        self.finished = None
+        # секунда от начала рассылки -> отправлено за эту секунду
+        self.sent_per_second = collections.Counter()
+        # chat_id -> причина постоянной ошибки (см. permanent_failure)
+        self.permanent = {}
+
+    @property
+    def pruned(self) -> int:
+        return len(self.permanent)
+
+    def record_sent(self, now: float):
+        self.sent += 1
+        self.sent_per_second[int(now - self.started)] += 1
+
+    def rate_curve(self, bucket_seconds: int = 60):
+        """Фактическая скорость отправки (сообщений/с) по интервалам bucket_seconds от начала."""
+        if not self.sent_per_second:
+            return []
+        buckets = collections.Counter()
+        for second, count in self.sent_per_second.items():
+            buckets[second // bucket_seconds] += count
+        return [round(buckets[k] / bucket_seconds, 2) for k in range(max(buckets) + 1)]
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "label": self.label, "total": self.total, "sent": self.sent, "skipped": self.skipped, "failed": self.failed,
+            "retried": self.retried, "rate_limited": self.rate_limited, "pruned": self.pruned,
+            "elapsed": round(self.elapsed, 2), "throughput": round(self.throughput, 2),
+            "rate_curve": self.rate_curve(),
+        }
+
+    def __str__(self):
+        return (f"Delivery '{self.label}': sent {self.sent}/{self.total}, skipped {self.skipped}, failed {self.failed}, "
+                f"unreachable {self.pruned}, retried {self.retried}, RetryAfter {self.rate_limited}, "
+                f"{self.elapsed:.1f}s, {self.throughput:.1f} msg/s")
+
+
+class DeliveryEngine:
+    # Сколько пустых (полностью восстановившихся) корзин чатов держать перед чисткой
+    _CHAT_BUCKETS_SWEEP_AT = 10000
+
+    def __init__(self, global_rate: float = 25, per_chat_rate: float = 1, per_chat_burst: int = 3,
+                 concurrency: int = 20, max_attempts: int = 4, backoff_base: float = 1.0):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self._chat_buckets = {}
+        self._paused_until = 0.0
+        self.last_report = None
+        self.totals = {"sent": 0, "skipped": 0, "failed": 0, "pruned": 0, "retried": 0, "rate_limited": 0}
+
+    # --- лимиты ---
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self._CHAT_BUCKETS_SWEEP_AT:
+                now = time.monotonic()
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.is_full(now)}
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id: int):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            # Сначала ждём свою очередь в чат, потом общий токен - чтобы не занимать общий впустую
+            chat_wait = self._chat_bucket(chat_id).reserve(now)
+            if chat_wait:
+                await asyncio.sleep(chat_wait)
+            global_wait = self.global_bucket.reserve()
+            if global_wait:
+                await asyncio.sleep(global_wait)
+            if time.monotonic() >= self._paused_until:
+                return
+
+    def pause(self, seconds: float):
+        """Остановить все отправки (Telegram ответил RetryAfter)."""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            logger.warning(f"Telegram flood control: pausing delivery for {seconds:.1f}s")
+
+    async def send(self, chat_id: int, make_request):
+        """Одна отправка в пределах лимитов: make_request() -> awaitable вызова Bot API.
+
+        RetryAfter приостанавливает все отправки и пробрасывается вызывающему.
+        """
+        await self._acquire(chat_id)
+        try:
+            return await make_request()
+        except RetryAfter as e:
+            self.pause(_retry_after_seconds(e))
+            raise
+
+    # --- массовая доставка ---
+
+    def _backoff(self, error, attempt: int) -> float:
+        if isinstance(error, RetryAfter):
+            return _retry_after_seconds(error)
+        return self.backoff_base * (2 ** (attempt - 1))
+
+    @staticmethod
+    def _is_retryable(error) -> bool:
+        # TimedOut - подкласс NetworkError; BadRequest/Forbidden тоже NetworkError-потомки в PTB,
+        # поэтому сетевыми считаем только "чистые" NetworkError и TimedOut
+        return isinstance(error, (RetryAfter, TimedOut)) or type(error) is NetworkError
+
+    async def run(self, chat_ids, deliver, label: str = "delivery", offsets: dict = None) -> DeliveryReport:
+        """Доставка deliver(chat_id) каждому чату; не больше concurrency одновременно.
+
+        deliver возвращает False, если отправлять было нечего (пропуск, считается в report.skipped),
+        иначе отправка засчитывается в report.sent. Ошибки отправки deliver должен пробрасывать: RetryAfter и сетевые ошибки
+        уходят в очередь повторов (до max_attempts попыток), постоянные (permanent_failure)
+        попадают в report.permanent без повторов, остальные считаются неудачей.
+        offsets - {chat_id: секунд от начала}: доставка не раньше этого момента
+        (окно доставки слота); без offsets всё отправляется сразу.
+        """
+        chat_ids = list(chat_ids)
+        report = DeliveryReport(label, len(chat_ids))
+        retry_queue = []  # куча (когда, порядковый номер, chat_id, попытка)
+        seq = itertools.count()
+        in_flight = 0
+        if offsets:
+            # Отложенные доставки живут в той же куче, что и повторы
+            retry_queue = [(report.started + offsets.get(chat_id, 0), next(seq), chat_id, 1) for chat_id in chat_ids]
+            heapq.heapify(retry_queue)
+            pending = iter(())
+        else:
+            pending = iter(chat_ids)
+
+        def _next_item():
+            if retry_queue and retry_queue[0][0] <= time.monotonic():
+                due, _, chat_id, attempt = heapq.heappop(retry_queue)
+                return chat_id, attempt
+            chat_id = next(pending, None)
+            if chat_id is not None:
+                return chat_id, 1
+            return None
+
+        async def _worker():
+            nonlocal in_flight
+            while True:
+                item = _next_item()
+                if item is None:
+                    if not retry_queue and in_flight == 0:
+                        return
+                    # Ждём ближайший повтор (или пока другой воркер не вернёт что-то в очередь)
+                    delay = retry_queue[0][0] - time.monotonic() if retry_queue else 0.05
+                    await asyncio.sleep(max(0.01, min(delay, 1.0)))
+                    continue
+                chat_id, attempt = item
+                in_flight += 1
+                try:
+                    if await deliver(chat_id) is False:
+                        report.skipped += 1
+                    else:
+                        report.record_sent(time.monotonic())
+                except Exception as e:
+                    reason = permanent_failure(e)
+                    if reason:
+                        report.permanent[chat_id] = reason
+                        logger.info(f"{label}: {chat_id} is unreachable ({reason}): {e}")
+                        continue
+                    if isinstance(e, RetryAfter):
+                        report.rate_limited += 1
+                    if self._is_retryable(e) and attempt < self.max_attempts:
+                        report.retried += 1
+                        heapq.heappush(retry_queue, (time.monotonic() + self._backoff(e, attempt), next(seq), chat_id, attempt + 1))
+                        logger.info(f"{label}: retrying {chat_id} (attempt {attempt + 1}) after {type(e).__name__}: {e}")
+                    else:
+                        report.failed += 1
+                        logger.error(f"{label}: delivery to {chat_id} failed after {attempt} attempt(s): {e}")
+                finally:
+                    in_flight -= 1
+
+        workers = min(self.concurrency, len(chat_ids))
+        await asyncio.gather(*(_worker() for _ in range(workers)))
+        report.finished = time.monotonic()
+        self.last_report = report
+        for key in self.totals:
+            self.totals[key] += getattr(report, key)
+        logger.info(str(report))
+        if report.elapsed >= 120:
+            logger.info(f"Delivery '{label}' rate curve, msg/s per minute: {report.rate_curve()}")
+        return report
+
+    def stats(self) -> dict:
+        return {
+            "totals": dict(self.totals),
+            "last_run": self.last_report.as_dict() if self.last_report else None,
+            "paused_for": max(0.0, round(self._paused_until - time.monotonic(), 1)),
+        }
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    # В новых версиях PTB retry_after может быть timedelta
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+_engine = None
+
+
+def init_engine(rate_share: float = 1.0) -> DeliveryEngine:
+    """Создаёт движок процесса. rate_share - доля общего лимита DELIVERY_GLOBAL_RATE:
+    лимит Telegram действует на бота целиком, и N воркеров доставки делят его поровну."""
+    global _engine
+    _engine = DeliveryEngine(
+        global_rate=config.DELIVERY_GLOBAL_RATE * rate_share,
+        per_chat_rate=config.DELIVERY_PER_CHAT_RATE,
+        concurrency=config.DELIVERY_CONCURRENCY,
+        max_attempts=config.DELIVERY_MAX_ATTEMPTS,
+    )
+    return _engine
+
+
+def get_engine() -> DeliveryEngine:
+    """Общий движок процесса: лимиты Telegram действуют на бота целиком."""
+    if _engine is None:
+        return init_engine()
+    return _engine
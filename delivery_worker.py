@@ -0,0 +1,124 @@
+# delivery_worker.py
+# Процессы-воркеры рассылки ежедневных практик.
+#
+# При config.DELIVERY_WORKERS = N лаунчер (bot_launcher.py / run_bot.py) запускает
+# N воркеров и один процесс опроса Telegram (bot.main(deliver_practices=False)).
+# Воркер не опрашивает Telegram: у него свой минутный тикер практик, который
+# обслуживает только его долю подписчиков (practice_scheduler.Shard, хэш chat_id),
+# и своя доля общего лимита отправки. Хранилище пользователей, состояние тикеров
+# (schedule.db) и журнал отправок (send_ledger.db) - общие SQLite-файлы, поэтому
+# большая утренняя рассылка идёт на нескольких ядрах и не тормозит ответы на апдейты.
+import asyncio
+import logging
+import multiprocessing
+import signal
+import sys
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать штатной остановки воркера, прежде чем убить его
+STOP_TIMEOUT_SECONDS = 30
+
+
+def workers_enabled() -> bool:
+    """Воркеры включены в config и могут работать с общим хранилищем."""
+    if config.DELIVERY_WORKERS <= 0:
+        return False
+    if config.USER_STORAGE_BACKEND != "sqlite":
+        logger.warning(
+            f"DELIVERY_WORKERS={config.DELIVERY_WORKERS} needs USER_STORAGE_BACKEND='sqlite' "
+            f"(got '{config.USER_STORAGE_BACKEND}'); delivering practices in the polling process."
+        )
+        return False
+    return True
+
+
+async def _serve(shard):
+    from telegram.ext import Application
+    from telegram.request import HTTPXRequest
+
+    import bot
+    import delivery
+    import practice_scheduler
+    import user_data_manager as udm
+
+    delivery.init_engine(rate_share=1 / shard.count)
+    request = HTTPXRequest(connection_pool_size=20, read_timeout=60.0, write_timeout=60.0, connect_timeout=60.0)
+    # Без Updater: апдейты получает только процесс опроса
+    application = Application.builder().token(config.BOT_TOKEN).request(request).updater(None).build()
+    bot._schedule_practice_ticker(application.job_queue, shard=shard)
+    plan = await practice_scheduler.aplan_slots()
+    logger.info(f"Delivery worker {shard} started: {practice_scheduler.format_plan(plan)}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop_event.set))
+    try:
+        await application.initialize()
+        await application.start()
+        await stop_event.wait()
+    finally:
+        logger.info(f"Delivery worker {shard} stopping...")
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await udm.aflush_users()
+        udm.close_store()
+        logger.info(f"Delivery worker {shard} stopped.")
+
+
+def run_worker(index: int, count: int):
+    """Точка входа процесса-воркера."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('bot.log'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+    import practice_scheduler
+    try:
+        asyncio.run(_serve(practice_scheduler.Shard(index, count)))
+    except Exception as e:
+        logger.error(f"Delivery worker {index + 1}/{count} crashed: {e}", exc_info=True)
+        raise
+
+
+def start_workers(count: int = None):
+    """Запускает воркеров доставки; [] если они выключены (тогда рассылает сам процесс опроса)."""
+    if not workers_enabled():
+        return []
+    count = count or config.DELIVERY_WORKERS
+    # Хранилище создаётся (и при необходимости импортируется из users.json) до старта воркеров,
+    # чтобы процессы не делали первичный импорт наперегонки
+    import user_data_manager as udm
+    udm.get_store()
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(count):
+        process = context.Process(target=run_worker, args=(index, count), name=f"delivery-worker-{index + 1}")
+        process.start()
+        processes.append(process)
+    logger.info(f"Started {count} delivery workers: {[p.pid for p in processes]}")
+    return processes
+
+
+def stop_workers(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()  # SIGTERM - штатная остановка
+    for process in processes:
+        process.join(STOP_TIMEOUT_SECONDS)
+        if process.is_alive():
+            logger.warning(f"{process.name} did not stop in {STOP_TIMEOUT_SECONDS}s, killing it.")
+            process.kill()
+            process.join()
+    if processes:
+        logger.info(f"Stopped {len(processes)} delivery workers.")
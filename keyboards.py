@@ -0,0 +1,107 @@
+# keyboards.py
+# Готовые inline-клавиатуры, общие для всех обработчиков.
+#
+# Вариантов немного: главное меню (подписан / не подписан) и клавиатура каждого
+# вопроса каждого теста (клавиатуры практик - в готовых сообщениях daily_content).
+# Каждая собирается один раз и дальше переиспользуется (объекты telegram
+# неизменяемы). Кэш сбрасывается сам, когда
+# меняются источники: тексты/ссылки меню в config (importlib.reload(config))
+# или определения тестов (importlib.reload(test_engine)); invalidate() - вручную.
+import logging
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+import daily_content
+import test_engine
+from text_render import escape_markdown_v2
+
+logger = logging.getLogger(__name__)
+
+MENU_CALLBACK_MAIN = daily_content.MENU_CALLBACK_MAIN
+
+_menu_keyboards = {}
+_question_keyboards = {}
+_sources = None
+
+
+def _current_sources():
+    # Для config сравниваются значения (reload меняет атрибуты того же модуля),
+    # для тестов - сам словарь TESTS (reload создаёт новый)
+    return (config.SUBSCRIBE_BUTTON_TEXT, config.MAIN_CHANNEL_BUTTON_TEXT, config.MAIN_CHANNEL_LINK,
+            id(test_engine.TESTS))
+
+
+def _check_sources():
+    global _sources
+    sources = _current_sources()
+    if sources != _sources:
+        if _sources is not None:
+            logger.info("Keyboard sources changed (config/test_engine reloaded), rebuilding keyboards")
+        invalidate()
+        _sources = sources
+
+
+def invalidate():
+    _menu_keyboards.clear()
+    _question_keyboards.clear()
+
+
+def _build_main_menu(subscribed: bool) -> InlineKeyboardMarkup:
+    keyboard = []
+    if subscribed:
+        keyboard.append([InlineKeyboardButton("⏸️ Остановить практики", callback_data="menu_stop_daily")])
+    else:
+        keyboard.append([InlineKeyboardButton(config.SUBSCRIBE_BUTTON_TEXT, callback_data="menu_subscribe_daily")])
+
+    keyboard.append([InlineKeyboardButton(config.MAIN_CHANNEL_BUTTON_TEXT, url=config.MAIN_CHANNEL_LINK)])
+
+    # "Купить консультацию" теперь третья кнопка
+    keyboard.append([InlineKeyboardButton("Купить консультацию", callback_data="post_email_consult_yes_menu")])
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_main_menu_keyboard(user_data: dict = None) -> InlineKeyboardMarkup:
+    _check_sources()
+    subscribed = bool(user_data and user_data.get("subscribed_to_daily"))
+    markup = _menu_keyboards.get(subscribed)
+    if markup is None:
+        markup = _menu_keyboards[subscribed] = _build_main_menu(subscribed)
+    return markup
+
+
+def _build_question_keyboard(test_id: str, question: dict, question_idx: int) -> InlineKeyboardMarkup:
+    keyboard_rows = []
+    for i, option in enumerate(question["options"]):
+        option_text = escape_markdown_v2(option["text"]) # Escape option text as well
+        keyboard_rows.append([InlineKeyboardButton(option_text, callback_data=f"testans_{test_id}_{question_idx}_{i}")])
+    keyboard_rows.append([InlineKeyboardButton("📖 В меню", callback_data=MENU_CALLBACK_MAIN)]) # Add menu button
+    return InlineKeyboardMarkup(keyboard_rows)
+
+
+def get_test_question_keyboard(test_id: str, test_data: dict, question_idx: int) -> InlineKeyboardMarkup:
+    """Варианты ответа на вопрос question_idx теста test_id и кнопка меню."""
+    _check_sources()
+    key = (test_id, question_idx)
+    markup = _question_keyboards.get(key)
+    if markup is None:
+        markup = _build_question_keyboard(test_id, test_data["questions"][question_idx], question_idx)
+        # Кэшируются только определения из test_engine - другой test_data собирается заново
+        if test_engine.TESTS.get(test_id) is test_data:
+            _question_keyboards[key] = markup
+    return markup
+
+
+def prebuild() -> int:
+    """Собирает все клавиатуры меню и вопросов тестов заранее (при старте); возвращает их число."""
+    _check_sources()
+    invalidate()
+    for subscribed in (False, True):
+        get_main_menu_keyboard({"subscribed_to_daily": subscribed})
+    for test_id, test_data in test_engine.TESTS.items():
+        for question_idx in range(len(test_data["questions"])):
+            get_test_question_keyboard(test_id, test_data, question_idx)
+    count = len(_menu_keyboards) + len(_question_keyboards)
+    logger.info(f"Prebuilt {count} keyboards ({len(_question_keyboards)} test questions)")
+    return count
@@ -0,0 +1,137 @@
+# media_registry.py
+# Реестр загруженных в Telegram файлов: локальный файл -> file_id.
+#
+# Картинка (вопросы тестов, QR-код оплаты) загружается в Telegram один раз,
+# возвращённый file_id сохраняется вместе с хэшем содержимого файла, и дальше
+# отправляется только file_id - без чтения файла с диска и повторной загрузки.
+# Если файл изменился (другой хэш), он загружается заново. file_id действует
+# только для бота, который его получил, поэтому ключ - (путь, id бота).
+# Реестр - SQLite-файл, общий для процессов (воркеры доставки видят те же file_id).
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from telegram.error import BadRequest
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaRegistry:
+    """(путь, id бота) -> (sha256 содержимого, file_id).
+
+    Хэш файла пересчитывается только когда меняются его размер или mtime,
+    так что обычная отправка стоит одного os.stat и одного запроса к SQLite.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self._conn = None
+        self._digests = {}
+
+    def _connection(self):
+        with self.lock:
+            if self._conn is None:
+                # timeout - ожидание блокировки файла другим процессом
+                self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS media (
+                        path TEXT NOT NULL,
+                        bot_id INTEGER NOT NULL,
+                        sha256 TEXT NOT NULL,
+                        file_id TEXT NOT NULL,
+                        uploaded_at REAL NOT NULL,
+                        PRIMARY KEY (path, bot_id)
+                    ) WITHOUT ROWID
+                """)
+            return self._conn
+
+    def digest(self, path: str) -> str:
+        """Хэш содержимого; FileNotFoundError, если файла нет."""
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self._digests.get(path)
+            if cached and cached[0] == key:
+                return cached[1]
+        digest = file_digest(path)
+        with self.lock:
+            self._digests[path] = (key, digest)
+        return digest
+
+    def lookup(self, path: str, bot_id: int):
+        """(хэш, file_id) - file_id None, если файл ещё не загружался или изменился."""
+        digest = self.digest(path)
+        with self.lock:
+            row = self._connection().execute(
+                "SELECT sha256, file_id FROM media WHERE path = ? AND bot_id = ?", (path, bot_id)
+            ).fetchone()
+        if row and row[0] == digest:
+            return digest, row[1]
+        return digest, None
+
+    def remember(self, path: str, bot_id: int, digest: str, file_id: str):
+        with self.lock:
+            self._connection().execute(
+                "INSERT INTO media (path, bot_id, sha256, file_id, uploaded_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path, bot_id) DO UPDATE SET sha256 = excluded.sha256, "
+                "file_id = excluded.file_id, uploaded_at = excluded.uploaded_at",
+                (path, bot_id, digest, file_id, time.time()),
+            )
+
+    def forget(self, path: str, bot_id: int):
+        with self.lock:
+            self._connection().execute("DELETE FROM media WHERE path = ? AND bot_id = ?", (path, bot_id))
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_registry = None
+
+
+def get_registry() -> MediaRegistry:
+    global _registry
+    if _registry is None:
+        _registry = MediaRegistry(config.MEDIA_REGISTRY_DB_FILE)
+    return _registry
+
+
+async def send_photo(bot, chat_id: int, path: str, **kwargs):
+    """bot.send_photo по file_id из реестра; при первой отправке (или если файл изменился) -
+    загрузка файла и запись полученного file_id. FileNotFoundError, если файла нет."""
+    registry = get_registry()
+    digest, file_id = await asyncio.to_thread(registry.lookup, path, bot.id)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            # file_id больше не принимается (например, файл удалён на стороне Telegram) - загружаем заново
+            if "file" not in str(e).lower():
+                raise
+            logger.warning(f"Cached file_id for {path} was rejected ({e}), uploading the file again")
+            await asyncio.to_thread(registry.forget, path, bot.id)
+    with open(path, 'rb') as photo:
+        message = await bot.send_photo(chat_id, photo=photo, **kwargs)
+    if message and message.photo:
+        await asyncio.to_thread(registry.remember, path, bot.id, digest, message.photo[-1].file_id)
+        logger.info(f"Uploaded {path} to Telegram, file_id cached")
+    return message
@@ -0,0 +1,305 @@
+# practice_scheduler.py
+# Расписание ежедневных практик по минутам UTC.
+#
+# Время практики у каждого подписчика своё (часовой пояс и локальное время,
+# см. practice_times). Хранилище держит индекс "минута UTC -> подписчики"
+# (минутные корзины), который обновляется вместе с записью пользователя.
+# Один тикер раз в минуту забирает корзины наступившей минуты и запускает
+# по ним рассылку, поэтому число таймеров и стоимость старта не зависят ни
+# от числа подписчиков, ни от числа различных времён.
+#
+# Модуль не импортирует telegram: bot.py передаёт сюда функцию доставки.
+import asyncio
+import collections
+import datetime
+import functools
+import logging
+import zlib
+
+import config
+import daily_content
+import schedule_store
+import user_data_manager as udm
+from practice_times import MODES_BY_PART, PRACTICE_PARTS, minute_to_str  # noqa: F401 (реэкспорт)
+
+logger = logging.getLogger(__name__)
+
+# Сколько отправок слота идёт одновременно
+SLOT_DELIVERY_CONCURRENCY = 20
+
+# Имя записи тикера в schedule_store: до какой минуты расписание отработано
+TICK_STATE_NAME = "practice_tick"
+
+PoolReport = collections.namedtuple("PoolReport", "total sent skipped")
+
+# Результат доставки одной практики: sent - сообщение действительно ушло,
+# completed_day - день цикла, который эта практика завершила у получателя (иначе None)
+PracticeDelivery = collections.namedtuple("PracticeDelivery", "sent completed_day")
+PRACTICE_SKIPPED = PracticeDelivery(False, None)
+
+# Префикс суточных счётчиков schedule_store для отписанных недоступных: pruned_<причина>
+PRUNED_COUNT_PREFIX = "pruned_"
+
+
+class Shard(collections.namedtuple("Shard", "index count")):
+    """Доля подписчиков одного процесса-воркера доставки (см. delivery_worker)."""
+    __slots__ = ()
+
+    def owns(self, chat_id: int) -> bool:
+        return shard_of(chat_id, self.count) == self.index
+
+    def __str__(self):
+        return f"{self.index + 1}/{self.count}"
+
+
+def shard_of(chat_id: int, count: int) -> int:
+    # Не crc32(chat_id) как у delivery_offset - иначе доли и смещения в окне были бы связаны
+    return zlib.crc32(f"shard:{chat_id}".encode()) % count
+
+
+def filter_shard(chat_ids, shard: Shard = None):
+    return chat_ids if shard is None else [chat_id for chat_id in chat_ids if shard.owns(chat_id)]
+
+
+def tick_state_name(shard: Shard = None) -> str:
+    """Запись тикера в schedule_store: у каждого воркера своя."""
+    return TICK_STATE_NAME if shard is None else f"{TICK_STATE_NAME}_{shard.index}of{shard.count}"
+
+
+def part_window_seconds(part: str) -> int:
+    return int(getattr(config, f"{part.upper()}_DELIVERY_WINDOW_MINUTES", 0) * 60)
+
+
+class PracticeSlot:
+    """Одна часть дня в одну минуту суток UTC (минутная корзина индекса).
+
+    window_seconds - окно доставки: отправка растянута на [минута, минута + window).
+    """
+    __slots__ = ("part", "minute", "window_seconds")
+
+    def __init__(self, part: str, minute: int, window_seconds: int = None):
+        self.part = part
+        self.minute = minute
+        self.window_seconds = window_seconds if window_seconds is not None else part_window_seconds(part)
+
+    @property
+    def time(self) -> datetime.time:
+        return datetime.time(hour=self.minute // 60, minute=self.minute % 60)
+
+    @property
+    def name(self) -> str:
+        return f"practice_slot_{self.part}_{self.time.strftime('%H%M')}"
+
+    def __repr__(self):
+        window = f", window {self.window_seconds // 60} min" if self.window_seconds else ""
+        return f"PracticeSlot({self.part} {minute_to_str(self.minute)} UTC{window})"
+
+
+def minute_of_day(moment: datetime.datetime) -> int:
+    moment = moment.astimezone(datetime.timezone.utc)
+    return moment.hour * 60 + moment.minute
+
+
+def due_chat_ids(slot: PracticeSlot):
+    """chat_id подписчиков из минутной корзины слота."""
+    return sorted(udm.get_chat_ids_by_minute(slot.part, slot.minute))
+
+
+async def adue_chat_ids(slot: PracticeSlot):
+    return sorted(await udm.aget_chat_ids_by_minute(slot.part, slot.minute))
+
+
+async def aslots_at(minute: int, shard: Shard = None):
+    """[(слот, chat_ids)] непустых корзин минуты minute - то, что тикер отправляет в эту минуту.
+
+    shard - только подписчики этого воркера.
+    """
+    result = []
+    for part in PRACTICE_PARTS:
+        slot = PracticeSlot(part, minute)
+        chat_ids = filter_shard(await adue_chat_ids(slot), shard)
+        if chat_ids:
+            result.append((slot, chat_ids))
+    return result
+
+
+def _plan(buckets: dict):
+    return sorted(
+        ((PracticeSlot(part, minute), count) for part, minutes in buckets.items() for minute, count in minutes.items()),
+        key=lambda item: (item[0].minute, item[0].part),
+    )
+
+
+def plan_slots():
+    """[(слот, число получателей)] по всем непустым корзинам - для лога при старте."""
+    return _plan(udm.get_schedule_buckets())
+
+
+async def aplan_slots():
+    return _plan(await udm.aget_schedule_buckets())
+
+
+def format_plan(plan, limit: int = 10) -> str:
+    text = "; ".join(f"{slot.part} {minute_to_str(slot.minute)} UTC -> {count}" for slot, count in plan[:limit])
+    if len(plan) > limit:
+        text += f"; ... and {len(plan) - limit} more"
+    return text
+
+
+def delivery_offset(chat_id: int, window_seconds: int) -> int:
+    """Смещение пользователя внутри окна доставки: детерминированно по chat_id,
+    поэтому каждый получает практику в одно и то же время изо дня в день."""
+    if window_seconds <= 0:
+        return 0
+    return zlib.crc32(str(chat_id).encode()) % window_seconds
+
+
+def window_offsets(chat_ids, window_seconds: int) -> dict:
+    return {chat_id: delivery_offset(chat_id, window_seconds) for chat_id in chat_ids} if window_seconds > 0 else {}
+
+
+def spread_offsets(chat_ids, spread_seconds: float) -> dict:
+    """Равномерно по порядку списка - для догонялки после простоя."""
+    if spread_seconds <= 0 or not chat_ids:
+        return {}
+    step = spread_seconds / len(chat_ids)
+    return {chat_id: i * step for i, chat_id in enumerate(chat_ids)}
+
+
+async def _run_pool(chat_ids, deliver_one, label: str = "slot", offsets: dict = None,
+                    concurrency: int = SLOT_DELIVERY_CONCURRENCY):
+    """Простой пул воркеров без лимитов и повторов (если движок доставки не передан)."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    offsets = offsets or {}
+    pending = iter(sorted(chat_ids, key=lambda chat_id: offsets.get(chat_id, 0)))
+    delivered = skipped = 0
+
+    async def _worker():
+        nonlocal delivered, skipped
+        for chat_id in pending:
+            delay = started + offsets.get(chat_id, 0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                if await deliver_one(chat_id) is False:
+                    skipped += 1
+                else:
+                    delivered += 1
+            except Exception as e:
+                logger.error(f"Slot {label}: delivery to {chat_id} failed: {e}", exc_info=True)
+
+    await asyncio.gather(*(_worker() for _ in range(min(concurrency, len(chat_ids)))))
+    return PoolReport(len(chat_ids), delivered, skipped)
+
+
+async def run_slot(slot: PracticeSlot, deliver, runner=None, concurrency: int = SLOT_DELIVERY_CONCURRENCY,
+                   spread_seconds: float = 0, chat_ids=None):
+    """Отправляет слот всем получателям: deliver(chat_id, part) -> PracticeDelivery.
+
+    В отчёт идут только действительно отправленные сообщения (sent), пропуски считаются отдельно.
+    Получатели, у которых доставленная практика завершила день цикла (completed_day),
+    после рассылки переводятся на следующий день одной пачкой.
+
+    chat_ids - получатели, если уже известны (иначе берутся из корзины слота).
+    runner(chat_ids, deliver_one, label=..., offsets=...) - движок доставки (delivery.DeliveryEngine.run);
+    без него используется простой пул из concurrency воркеров без лимитов и повторов.
+    Каждый получатель обслуживается в своё смещение внутри окна слота;
+    spread_seconds > 0 вместо этого равномерно растягивает отправку (догонялка после простоя).
+    Недоступные получатели (report.permanent движка доставки) отписываются одной пачкой.
+    Возвращает отчёт runner'а - ошибка одной отправки не останавливает остальные.
+    """
+    if chat_ids is None:
+        chat_ids = await adue_chat_ids(slot)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    if spread_seconds:
+        offsets = spread_offsets(chat_ids, spread_seconds)
+        pacing = f", spread over {spread_seconds / 60:.0f} min"
+    else:
+        offsets = window_offsets(chat_ids, slot.window_seconds)
+        pacing = f", window {slot.window_seconds / 60:.0f} min" if offsets else ""
+    logger.info(f"{slot}: {len(chat_ids)} recipients{pacing}")
+    if runner is None:
+        runner = functools.partial(_run_pool, concurrency=concurrency)
+    completed_days = {}
+
+    async def _deliver_one(chat_id):
+        result = await deliver(chat_id, slot.part)
+        if result.completed_day is not None:
+            completed_days[chat_id] = result.completed_day
+        return result.sent
+
+    report = await runner(chat_ids, _deliver_one, label=slot.name, offsets=offsets)
+    logger.info(f"{slot}: done {report.sent}/{len(chat_ids)}, skipped {report.skipped} in {loop.time() - started:.1f}s")
+    if completed_days:
+        await udm.aadvance_daily_days(completed_days, daily_content.TOTAL_DAYS)
+    permanent = getattr(report, "permanent", None)
+    if permanent:
+        await aprune_unreachable(permanent)
+    return report
+
+
+async def aprune_unreachable(reasons: dict):
+    """Отписывает недоступных {chat_id: причина} одной транзакцией и считает их за сутки."""
+    pruned = await udm.aunsubscribe_unreachable(reasons)
+    counts = collections.Counter(reasons.values())
+    store = schedule_store.get_store()
+    for reason, count in counts.items():
+        await asyncio.to_thread(store.add_daily_count, f"{PRUNED_COUNT_PREFIX}{reason}", count)
+    return pruned
+
+
+def pruned_today() -> dict:
+    """{причина: сколько недоступных отписано за сегодня (UTC)} - по всем процессам."""
+    counts = schedule_store.get_store().daily_counts(prefix=PRUNED_COUNT_PREFIX)
+    return {name[len(PRUNED_COUNT_PREFIX):]: value for name, value in counts.items()}
+
+
+# --- минутный тикер и состояние между перезапусками ---
+
+def floor_minute(moment: datetime.datetime) -> datetime.datetime:
+    return moment.astimezone(datetime.timezone.utc).replace(second=0, microsecond=0)
+
+
+def minutes_between(last_completed, until: datetime.datetime):
+    """Минуты (last_completed, until] - только в пределах суток UTC, к которым относится until.
+
+    Вчерашняя практика, отправленная сегодня, отметилась бы как сегодняшняя,
+    а индекс уже посчитан на сегодняшнюю дату, поэтому вчерашние минуты не догоняются.
+    """
+    until = floor_minute(until)
+    day_start = until.replace(hour=0, minute=0)
+    first = floor_minute(last_completed) + datetime.timedelta(minutes=1) if last_completed else until
+    if first < day_start:
+        logger.info(f"Schedule minutes from {first.isoformat()} to {day_start.isoformat()} are too old to catch up")
+        first = day_start
+    count = int((until - first).total_seconds() // 60) + 1
+    return [first + datetime.timedelta(minutes=i) for i in range(max(0, count))]
+
+
+def find_missed(store, now: datetime.datetime, name: str = TICK_STATE_NAME):
+    """Минуты, пропущенные пока бот был выключен (до текущей минуты, не включая её).
+
+    Отмечает их в store как пройденные: дальше тикер работает с текущей минуты,
+    а что делать с пропущенным, решает вызывающий (CATCHUP_*).
+    """
+    state = store.get(name)
+    previous = floor_minute(now) - datetime.timedelta(minutes=1)
+    last_completed = state["last_completed"] if state else None
+    missed = minutes_between(last_completed, previous) if last_completed and last_completed < previous else []
+    store.mark_completed(name, previous, previous + datetime.timedelta(minutes=1))
+    return missed
+
+
+async def amissed_slots(minutes, shard: Shard = None):
+    """[(слот, chat_ids)] непустых корзин среди пропущенных минут - одним запросом к индексу."""
+    wanted = {minute_of_day(minute) for minute in minutes}
+    buckets = await udm.aget_schedule_buckets()
+    result = []
+    for slot, _ in _plan(buckets):
+        if slot.minute in wanted:
+            chat_ids = filter_shard(await adue_chat_ids(slot), shard)
+            if chat_ids:
+                result.append((slot, chat_ids))
+    return result
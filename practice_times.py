@@ -0,0 +1,135 @@
+# practice_times.py
+# Время отправки практик для конкретного пользователя.
+#
+# У пользователя могут быть свой часовой пояс (timezone, имя из базы IANA) и
+# своё локальное время утренней/вечерней практики (morning_time/evening_time, "HH:MM").
+# Не заданное берётся из config: DEFAULT_USER_TIMEZONE и *_PRACTICE_TIME_MSK_STR.
+#
+# Результат - минута суток по UTC (0..1439) для каждой части дня. По ней
+# user_storage.UserIndex раскладывает подписчиков по минутным корзинам,
+# а минутный тикер забирает корзину текущей минуты. Перевод в UTC делается
+# на конкретную дату, поэтому переходы на летнее время учитываются
+# (индекс пересчитывается раз в сутки).
+import datetime
+import functools
+import logging
+
+import pytz
+
+import config
+
+logger = logging.getLogger(__name__)
+
+PRACTICE_PARTS = ("morning", "evening")
+
+# Какие режимы daily_practice_mode получают какую часть дня
+MODES_BY_PART = {
+    "morning": ("both", "morning_only"),
+    "evening": ("both", "dual"),
+}
+
+# Особое время (UTC) для дней цикла - только для тех, кто не задал своё время
+SPECIAL_DAY_TIMES_UTC = {
+    "morning": {3: "DAY3_KEY_TEST_OFFER_MORNING_UTC"},
+    "evening": {3: "DAY3_KEY_TEST_OFFER_EVENING_UTC"},
+}
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_hhmm(value: str) -> datetime.time:
+    """'HH:MM' -> datetime.time; ValueError при неверном формате."""
+    hour, minute = map(int, value.strip().split(':'))
+    return datetime.time(hour=hour, minute=minute)
+
+
+def validate_timezone(name: str) -> str:
+    """Каноничное имя часового пояса; ValueError, если такого нет."""
+    try:
+        return pytz.timezone(name).zone
+    except pytz.UnknownTimeZoneError:
+        raise ValueError(f"Unknown timezone: {name}")
+
+
+def default_local_time(part: str) -> str:
+    return config.MORNING_PRACTICE_TIME_MSK_STR if part == "morning" else config.EVENING_PRACTICE_TIME_MSK_STR
+
+
+def utc_today() -> datetime.date:
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+def minute_to_str(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+@functools.lru_cache(maxsize=4096)
+def local_to_utc_minute(local_hhmm: str, tz_name: str, on_date: datetime.date) -> int:
+    """Локальное 'HH:MM' в поясе tz_name на дату on_date -> минута суток UTC."""
+    local_time = parse_hhmm(local_hhmm)
+    tz = pytz.timezone(tz_name)
+    moment = tz.localize(datetime.datetime.combine(on_date, local_time)).astimezone(pytz.utc)
+    return moment.hour * 60 + moment.minute
+
+
+@functools.lru_cache(maxsize=64)
+def _utc_time_minute(value) -> int:
+    if isinstance(value, str):
+        value = parse_hhmm(value)
+    if value.tzinfo is not None:
+        offset = value.utcoffset() or datetime.timedelta(0)
+        minutes = value.hour * 60 + value.minute - int(offset.total_seconds() // 60)
+        return minutes % MINUTES_PER_DAY
+    return value.hour * 60 + value.minute
+
+
+def special_days() -> frozenset:
+    """Дни цикла, у которых может быть своё время отправки."""
+    return frozenset(day for days in SPECIAL_DAY_TIMES_UTC.values() for day in days)
+
+
+def _special_minute(part: str, day) -> int:
+    attr = SPECIAL_DAY_TIMES_UTC[part].get(day)
+    value = getattr(config, attr, None) if attr else None
+    if value is None:
+        return None
+    try:
+        return _utc_time_minute(value)
+    except (ValueError, AttributeError) as e:
+        logger.error(f"Bad {attr} in config: {e}. Using the regular time.")
+        return None
+
+
+def user_minutes(record, on_date: datetime.date = None) -> dict:
+    """{часть дня: минута UTC} для подписчика; {} если он ничего не получает.
+
+    record - словарь или UserRecord (нужен только .get).
+    """
+    mode = record.get("daily_practice_mode")
+    if not record.get("subscribed_to_daily"):
+        return {}
+    on_date = on_date or utc_today()
+    tz_name = record.get("timezone")
+    if tz_name:
+        try:
+            tz_name = validate_timezone(tz_name)
+        except ValueError:
+            logger.warning(f"User {record.get('chat_id')} has unknown timezone '{tz_name}', using default.")
+            tz_name = None
+    minutes = {}
+    for part in PRACTICE_PARTS:
+        if mode not in MODES_BY_PART[part]:
+            continue
+        personal_time = record.get(f"{part}_time")
+        if not personal_time and not tz_name:
+            special = _special_minute(part, record.get("current_daily_day"))
+            if special is not None:
+                minutes[part] = special
+                continue
+        try:
+            minutes[part] = local_to_utc_minute(personal_time or default_local_time(part),
+                                                tz_name or config.DEFAULT_USER_TIMEZONE, on_date)
+        except ValueError as e:
+            logger.warning(f"User {record.get('chat_id')} has bad {part}_time '{personal_time}': {e}. Using default.")
+            minutes[part] = local_to_utc_minute(default_local_time(part), tz_name or config.DEFAULT_USER_TIMEZONE, on_date)
+    return minutes
@@ -14,14 +14,21 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 async def main():
+    workers = []
     try:
         logger.info("=== Запуск бота ===")
         import bot
+        import delivery_worker
         logger.info("=== Импортирован модуль bot ===")
-        await bot.main()
+        # Воркеры рассылки практик (config.DELIVERY_WORKERS); без них рассылает сам процесс бота
+        workers = delivery_worker.start_workers()
+        await bot.main(deliver_practices=not workers)
         logger.info("=== Бот запущен успешно ===")
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}", exc_info=True)
+    finally:
+        if workers:
+            delivery_worker.stop_workers(workers)
 
 if __name__ == '__main__':
     asyncio.run(main())
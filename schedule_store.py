@@ -0,0 +1,123 @@
+# schedule_store.py
+# Состояние расписания слотов практик в SQLite: когда слот последний раз
+# отработал и когда должен сработать следующий раз. Переживает перезапуск бота,
+# поэтому при старте видно, какие слоты были пропущены, пока бот лежал.
+# Здесь же суточные счётчики рассылки (например, сколько недоступных отписано за день UTC).
+import datetime
+import logging
+import sqlite3
+import threading
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Что делать со слотом, который должен был сработать, пока бот был выключен
+CATCHUP_LATE = "late"      # отправить сразу после старта
+CATCHUP_SKIP = "skip"      # пропустить до следующего срабатывания
+CATCHUP_SPREAD = "spread"  # отправить, растянув на PRACTICE_CATCHUP_SPREAD_MINUTES
+CATCHUP_POLICIES = (CATCHUP_LATE, CATCHUP_SKIP, CATCHUP_SPREAD)
+
+
+def _to_iso(moment: datetime.datetime):
+    return moment.astimezone(datetime.timezone.utc).isoformat() if moment else None
+
+
+def _from_iso(value: str):
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+class ScheduleStore:
+    """Одна строка на слот: slot_name, last_completed, next_fire (ISO, UTC).
+
+    Соединение открывается при первом обращении.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self._conn = None
+
+    def _connection(self):
+        with self.lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS slot_state (
+                        slot_name TEXT PRIMARY KEY,
+                        last_completed TEXT,
+                        next_fire TEXT
+                    )
+                """)
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS daily_counts (
+                        day TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        value INTEGER NOT NULL,
+                        PRIMARY KEY (day, name)
+                    )
+                """)
+            return self._conn
+
+    def get(self, slot_name: str):
+        """{"last_completed": datetime|None, "next_fire": datetime|None} или None, если слота ещё не было."""
+        with self.lock:
+            row = self._connection().execute(
+                "SELECT last_completed, next_fire FROM slot_state WHERE slot_name = ?", (slot_name,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"last_completed": _from_iso(row[0]), "next_fire": _from_iso(row[1])}
+
+    def set_next_fire(self, slot_name: str, next_fire: datetime.datetime):
+        with self.lock:
+            self._connection().execute(
+                "INSERT INTO slot_state (slot_name, next_fire) VALUES (?, ?) "
+                "ON CONFLICT(slot_name) DO UPDATE SET next_fire = excluded.next_fire",
+                (slot_name, _to_iso(next_fire)),
+            )
+
+    def mark_completed(self, slot_name: str, occurrence: datetime.datetime, next_fire: datetime.datetime):
+        with self.lock:
+            self._connection().execute(
+                "INSERT INTO slot_state (slot_name, last_completed, next_fire) VALUES (?, ?, ?) "
+                "ON CONFLICT(slot_name) DO UPDATE SET last_completed = excluded.last_completed, "
+                "next_fire = excluded.next_fire",
+                (slot_name, _to_iso(occurrence), _to_iso(next_fire)),
+            )
+
+    def add_daily_count(self, name: str, amount: int = 1, day: str = None):
+        day = day or datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+        with self.lock:
+            self._connection().execute(
+                "INSERT INTO daily_counts (day, name, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value",
+                (day, name, amount),
+            )
+
+    def daily_counts(self, day: str = None, prefix: str = "") -> dict:
+        """{name: value} за сутки UTC (по умолчанию - сегодня), только имена с prefix."""
+        day = day or datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+        with self.lock:
+            rows = self._connection().execute(
+                "SELECT name, value FROM daily_counts WHERE day = ? AND name >= ? AND name < ? ORDER BY name",
+                (day, prefix, prefix + "\U0010ffff"),
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_store = None
+
+
+def get_store() -> ScheduleStore:
+    global _store
+    if _store is None:
+        _store = ScheduleStore(config.SCHEDULE_DB_FILE)
+    return _store
@@ -0,0 +1,150 @@
+# send_ledger.py
+# Журнал отправок практик: защита от повторной отправки одной и той же практики.
+#
+# Запись (дата UTC, часть дня, chat_id) сначала захватывается (claim), потом
+# идёт отправка, после успеха запись подтверждается (confirm), при ошибке -
+# освобождается (release), чтобы повтор мог её захватить снова. Захват -
+# атомарная вставка в SQLite, поэтому одну практику не отправят ни две
+# перекрывающиеся рассылки, ни несколько процессов-воркеров с общим файлом.
+# Захват, брошенный упавшим воркером, перехватывается через SEND_CLAIM_TIMEOUT_SECONDS.
+import datetime
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CLAIMED = 1
+SENT = 2
+
+
+def utc_today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+
+class SendLedger:
+    """Одна строка на (дату, часть дня, chat_id) - не больше двух строк на пользователя в сутки.
+
+    Строки старше retention_days удаляются при первом захвате в новые сутки.
+    """
+
+    def __init__(self, path: str, claim_timeout: float = 600, retention_days: int = 3):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self.retention_days = retention_days
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.lock = threading.RLock()
+        self._conn = None
+        self._pruned_for = None
+
+    def _connection(self):
+        with self.lock:
+            if self._conn is None:
+                # timeout - ожидание блокировки файла другим процессом
+                self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS send_ledger (
+                        send_date TEXT NOT NULL,
+                        part TEXT NOT NULL,
+                        chat_id INTEGER NOT NULL,
+                        cycle_day INTEGER,
+                        state INTEGER NOT NULL,
+                        claimed_at REAL NOT NULL,
+                        owner TEXT,
+                        PRIMARY KEY (send_date, part, chat_id)
+                    ) WITHOUT ROWID
+                """)
+            return self._conn
+
+    def _prune(self, send_date: str):
+        if self._pruned_for == send_date:
+            return
+        self._pruned_for = send_date
+        oldest = (datetime.date.fromisoformat(send_date) - datetime.timedelta(days=self.retention_days)).isoformat()
+        deleted = self._connection().execute("DELETE FROM send_ledger WHERE send_date < ?", (oldest,)).rowcount
+        if deleted:
+            logger.info(f"Send ledger: pruned {deleted} entries older than {oldest}")
+
+    def claim(self, chat_id: int, part: str, cycle_day: int = None, send_date: str = None) -> bool:
+        """True - отправлять можно (запись захвачена этим процессом), False - уже отправлено или отправляется."""
+        send_date = send_date or utc_today()
+        now = time.time()
+        with self.lock:
+            self._prune(send_date)
+            conn = self._connection()
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO send_ledger (send_date, part, chat_id, cycle_day, state, claimed_at, owner) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (send_date, part, chat_id, cycle_day, CLAIMED, now, self.owner),
+            ).rowcount
+            if inserted:
+                return True
+            # Захват, который так и не подтвердили (воркер упал посреди отправки)
+            taken_over = conn.execute(
+                "UPDATE send_ledger SET cycle_day = ?, claimed_at = ?, owner = ? "
+                "WHERE send_date = ? AND part = ? AND chat_id = ? AND state = ? AND claimed_at < ?",
+                (cycle_day, now, self.owner, send_date, part, chat_id, CLAIMED, now - self.claim_timeout),
+            ).rowcount
+        if taken_over:
+            logger.warning(f"Send ledger: took over stale claim for {chat_id} {part} {send_date}")
+        return bool(taken_over)
+
+    def confirm(self, chat_id: int, part: str, send_date: str = None):
+        with self.lock:
+            self._connection().execute(
+                "UPDATE send_ledger SET state = ?, claimed_at = ? WHERE send_date = ? AND part = ? AND chat_id = ?",
+                (SENT, time.time(), send_date or utc_today(), part, chat_id),
+            )
+
+    def release(self, chat_id: int, part: str, send_date: str = None, sent: bool = False):
+        """Снять незавершённый захват (отправка не удалась); sent=True снимает и подтверждённую отправку."""
+        query = "DELETE FROM send_ledger WHERE send_date = ? AND part = ? AND chat_id = ?"
+        params = (send_date or utc_today(), part, chat_id)
+        if not sent:
+            query += " AND state = ?"
+            params += (CLAIMED,)
+        with self.lock:
+            self._connection().execute(query, params)
+
+    def state(self, chat_id: int, part: str, send_date: str = None):
+        """CLAIMED, SENT или None."""
+        with self.lock:
+            row = self._connection().execute(
+                "SELECT state FROM send_ledger WHERE send_date = ? AND part = ? AND chat_id = ?",
+                (send_date or utc_today(), part, chat_id),
+            ).fetchone()
+        return row[0] if row else None
+
+    def stats(self, send_date: str = None) -> dict:
+        """{part: {"sent": n, "claimed": n}} за сутки."""
+        with self.lock:
+            rows = self._connection().execute(
+                "SELECT part, state, COUNT(*) FROM send_ledger WHERE send_date = ? GROUP BY part, state",
+                (send_date or utc_today(),),
+            ).fetchall()
+        result = {}
+        for part, state, count in rows:
+            result.setdefault(part, {"sent": 0, "claimed": 0})["sent" if state == SENT else "claimed"] = count
+        return result
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_ledger = None
+
+
+def get_ledger() -> SendLedger:
+    global _ledger
+    if _ledger is None:
+        _ledger = SendLedger(config.SEND_LEDGER_DB_FILE, claim_timeout=config.SEND_CLAIM_TIMEOUT_SECONDS)
+    return _ledger
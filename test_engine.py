@@ -1,4 +1,5 @@
 # test_engine.py
+import collections
 import logging
 
 logger = logging.getLogger(__name__)
@@ -369,11 +370,8 @@ TESTS = {
 }
 
 def get_test_by_id(test_id):
-    logger.info(f"Attempting to get test by ID: {test_id}")
     test = TESTS.get(test_id)
-    if test:
-        logger.info(f"Test '{test_id}' found.")
-    else:
+    if not test:
         logger.warning(f"Test '{test_id}' not found in TESTS.")
     return test
 
@@ -381,74 +379,151 @@ def get_all_tests_info():
     return [{"id": test_id, "name": data["name"], "description": data.get("description", "")}
             for test_id, data in TESTS.items()]
 
+
+# --- Таблицы результатов ---
+# При загрузке модуля результаты каждого теста компилируются в плотный массив по баллам:
+# элемент [score - min_score] хранит уже собранные тексты результата (с подставленным
+# score), разрезанные по месту ответов пользователя. Поиск результата - один индекс
+# в массиве и одна склейка с ответами. Диапазоны проверяются заранее: пересечения и
+# дыры между ними - ошибка в определении теста (ValueError при импорте).
+
+RESULT_NOT_FOUND_TEXT = "Результат не найден."
+CONSULT_FOCUS_NOT_FOUND_TEXT = "Информация для консультации не найдена."
+FULL_HTML_NOT_FOUND_TEXT = "<p>Полные результаты не найдены.</p>"
+
+# summary_parts / html_parts - куски текста, между которыми вставляются ответы пользователя
+ResultEntry = collections.namedtuple("ResultEntry", "summary_parts consultation_focus html_parts")
+
+
+class ResultTable:
+    """Результаты теста по баллам: entries[score - min_score]."""
+    __slots__ = ("min_score", "entries")
+
+    def __init__(self, min_score: int, entries: tuple):
+        self.min_score = min_score
+        self.entries = entries
+
+    @property
+    def max_score(self) -> int:
+        return self.min_score + len(self.entries) - 1
+
+    def lookup(self, score):
+        index = score - self.min_score
+        if isinstance(index, int) and 0 <= index < len(self.entries):
+            return self.entries[index]
+        return None
+
+
+def _validate_ranges(test_id: str, ranges):
+    """ranges - [(ключ, low, high)]; ValueError при неверном диапазоне, пересечении или дыре."""
+    previous = None
+    for key, low, high in sorted(ranges, key=lambda item: item[1]):
+        if not (isinstance(low, int) and isinstance(high, int)) or low > high:
+            raise ValueError(f"Test '{test_id}': bad score range {low}..{high} for result '{key}'")
+        if previous is not None:
+            prev_key, _, prev_high = previous
+            if low <= prev_high:
+                raise ValueError(f"Test '{test_id}': results '{prev_key}' and '{key}' overlap at score {low}")
+            if low > prev_high + 1:
+                raise ValueError(f"Test '{test_id}': no result for scores {prev_high + 1}..{low - 1} "
+                                 f"(between '{prev_key}' and '{key}')")
+        previous = (key, low, high)
+
+
+def _list_result_entry(res_info: dict, score: int) -> ResultEntry:
+    summary_template = res_info.get("summary_template", "Результат: {score} баллов.")
+    full_html_template = res_info.get("full_html_result_template", "<p>Результат: {score} баллов.</p>{user_answers_html}")
+    return ResultEntry(
+        tuple(part.replace("{score}", str(score)) for part in summary_template.split("{user_answers}")),
+        res_info.get("consultation_focus", "Обсудите ваши результаты с специалистом."),
+        tuple(part.replace("{score}", str(score)) for part in full_html_template.split("{user_answers_html}")),
+    )
+
+
+def _dict_result_entry(test_data: dict, result_key: str, res_info: dict, score: int) -> ResultEntry:
+    result_title = res_info.get("title", f"Результат: {result_key}")
+    result_desc = res_info.get("description", "")
+    result_freq = res_info.get("frequency", "")
+    result_rec = res_info.get("recommendations", res_info.get("recommendation", ""))
+
+    # Текст результата для Telegram
+    # Без специальных символов для MarkdownV2, которые будут экранированы в bot.py
+    summary = f"{result_title}\n\n{result_desc}\n\nРекомендуемая частота: {result_freq}\n\nРекомендации: {result_rec}\n\n📝 Ваш результат: {score} баллов"
+
+    # Фокус для консультации - из отдельного поля теста, если оно есть
+    if "consultation_focus" in test_data and result_key in test_data["consultation_focus"]:
+        consult_focus = test_data["consultation_focus"][result_key]
+    else:
+        consult_focus = res_info.get("consultation_focus", "Обсудите ваши результаты с специалистом.")
+
+    # HTML для email
+    full_html = f"<h2>{result_title}</h2><p>{result_desc}</p><p><strong>Рекомендуемая частота:</strong> {result_freq}</p><p><strong>Рекомендации:</strong> {result_rec}</p><p><strong>Ваш результат:</strong> {score} баллов</p>"
+    return ResultEntry((summary, ""), consult_focus, (full_html, ""))
+
+
+def compile_results(test_id: str, test_data: dict):
+    """ResultTable теста или None, если результатов у теста нет (выбор пола)."""
+    results = test_data.get("results")
+    if not results:
+        return None
+    # Два формата результатов: список (новые тесты) и словарь по ключам (constitution tests)
+    if isinstance(results, list):
+        items = [(str(i), res_info) for i, res_info in enumerate(results)]
+    else:
+        items = list(results.items())
+    ranges = [(key, *res_info["range"]) for key, res_info in items]
+    _validate_ranges(test_id, ranges)
+    min_score = min(low for _, low, _ in ranges)
+    max_score = max(high for _, _, high in ranges)
+    entries = [None] * (max_score - min_score + 1)
+    for (result_key, res_info), (_, low, high) in zip(items, ranges):
+        for score in range(low, high + 1):
+            if isinstance(results, list):
+                entries[score - min_score] = _list_result_entry(res_info, score)
+            else:
+                entries[score - min_score] = _dict_result_entry(test_data, result_key, res_info, score)
+    return ResultTable(min_score, tuple(entries))
+
+
+RESULT_TABLES = {test_id: compile_results(test_id, test_data) for test_id, test_data in TESTS.items()}
+
+
+def _format_user_answers(test_data: dict, user_answers_indices):
+    """(текст для Telegram, HTML для email) с ответами пользователя."""
+    # Строка с ответами пользователя для Telegram (без спецсимволов Markdown)
+    user_answers_str = "\n\n📝 Ваши ответы:\n"
+    for i, ans_idx in enumerate(user_answers_indices):
+        q_text = test_data["questions"][i]["text"].split('\n')[0] # Краткий вопрос
+        a_text = test_data["questions"][i]["options"][ans_idx]["text"]
+        user_answers_str += f"{i+1}. {q_text}\n   Ответ: {a_text}\n" # Без спецсимволов Markdown
+
+    # HTML строка с ответами пользователя для email
+    user_answers_html_str = "<h3>Ваши ответы:</h3><ul>"
+    for i, ans_idx in enumerate(user_answers_indices):
+        q_text = test_data["questions"][i]["text"] # Полный вопрос для email
+        a_text = test_data["questions"][i]["options"][ans_idx]["text"]
+        user_answers_html_str += f"<li><strong>{q_text}</strong><br>Ответ: <em>{a_text}</em></li>"
+    user_answers_html_str += "</ul>"
+    return user_answers_str, user_answers_html_str
+
 def get_test_result(test_id, score, user_answers_indices=None):
-    logger.info(f"Calculating test result for test_id: {test_id}, score: {score}")
+    logger.debug(f"Calculating test result for test_id: {test_id}, score: {score}")
     test_data = get_test_by_id(test_id)
     if not test_data:
         logger.error(f"Test data not found for test_id: {test_id}. Cannot calculate result.")
         return None
 
-    result_text = "Результат не найден."
-    consult_focus = "Информация для консультации не найдена."
-    full_html = "<p>Полные результаты не найдены.</p>"
-    
-    user_answers_str = ""
-    user_answers_html_str = ""
+    table = RESULT_TABLES.get(test_id)
+    entry = table.lookup(score) if table else None
+    if entry is None:
+        logger.warning(f"No result for test_id: {test_id}, score: {score}")
+        return {"summary": RESULT_NOT_FOUND_TEXT, "consultation_focus": CONSULT_FOCUS_NOT_FOUND_TEXT,
+                "full_html_result": FULL_HTML_NOT_FOUND_TEXT}
 
     if user_answers_indices is not None:
-        # Формируем строку с ответами пользователя для Telegram (без спецсимволов Markdown)
-        user_answers_str = "\n\n📝 Ваши ответы:\n"
-        for i, ans_idx in enumerate(user_answers_indices):
-            q_text = test_data["questions"][i]["text"].split('\n')[0] # Краткий вопрос
-            logger.debug(f"Processing question {i} with answer index {ans_idx}")
-            a_text = test_data["questions"][i]["options"][ans_idx]["text"]
-            user_answers_str += f"{i+1}. {q_text}\n   Ответ: {a_text}\n" # Без спецсимволов Markdown
-
-        # Формируем HTML строку с ответами пользователя для email
-        user_answers_html_str = "<h3>Ваши ответы:</h3><ul>"
-        for i, ans_idx in enumerate(user_answers_indices):
-            q_text = test_data["questions"][i]["text"] # Полный вопрос для email
-            a_text = test_data["questions"][i]["options"][ans_idx]["text"]
-            user_answers_html_str += f"<li><strong>{q_text}</strong><br>Ответ: <em>{a_text}</em></li>"
-        user_answers_html_str += "</ul>"
-
-    # Определяем, какой формат у результатов теста - список объектов или словарь объектов
-    if isinstance(test_data["results"], list):
-        # Для списка объектов (новые тесты)
-        for res_info in test_data["results"]:
-            low, high = res_info["range"]
-            if low <= score <= high:
-                summary_template = res_info.get("summary_template", "Результат: {score} баллов.")
-                result_text = summary_template.replace("{user_answers}", user_answers_str).replace("{score}", str(score))
-                
-                consult_focus = res_info.get("consultation_focus", "Обсудите ваши результаты с специалистом.")
-                
-                full_html_template = res_info.get("full_html_result_template", "<p>Результат: {score} баллов.</p>{user_answers_html}")
-                full_html = full_html_template.replace("{user_answers_html}", user_answers_html_str).replace("{score}", str(score))
-                break
+        user_answers_str, user_answers_html_str = _format_user_answers(test_data, user_answers_indices)
     else:
-        # Для словаря объектов (constitution tests)
-        for result_key, res_info in test_data["results"].items():
-            low, high = res_info["range"]
-            if low <= score <= high:
-                result_title = res_info.get("title", f"Результат: {result_key}")
-                result_desc = res_info.get("description", "")
-                result_freq = res_info.get("frequency", "")
-                result_rec = res_info.get("recommendations", res_info.get("recommendation", ""))
-                
-                # Формируем текст результата для Telegram 
-                # Без специальных символов для MarkdownV2, которые будут экранированы в bot.py
-                summary_template = f"{result_title}\n\n{result_desc}\n\nРекомендуемая частота: {result_freq}\n\nРекомендации: {result_rec}\n\n📝 Ваш результат: {score} баллов{user_answers_str}"
-                result_text = summary_template
-                
-                # Получаем фокус для консультации из отдельного поля, если оно есть
-                if "consultation_focus" in test_data and result_key in test_data["consultation_focus"]:
-                    consult_focus = test_data["consultation_focus"][result_key]
-                else:
-                    consult_focus = res_info.get("consultation_focus", "Обсудите ваши результаты с специалистом.")
-                
-                # Формируем HTML для email
-                full_html = f"<h2>{result_title}</h2><p>{result_desc}</p><p><strong>Рекомендуемая частота:</strong> {result_freq}</p><p><strong>Рекомендации:</strong> {result_rec}</p><p><strong>Ваш результат:</strong> {score} баллов</p>{user_answers_html_str}"
-                break
-            
-    return {"summary": result_text, "consultation_focus": consult_focus, "full_html_result": full_html}
\ No newline at end of file
+        user_answers_str = user_answers_html_str = ""
+    return {"summary": user_answers_str.join(entry.summary_parts),
+            "consultation_focus": entry.consultation_focus,
+            "full_html_result": user_answers_html_str.join(entry.html_parts)}
\ No newline at end of file
@@ -0,0 +1,82 @@
+# text_render.py
+# Экранирование текста для Telegram MarkdownV2.
+#
+# Экранирование идёт по готовой таблице (символ, замена), и replace вызывается только
+# для символов, которые в строке есть. str.translate здесь медленнее: на кириллице
+# (а это почти все тексты бота) он ищет в таблице каждый символ строки.
+# Почти все экранируемые строки статические (тексты config, названия, вопросы и варианты ответов
+# тестов), поэтому результат кэшируется в LRU на ESCAPE_CACHE_SIZE строк; prewarm()
+# при старте заранее кладёт туда все статические тексты.
+import functools
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Символы, которые MarkdownV2 требует экранировать (обратный слэш - тоже)
+MARKDOWN_V2_SPECIAL_CHARS = '\\_*[]()~`>#+-=|{}.!'
+
+# Обратный слэш первым - иначе задвоились бы слэши, добавленные для остальных символов
+_ESCAPE_TABLE = tuple((char, '\\' + char) for char in MARKDOWN_V2_SPECIAL_CHARS)
+
+# Длинные строки (письма, ответы пользователей) не кэшируются - они почти не повторяются
+MAX_CACHED_LENGTH = 4096
+
+
+def _escape(text: str) -> str:
+    for char, escaped in _ESCAPE_TABLE:
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
+
+
+def escape_markdown_v2_uncached(text) -> str:
+    if not isinstance(text, str):
+        text = str(text)
+    return _escape(text)
+
+
+_escape_cached = functools.lru_cache(maxsize=config.ESCAPE_CACHE_SIZE)(_escape)
+
+
+def escape_markdown_v2(text) -> str:
+    if not isinstance(text, str):
+        text = str(text)
+    if len(text) > MAX_CACHED_LENGTH:
+        return _escape(text)
+    return _escape_cached(text)
+
+
+def _config_texts():
+    for name in dir(config):
+        value = getattr(config, name)
+        # Шаблоны с {полями} экранируются уже после format - заранее их не посчитать
+        if name.endswith("_TEXT") and isinstance(value, str) and '{' not in value:
+            yield value
+
+
+def _test_texts():
+    import test_engine
+    for test in test_engine.TESTS.values():
+        yield test["name"]
+        yield f"Начинаем тест «{test['name']}»..."
+        for question in test["questions"]:
+            yield question["text"]
+            for option in question["options"]:
+                yield option["text"]
+
+
+def prewarm() -> int:
+    """Кладёт в кэш статические тексты config и тестов; возвращает их число."""
+    texts = set(_config_texts())
+    texts.update(_test_texts())
+    for text in texts:
+        escape_markdown_v2(text)
+    logger.info(f"Markdown escape cache prewarmed with {len(texts)} static texts "
+                f"(cache size {config.ESCAPE_CACHE_SIZE})")
+    return len(texts)
+
+
+def cache_info():
+    return _escape_cached.cache_info()
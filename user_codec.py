@@ -0,0 +1,160 @@
+# user_codec.py
+# Форматы файлов хранилища пользователей (снапшот users.json и журнал изменений).
+#
+#   "json"    - компактный JSON без отступов (только stdlib)
+#   "orjson"  - тот же JSON, но (де)сериализация через orjson, если он установлен
+#   "msgpack" - бинарный формат, если установлен msgpack
+#   "auto"    - лучший из доступных: orjson -> msgpack -> json
+#
+# Формат файла при чтении определяется по содержимому, а не по настройке:
+# msgpack-файлы начинаются с MSGPACK_MAGIC, всё остальное читается как JSON.
+# Поэтому смена USERS_CODEC не ломает старые файлы - они просто перепишутся при компакции.
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:  # необязательная зависимость
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # необязательная зависимость
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_MAGIC = b"\x00UDM-MSGPACK-1\n"
+
+FORMAT_JSON = "json"
+FORMAT_MSGPACK = "msgpack"
+
+
+class CodecUnavailableError(RuntimeError):
+    """Файл записан форматом, для которого не установлена библиотека.
+
+    Не ValueError: такой файл не битый, его нельзя откладывать в сторону как повреждённый.
+    """
+
+
+def _json_loads(data: bytes):
+    # orjson читает любой корректный JSON, в том числе старые файлы с indent=4
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def dumps_text(obj) -> str:
+    """Компактная JSON-строка (для значений внутри записи, например истории тестов)."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads_text(text: str):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+class JsonCodec:
+    name = "json"
+    format = FORMAT_JSON
+    header = b""
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes):
+        return _json_loads(data)
+
+    def encode_entry(self, entry: dict) -> bytes:
+        # Журнал - одна JSON-строка на изменение
+        return self.dumps(entry) + b"\n"
+
+    def iter_entries(self, data: bytes, source: str = "journal"):
+        """Записи журнала; битые строки пропускаются с предупреждением."""
+        for line_no, line in enumerate(data.split(b"\n"), 1):
+            if not line.strip():
+                continue
+            try:
+                yield _json_loads(line)
+            except ValueError as e:
+                # Обычно это недописанная последняя строка после падения
+                logger.warning(f"Skipping broken journal line {source}:{line_no}: {e}")
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    format = FORMAT_MSGPACK
+    header = MSGPACK_MAGIC
+
+    def dumps(self, obj) -> bytes:
+        return MSGPACK_MAGIC + msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: bytes):
+        return msgpack.unpackb(data[len(MSGPACK_MAGIC):], raw=False, strict_map_key=False)
+
+    def encode_entry(self, entry: dict) -> bytes:
+        # Журнал - поток msgpack-объектов подряд после заголовка файла
+        return msgpack.packb(entry, use_bin_type=True)
+
+    def iter_entries(self, data: bytes, source: str = "journal"):
+        unpacker = msgpack.Unpacker(raw=False, strict_map_key=False)
+        unpacker.feed(data[len(MSGPACK_MAGIC):] if data.startswith(MSGPACK_MAGIC) else data)
+        try:
+            for entry in unpacker:
+                yield entry
+        except (ValueError, msgpack.UnpackException) as e:
+            # Дальше разбирать поток нельзя: теряем только хвост после битой записи
+            logger.warning(f"Stopping journal replay of {source} at a broken entry: {e}")
+
+
+def available_codecs():
+    names = ["json"]
+    if orjson is not None:
+        names.append("orjson")
+    if msgpack is not None:
+        names.append("msgpack")
+    return names
+
+
+def get_codec(name: str = "auto"):
+    """Кодек по имени из config.USERS_CODEC; недоступный заменяется на json с предупреждением."""
+    if name == "auto":
+        name = "orjson" if orjson is not None else "msgpack" if msgpack is not None else "json"
+    if name == "orjson":
+        if orjson is not None:
+            return OrjsonCodec()
+        logger.warning("USERS_CODEC 'orjson' requested but orjson is not installed, using json.")
+    elif name == "msgpack":
+        if msgpack is not None:
+            return MsgpackCodec()
+        logger.warning("USERS_CODEC 'msgpack' requested but msgpack is not installed, using json.")
+    elif name != "json":
+        logger.warning(f"Unknown USERS_CODEC '{name}', using json.")
+    return JsonCodec()
+
+
+def detect_format(data: bytes) -> str:
+    return FORMAT_MSGPACK if data.startswith(MSGPACK_MAGIC) else FORMAT_JSON
+
+
+def codec_for_data(data: bytes):
+    """Кодек, которым можно прочитать уже записанный файл."""
+    if detect_format(data) == FORMAT_MSGPACK:
+        if msgpack is None:
+            raise CodecUnavailableError("file is in msgpack format but msgpack is not installed (pip install msgpack)")
+        return MsgpackCodec()
+    return OrjsonCodec() if orjson is not None else JsonCodec()
+
+
+def strip_header(data: bytes) -> bytes:
+    return data[len(MSGPACK_MAGIC):] if data.startswith(MSGPACK_MAGIC) else data
@@ -1,8 +1,21 @@
 # user_data_manager.py
-import json
-import os
+import atexit
+import asyncio
+import collections
+import contextlib
+import copy
 import datetime
+import functools
 import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import practice_times
+import test_engine
+import user_storage
+from user_record import UserRecord
 
 USERS_FILE = "users.json"
 logger = logging.getLogger(__name__)
@@ -12,121 +25,184 @@ logger = logging.getLogger(__name__)
 # username: str | None
 # ... (all other fields)
 
+# --- Storage backend ---
+# Бэкенд выбирается в config.USER_STORAGE_BACKEND ("json" или "sqlite").
+# JSON-бэкенд держит все записи в памяти и дописывает изменения в журнал пачкой
+# по таймеру (flush_users из job_queue), при превышении порога и при остановке.
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = user_storage.create_store(
+                    config.USER_STORAGE_BACKEND,
+                    json_path=USERS_FILE,
+                    db_path=config.USERS_DB_FILE,
+                    flush_threshold=config.USERS_FLUSH_DIRTY_THRESHOLD,
+                    journal_path=config.USERS_JOURNAL_FILE,
+                    compact_bytes=config.USERS_JOURNAL_COMPACT_BYTES,
+                    durability=config.USERS_DURABILITY,
+                    codec=config.USERS_CODEC,
+                )
+    return _store
+
+def flush_users():
+    """Сбрасывает отложенные изменения на диск. Возвращает число сброшенных записей."""
+    if _store is None:
+        return 0
+    return _store.flush()
+
+def close_store():
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
+
+atexit.register(close_store)
+
 def load_users():
-    if not os.path.exists(USERS_FILE):
-        logger.info(f"{USERS_FILE} not found. Creating and initializing with {{}}.")
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump({}, f)
-        return {}
-    try:
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            content = f.read()
-            if not content.strip():
-                logger.warning(f"{USERS_FILE} is empty. Initializing with {{}}.")
-                with open(USERS_FILE, 'w', encoding='utf-8') as fw:
-                    json.dump({}, fw)
-                return {}
-            data = json.loads(content)
-            return {int(k): v for k, v in data.items()}
-    except (json.JSONDecodeError, IOError) as e:
-        logger.error(f"Error loading users from {USERS_FILE}: {e}. Attempting to reset.")
-        try:
-            with open(USERS_FILE, 'w', encoding='utf-8') as f_reset:
-                json.dump({}, f_reset)
-            logger.info(f"{USERS_FILE} has been reset to {{}}.")
-            return {}
-        except Exception as reset_e:
-            logger.error(f"Failed to reset {USERS_FILE}: {reset_e}")
-            return {} # Fallback to empty if reset fails
+    return get_store().all()
 
 def save_users(users_data):
-    try:
-        data_to_save = {str(k): v for k, v in users_data.items()}
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=4)
-        logger.debug(f"Users data saved to {USERS_FILE}")
-    except IOError as e:
-        logger.error(f"IOError saving users to {USERS_FILE}: {e}")
-    except Exception as e_gen:
-        logger.error(f"Generic error saving users to {USERS_FILE}: {e_gen}")
+    get_store().replace_all(users_data)
+
+# --- Per-user locks and transactions ---
+# Блокировка на chat_id живёт, пока кто-то её держит (WeakValueDictionary)
+_user_locks = weakref.WeakValueDictionary()
+_user_locks_guard = threading.Lock()
+_MISSING = object()
+
+def _user_lock(chat_id: int):
+    with _user_locks_guard:
+        lock = _user_locks.get(chat_id)
+        if lock is None:
+            lock = threading.RLock()
+            _user_locks[chat_id] = lock
+        return lock
+
+def _changed_fields(original: dict, user: dict):
+    return {key: value for key, value in user.items() if original.get(key, _MISSING) != value}
+
+def _commit(chat_id: int, original: dict, user: dict):
+    changed = _changed_fields(original, user)
+    if not changed:
+        return False
+    changed["last_interaction_date"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    get_store().update(chat_id, changed)
+    logger.debug(f"Transaction committed for {chat_id}: {sorted(changed)}")
+    return True
+
+@contextlib.contextmanager
+def transaction(chat_id: int):
+    """Unit of work над одной записью: одна загрузка, любые изменения словаря, одна запись.
+
+    with udm.transaction(chat_id) as user:
+        if user is not None:
+            user["stage"] = "..."; user["email"] = "..."
+
+    Изменённые поля фиксируются одним update (одна строка журнала / одна строка SQLite)
+    под блокировкой пользователя и внутри store.atomic() - для SQLite это одна транзакция,
+    так что чтение и запись не перемешиваются с воркерами доставки в других процессах.
+    При исключении внутри блока ничего не сохраняется.
+    Удаление ключей не поддерживается - присваивайте None.
+    """
+    store = get_store()
+    with _user_lock(chat_id), store.atomic():
+        original = store.get(chat_id)
+        if original is None:
+            yield None
+            return
+        user = copy.deepcopy(original)
+        yield user
+        _commit(chat_id, original, user)
 
 def get_user_data(chat_id: int):
-    users = load_users()
-    return users.get(chat_id)
+    return get_store().get(chat_id)
 
 def create_or_update_user(chat_id: int, username: str = None, first_name: str = None, initial_stage: str = "greeted"):
-    users = load_users()
-    user_data = users.get(chat_id)
-    
-    current_time_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
-
-    if user_data is None:
-        user_data = {
-            "chat_id": chat_id,
-            "username": username,
-            "first_name": first_name,
-            "subscribed_to_daily": False,
-            "daily_practice_mode": "none",
-            "current_daily_day": 0,
-            "last_morning_sent_date": None,
-            "last_evening_sent_date": None,
-            "stage": initial_stage,
-            "email": None,
-            "active_test": None,
-            "tests_taken": {},
-            "created_at": current_time_iso,
-            "last_interaction_date": current_time_iso
-        }
-        logger.info(f"New user created: {chat_id} ({username or 'NoUsername'})")
-    else:
+    # Слой совместимости: снаружи словарь, внутри хранилища - UserRecord со схемой и умолчаниями.
+    # Существующей записи пишутся только изменённые поля, и всё - внутри store.atomic():
+    # иначе перезапись целиком затёрла бы то, что между чтением и записью сделал воркер
+    # доставки (перевод дня, last_*_sent_date, отписка недоступных).
+    store = get_store()
+    with _user_lock(chat_id), store.atomic():
+        user_data = store.get(chat_id)
+        current_time_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        if user_data is None:
+            user_data = UserRecord(
+                chat_id=chat_id,
+                username=username,
+                first_name=first_name,
+                stage=initial_stage,
+                created_at=current_time_iso,
+                last_interaction_date=current_time_iso
+            ).to_dict()
+            store.put(chat_id, user_data)
+            logger.info(f"New user created: {chat_id} ({username or 'NoUsername'})")
+            return user_data
+
+        fields = {"last_interaction_date": current_time_iso}
         if username is not None: # Allow updating username, even to None if user removes it
-            user_data["username"] = username
+            fields["username"] = username
         if first_name: # Only update if a new first_name is provided
-            user_data["first_name"] = first_name
-        user_data["last_interaction_date"] = current_time_iso
+            fields["first_name"] = first_name
         # Don't reset stage if user already exists, unless specified by initial_stage and different from default
-        if initial_stage != "greeted" or "stage" not in user_data:
-            user_data["stage"] = initial_stage
-        # Ensure essential keys exist if loading an old user_data structure
-        for key, default_value in [
-            ("subscribed_to_daily", False), ("daily_practice_mode", "none"),
-            ("current_daily_day", 0), ("active_test", None), ("tests_taken", {})
-        ]:
-            if key not in user_data:
-                user_data[key] = default_value
-
-
-    users[chat_id] = user_data
-    save_users(users)
-    return user_data
+        if initial_stage != "greeted" or user_data.get("stage") is None:
+            fields["stage"] = initial_stage
+        store.update(chat_id, fields)
+        user_data.update(fields)
+        return user_data
 
 def update_user_data(chat_id: int, new_data_dict: dict):
-    users = load_users()
-    user = users.get(chat_id)
-    if user:
-        for key, value in new_data_dict.items():
-            user[key] = value
-        user["last_interaction_date"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-        users[chat_id] = user
-        save_users(users)
+    fields = dict(new_data_dict)
+    fields["last_interaction_date"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with _user_lock(chat_id):
+        updated = get_store().update(chat_id, fields)
+    if updated:
         logger.debug(f"User data updated for {chat_id}: {new_data_dict}")
         return True
     logger.warning(f"Attempted to update non-existent user: {chat_id}")
     return False
 
 def set_user_subscribed(chat_id: int, subscribed_status: bool = True):
-    mode = "both" if subscribed_status else "none"
-    # При подписке начинаем с дня 1, при отписке current_daily_day можно не менять или сбросить в 0
-    current_day_on_sub = 1 if subscribed_status else get_user_data(chat_id).get("current_daily_day", 0)
-
-    return update_user_data(chat_id, {
-        "subscribed_to_daily": subscribed_status,
-        "daily_practice_mode": mode,
-        "current_daily_day": current_day_on_sub, 
-        "stage": "daily_subscribed" if subscribed_status else "unsubscribed_daily",
-        "last_morning_sent_date": None,  # Сброс при новой подписке
-        "last_evening_sent_date": None   # Сброс при новой подписке
-    })
+    with transaction(chat_id) as user:
+        if user is None:
+            logger.warning(f"Attempted to update non-existent user: {chat_id}")
+            return False
+        user.update({
+            "subscribed_to_daily": subscribed_status,
+            "daily_practice_mode": "both" if subscribed_status else "none",
+            # При подписке начинаем с дня 1, при отписке current_daily_day не меняем
+            "current_daily_day": 1 if subscribed_status else user.get("current_daily_day", 0),
+            "stage": "daily_subscribed" if subscribed_status else "unsubscribed_daily",
+            "last_morning_sent_date": None,  # Сброс при новой подписке
+            "last_evening_sent_date": None   # Сброс при новой подписке
+        })
+    return True
+
+# stage отписанного из-за постоянной ошибки доставки (причины - delivery.PERMANENT_FAILURES)
+UNREACHABLE_STAGES = {"blocked": "bot_blocked", "deactivated": "user_deactivated", "chat_not_found": "chat_not_found"}
+
+def unsubscribe_unreachable(reasons: dict):
+    """Отписывает пачку недоступных пользователей {chat_id: причина} одной транзакцией хранилища.
+
+    Минутные корзины расписания обновляются вместе с записями. Возвращает число отписанных.
+    """
+    if not reasons:
+        return 0
+    updates = {
+        chat_id: {"subscribed_to_daily": False, "daily_practice_mode": "none",
+                  "stage": UNREACHABLE_STAGES.get(reason, "bot_blocked")}
+        for chat_id, reason in reasons.items()
+    }
+    updated = get_store().update_many(updates)
+    logger.info(f"Unsubscribed {updated} unreachable users: {dict(collections.Counter(reasons.values()))}")
+    return updated
 
 def set_user_stage(chat_id: int, stage: str):
     return update_user_data(chat_id, {"stage": stage})
@@ -135,46 +211,265 @@ def set_user_email(chat_id: int, email: str):
     return update_user_data(chat_id, {"email": email})
 
 def increment_user_daily_day(chat_id: int, total_days: int):
-    user = get_user_data(chat_id)
-    if user:
-        current_day = user.get("current_daily_day", 0)
-        next_day = current_day + 1
+    with transaction(chat_id) as user:
+        if user is None:
+            return False
+        next_day = user.get("current_daily_day", 0) + 1
         if next_day > total_days:
             next_day = 1 # Зацикливание
             logger.info(f"User {chat_id} completed {total_days} day cycle, looping to day 1.")
-        return update_user_data(chat_id, {"current_daily_day": next_day})
-    return False
+        user["current_daily_day"] = next_day
+    return True
+
+def advance_daily_days(delivered_days: dict, total_days: int):
+    """Перевод на следующий день цикла всех, кому доставлена завершающая день практика.
+
+    delivered_days - {chat_id: день, практика которого доставлена}. Одна транзакция хранилища
+    вместо загрузки и сохранения записи на каждого; после total_days - снова день 1.
+    Возвращает {chat_id: новый день}.
+    """
+    if not delivered_days:
+        return {}
+    advanced = get_store().advance_days(delivered_days, total_days)
+    looped = sum(1 for day in advanced.values() if day == 1)
+    logger.info(f"Advanced daily day for {len(advanced)}/{len(delivered_days)} users"
+                + (f", {looped} completed the {total_days} day cycle and looped to day 1" if looped else ""))
+    return advanced
 
-def record_test_taken(chat_id: int, test_id: str, summary: str, answers: list, email_recipient: str = None, email_sent_status: str = None):
-    user = get_user_data(chat_id)
-    if user:
-        if "tests_taken" not in user or user["tests_taken"] is None:
-            user["tests_taken"] = {}
-        
-        user["tests_taken"][test_id] = {
-            "summary": summary,
-            "answers": answers,
-            "date_taken": datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
-            "email_recipient": email_recipient,
-            "email_sent_status": email_sent_status,
-            "consult_interest_shown": False # Инициализируем по умолчанию
-        }
+def make_test_taken_entry(answers: list, score: int = None, email_recipient: str = None, email_sent_status: str = None):
+    # Текст результата не хранится: он собирается заново по test_id + score (stored_test_result)
+    return {
+        "score": score,
+        "answers": answers,
+        "date_taken": datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+        "email_recipient": email_recipient,
+        "email_sent_status": email_sent_status,
+        "consult_interest_shown": False # Инициализируем по умолчанию
+    }
+
+def record_test_taken(chat_id: int, test_id: str, answers: list, email_recipient: str = None, email_sent_status: str = None, score: int = None):
+    with transaction(chat_id) as user:
+        if user is None:
+            return False
+        tests_taken = user.get("tests_taken") or {}
+        tests_taken[test_id] = make_test_taken_entry(answers, score, email_recipient, email_sent_status)
+        user["tests_taken"] = tests_taken
         # Сбрасываем активный тест после записи
-        return update_user_data(chat_id, {"tests_taken": user["tests_taken"], "active_test": None})
-    return False
+        user["active_test"] = None
+    return True
+
+def stored_test_result(test_id: str, entry: dict):
+    """Результат пройденного теста по записи tests_taken[test_id] - test_engine.get_test_result по баллу.
+
+    None, если балла нет или у теста нет результата для этого балла (например, выбор пола).
+    Старые записи без балла отдают только сохранённый в них summary.
+    """
+    if not entry:
+        return None
+    score = entry.get("score")
+    if score is None:
+        return {"summary": entry["summary"]} if entry.get("summary") else None
+    table = test_engine.RESULT_TABLES.get(test_id)
+    if table is None or table.lookup(score) is None:
+        return None
+    return test_engine.get_test_result(test_id, score, entry.get("answers"))
 
 def get_subscribed_users():
-    users = load_users()
-    return [
-        data for data in users.values() 
-        if data.get("subscribed_to_daily") and data.get("daily_practice_mode") in ["both", "dual", "morning_only"]
-    ]
+    return get_store().subscribed_users()
+
+# --- Index queries ---
+# Ответ за время, пропорциональное размеру результата, без прохода по всем пользователям
+
+def get_chat_ids_by_mode(mode: str):
+    """chat_id подписчиков с режимом daily_practice_mode == mode."""
+    return get_store().chat_ids_by_mode(mode)
+
+def get_chat_ids_by_day(day: int):
+    """chat_id подписчиков, у которых current_daily_day == day."""
+    return get_store().chat_ids_by_day(day)
+
+def get_chat_ids_by_stage_prefix(prefix: str):
+    """chat_id всех пользователей, чей stage начинается с prefix."""
+    return get_store().chat_ids_by_stage_prefix(prefix)
+
+def get_chat_ids_by_minute(part: str, minute: int):
+    """chat_id подписчиков, чья практика part приходится на минуту суток UTC minute (0..1439)."""
+    return get_store().chat_ids_by_minute(part, minute)
+
+def get_schedule_buckets():
+    """{part: {минута UTC: число подписчиков}} - непустые минутные корзины расписания."""
+    return get_store().schedule_buckets()
+
+def get_users_awaiting_email():
+    return get_store().chat_ids_by_stage_prefix(user_storage.AWAITING_EMAIL_STAGE_PREFIX)
+
+def get_user_stats():
+    """Счётчики для админской статистики: подписчики по режимам и дням, ожидающие email."""
+    return get_store().index_stats()
+
+def set_user_schedule(chat_id: int, timezone: str = _MISSING, morning_time: str = _MISSING, evening_time: str = _MISSING):
+    """Личное расписание практик: часовой пояс и локальное время "HH:MM".
+
+    Не переданные поля не меняются, None - вернуть значение по умолчанию.
+    ValueError при неизвестном поясе или неверном времени. Минутный индекс
+    хранилища обновляется вместе с записью.
+    """
+    fields = {}
+    if timezone is not _MISSING:
+        fields["timezone"] = practice_times.validate_timezone(timezone) if timezone else None
+    for name, value in (("morning_time", morning_time), ("evening_time", evening_time)):
+        if value is not _MISSING:
+            fields[name] = practice_times.parse_hhmm(value).strftime("%H:%M") if value else None
+    if not fields:
+        return True
+    return update_user_data(chat_id, fields)
 
 def update_last_sent_date(chat_id: int, practice_type: str):
-    """practice_type: "morning" or "evening" """
-    today_str = datetime.date.today().isoformat()
+    """practice_type: "morning" or "evening"; дата - по UTC, как в send_ledger"""
+    today_str = datetime.datetime.now(datetime.timezone.utc).date().isoformat()
     if practice_type == "morning":
         return update_user_data(chat_id, {"last_morning_sent_date": today_str})
     elif practice_type == "evening":
         return update_user_data(chat_id, {"last_evening_sent_date": today_str})
-    return False
\ No newline at end of file
+    return False
+
+
+# --- Async API ---
+# Все обращения к хранилищу из хэндлеров идут через один выделенный I/O-поток,
+# чтобы медленный диск не останавливал event loop. Один поток = операции
+# выполняются строго по очереди, как и раньше, но уже не в цикле asyncio.
+_io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="udm-io")
+
+async def _run_io(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(func, *args, **kwargs))
+
+# --- Per-chat asyncio locks ---
+# Сериализуют обработку одного чата при конкурентной обработке апдейтов:
+# разные чаты идут параллельно, один и тот же - строго по очереди.
+# Это только хэндлеры этого процесса: доставка (ticker, воркеры) chat_lock не берёт,
+# от неё записи защищают _user_lock и store.atomic() (transaction / atransaction).
+
+class ChatLock:
+    """asyncio.Lock, повторно входимый из той же задачи."""
+    __slots__ = ("_lock", "_owner", "_depth", "__weakref__")
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._owner = None
+        self._depth = 0
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    async def __aenter__(self):
+        task = asyncio.current_task()
+        if self._owner is task and task is not None:
+            self._depth += 1
+            return self
+        await self._lock.acquire()
+        self._owner = task
+        self._depth = 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._lock.release()
+
+# Блокировка живёт, пока её держат или ждут; потом запись исчезает сама
+_chat_locks = weakref.WeakValueDictionary()
+
+def chat_lock(chat_id: int) -> ChatLock:
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = ChatLock()
+        _chat_locks[chat_id] = lock
+    return lock
+
+def chat_locks_in_use() -> int:
+    return len(_chat_locks)
+
+async def atransaction(chat_id: int, mutate):
+    """Асинхронный вариант transaction(): загрузка, mutate(user) и фиксация - один вызов в I/O-потоке.
+
+    def apply(user):
+        user["stage"] = "..."
+    user = await udm.atransaction(chat_id, apply)
+
+    Всё идёт внутри transaction(), то есть под блокировкой пользователя и store.atomic(),
+    поэтому чтение и запись не перемешиваются с ticker'ом и воркерами доставки.
+    mutate - обычная функция (без await): она выполняется в I/O-потоке.
+    Возвращает изменённую запись или None, если пользователя нет (mutate тогда не вызывается).
+    """
+    def run():
+        with transaction(chat_id) as user:
+            if user is None:
+                return None
+            mutate(user)
+            return user
+    return await _run_io(run)
+
+async def aget_user(chat_id: int):
+    return await _run_io(get_user_data, chat_id)
+
+async def aupdate_user(chat_id: int, new_data_dict: dict):
+    return await _run_io(update_user_data, chat_id, new_data_dict)
+
+async def acreate_or_update_user(chat_id: int, username: str = None, first_name: str = None, initial_stage: str = "greeted"):
+    return await _run_io(create_or_update_user, chat_id, username, first_name, initial_stage)
+
+async def aset_user_subscribed(chat_id: int, subscribed_status: bool = True):
+    return await _run_io(set_user_subscribed, chat_id, subscribed_status)
+
+async def aunsubscribe_unreachable(reasons: dict):
+    return await _run_io(unsubscribe_unreachable, reasons)
+
+async def aset_user_stage(chat_id: int, stage: str):
+    return await _run_io(set_user_stage, chat_id, stage)
+
+async def aset_user_email(chat_id: int, email: str):
+    return await _run_io(set_user_email, chat_id, email)
+
+async def aincrement_user_daily_day(chat_id: int, total_days: int):
+    return await _run_io(increment_user_daily_day, chat_id, total_days)
+
+async def aadvance_daily_days(delivered_days: dict, total_days: int):
+    return await _run_io(advance_daily_days, delivered_days, total_days)
+
+async def arecord_test_taken(chat_id: int, test_id: str, answers: list, email_recipient: str = None, email_sent_status: str = None, score: int = None):
+    return await _run_io(record_test_taken, chat_id, test_id, answers, email_recipient, email_sent_status, score)
+
+async def aupdate_last_sent_date(chat_id: int, practice_type: str):
+    return await _run_io(update_last_sent_date, chat_id, practice_type)
+
+async def aget_subscribed_users():
+    return await _run_io(get_subscribed_users)
+
+async def aget_chat_ids_by_mode(mode: str):
+    return await _run_io(get_chat_ids_by_mode, mode)
+
+async def aget_chat_ids_by_day(day: int):
+    return await _run_io(get_chat_ids_by_day, day)
+
+async def aget_chat_ids_by_stage_prefix(prefix: str):
+    return await _run_io(get_chat_ids_by_stage_prefix, prefix)
+
+async def aget_chat_ids_by_minute(part: str, minute: int):
+    return await _run_io(get_chat_ids_by_minute, part, minute)
+
+async def aget_schedule_buckets():
+    return await _run_io(get_schedule_buckets)
+
+async def aset_user_schedule(chat_id: int, **schedule):
+    return await _run_io(set_user_schedule, chat_id, **schedule)
+
+async def aget_user_stats():
+    return await _run_io(get_user_stats)
+
+async def aload_users():
+    return await _run_io(load_users)
+
+async def aflush_users():
+    return await _run_io(flush_users)
@@ -0,0 +1,141 @@
+# user_record.py
+# Компактное представление пользователя для хранилища в памяти.
+# Снаружи (user_data_manager, bot.py) по-прежнему ходят словари: to_dict()/from_dict()
+# и dict-подобные get()/[] - это слой совместимости.
+import sys
+import copy
+
+from user_codec import dumps_text, loads_text
+
+
+# Стабильная схема записи: поле -> значение по умолчанию
+FIELDS = (
+    ("chat_id", None),
+    ("username", None),
+    ("first_name", None),
+    ("subscribed_to_daily", False),
+    ("daily_practice_mode", "none"),
+    ("current_daily_day", 0),
+    ("last_morning_sent_date", None),
+    ("last_evening_sent_date", None),
+    ("stage", None),
+    ("email", None),
+    ("active_test", None),
+    ("created_at", None),
+    ("last_interaction_date", None),
+    # Личное расписание практик (None - как у всех, см. practice_times)
+    ("timezone", None),
+    ("morning_time", None),
+    ("evening_time", None),
+)
+FIELD_NAMES = frozenset(name for name, _ in FIELDS)
+# Повторяющиеся короткие строки храним в одном экземпляре
+_INTERNED_FIELDS = ("daily_practice_mode", "stage", "last_morning_sent_date", "last_evening_sent_date",
+                    "timezone", "morning_time", "evening_time")
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _copy(value):
+    # Строки и числа неизменяемы - копировать имеет смысл только контейнеры
+    return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+
+def _score_from_answers(test_id: str, answers):
+    """Восстанавливает балл старых записей, где вместо балла хранился текст summary."""
+    import test_engine
+    test = test_engine.TESTS.get(test_id)
+    if not test or not answers:
+        return None
+    try:
+        score = sum(test["questions"][i]["options"][ans]["score"] for i, ans in enumerate(answers))
+    except (IndexError, KeyError, TypeError):
+        return None
+    return score if isinstance(score, int) else None
+
+
+def compact_test_entry(test_id: str, entry: dict):
+    """Убирает из записи о тесте копию текста результата, оставляя ссылку (test_id + score)."""
+    entry = dict(entry)
+    if "summary" in entry:
+        if entry.get("score") is None:
+            entry["score"] = _score_from_answers(test_id, entry.get("answers"))
+        if entry["score"] is not None:
+            # Текст восстанавливается через test_engine.get_test_result по требованию
+            del entry["summary"]
+    return entry
+
+
+class UserRecord:
+    __slots__ = tuple(name for name, _ in FIELDS) + ("extra", "_tests_taken")
+
+    def __init__(self, **fields):
+        for name, default in FIELDS:
+            value = fields.pop(name, default)
+            setattr(self, name, _intern(value) if name in _INTERNED_FIELDS else value)
+        tests_taken = fields.pop("tests_taken", None)
+        self._tests_taken = None
+        self.set_tests_taken(tests_taken)
+        # Всё, что не входит в схему (channel_subscription, pending_email_* и т.п.)
+        self.extra = fields or None
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**copy.deepcopy(data))
+
+    # --- история тестов ---
+    # Хранится сериализованной строкой и разворачивается только при обращении
+
+    @property
+    def tests_taken(self) -> dict:
+        return loads_text(self._tests_taken) if self._tests_taken else {}
+
+    def set_tests_taken(self, tests_taken):
+        if not tests_taken:
+            self._tests_taken = None
+            return
+        compacted = {test_id: compact_test_entry(test_id, entry or {}) for test_id, entry in tests_taken.items()}
+        self._tests_taken = dumps_text(compacted)
+
+    # --- совместимость со словарём ---
+
+    def get(self, key: str, default=None):
+        if key in FIELD_NAMES:
+            return getattr(self, key)
+        if key == "tests_taken":
+            return self.tests_taken
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        return default
+
+    def __getitem__(self, key: str):
+        if key in FIELD_NAMES or key == "tests_taken" or (self.extra and key in self.extra):
+            return self.get(key)
+        raise KeyError(key)
+
+    def __contains__(self, key: str):
+        return key in FIELD_NAMES or key == "tests_taken" or bool(self.extra and key in self.extra)
+
+    def update(self, fields: dict):
+        for key, value in fields.items():
+            value = copy.deepcopy(value)
+            if key in FIELD_NAMES:
+                setattr(self, key, _intern(value) if key in _INTERNED_FIELDS else value)
+            elif key == "tests_taken":
+                self.set_tests_taken(value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+
+    def to_dict(self) -> dict:
+        data = {name: _copy(getattr(self, name)) for name, _ in FIELDS}
+        data["tests_taken"] = self.tests_taken
+        if self.extra:
+            data.update((key, _copy(value)) for key, value in self.extra.items())
+        return data
+
+    def __repr__(self):
+        return f"UserRecord(chat_id={self.chat_id!r}, stage={self.stage!r})"
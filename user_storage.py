@@ -0,0 +1,796 @@
+# user_storage.py
+# Хранилища записей пользователей. user_data_manager работает только через
+# интерфейс ниже, конкретный бэкенд выбирается в config.USER_STORAGE_BACKEND.
+#
+# Интерфейс бэкенда:
+#   lock                      - RLock для read-modify-write в user_data_manager
+#   get(chat_id)              - копия записи или None
+#   put(chat_id, record)      - записать запись целиком
+#   update(chat_id, fields)   - точечное обновление одной записи, False если нет записи
+#   update_many(updates)      - {chat_id: fields} одной транзакцией, возвращает число обновлённых записей
+#   advance_days(days, total_days) - {chat_id: день, который был доставлен}: перевод на следующий день
+#                               (после total_days - снова 1) одной транзакцией; запись, чей день уже
+#                               сменился, не трогается. Возвращает {chat_id: новый день}
+#   atomic()                  - контекст: чтение и запись внутри - одна транзакция (для SQLite - и между процессами)
+#   all()                     - копия всех записей {chat_id: record}
+#   replace_all(users)        - заменить всё содержимое
+#   subscribed_users()        - подписчики с активным режимом практик
+#   chat_ids_by_mode(mode)    - chat_id подписчиков с данным daily_practice_mode
+#   chat_ids_by_day(day)      - chat_id подписчиков на данном current_daily_day
+#   chat_ids_by_stage_prefix(prefix) - chat_id всех пользователей, чей stage начинается с prefix
+#   chat_ids_by_minute(part, minute) - chat_id подписчиков, чья практика part приходится на минуту UTC
+#   schedule_buckets()        - {part: {минута UTC: число подписчиков}}
+#   refresh_schedule_index()  - пересчитать минуты на сегодняшнюю дату (переходы на летнее время)
+#   index_stats()             - счётчики по индексам для статистики
+#   flush()                   - сбросить отложенные изменения, вернуть их число
+#   close()
+import contextlib
+import json
+import os
+import copy
+import logging
+import sqlite3
+import threading
+import time
+
+import practice_times
+import user_codec
+from user_record import UserRecord
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_PRACTICE_MODES = ("both", "dual", "morning_only")
+
+# Режимы надёжности записи:
+#   "always" - каждое изменение сразу пишется и fsync'ится (пакетные update_many/advance_days - одним fsync)
+#   "group"  - изменения копятся и фиксируются одним fsync за интервал flush
+DURABILITY_ALWAYS = "always"
+DURABILITY_GROUP = "group"
+
+AWAITING_EMAIL_STAGE_PREFIX = "awaiting_email_input_for_"
+
+
+def _fsync_dir(path: str):
+    """fsync каталога, чтобы rename пережил падение питания."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return  # Windows: каталог так не открыть
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def atomic_write_bytes(path: str, data: bytes):
+    """Пишет во временный файл, fsync'ит и атомарно подменяет path.
+
+    При падении на любом шаге на месте остаётся либо старый файл целиком, либо новый.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+class UserIndex:
+    """Вторичные индексы по записям в памяти, обновляются при каждом изменении записи.
+
+    Подписчики (subscribed_to_daily + активный режим) индексируются по режиму,
+    по текущему дню и по минуте UTC каждой своей практики (минутные корзины
+    для тикера расписания, минуты считаются на дату minutes_date), все
+    пользователи - по stage. Запросы отдают множества chat_id за время,
+    пропорциональное размеру результата.
+    """
+
+    def __init__(self, minutes_date=None):
+        self._by_mode = {}
+        self._by_day = {}
+        self._by_stage = {}
+        self._by_minute = {}  # (part, минута UTC) -> chat_id
+        self._entries = {}  # chat_id -> (mode, day, stage, minutes), чтобы снять старые ключи
+        self.minutes_date = minutes_date or practice_times.utc_today()
+
+    def _entry_for(self, record: dict):
+        subscribed = record.get("subscribed_to_daily") and record.get("daily_practice_mode") in ACTIVE_PRACTICE_MODES
+        mode = record.get("daily_practice_mode") if subscribed else None
+        day = record.get("current_daily_day", 0) if subscribed else None
+        minutes = tuple(practice_times.user_minutes(record, self.minutes_date).items()) if subscribed else ()
+        return mode, day, record.get("stage"), minutes
+
+    @staticmethod
+    def _discard(buckets: dict, key, chat_id: int):
+        bucket = buckets.get(key)
+        if bucket is not None:
+            bucket.discard(chat_id)
+            if not bucket:
+                del buckets[key]
+
+    def remove(self, chat_id: int):
+        old = self._entries.pop(chat_id, None)
+        if old is None:
+            return
+        mode, day, stage, minutes = old
+        if mode is not None:
+            self._discard(self._by_mode, mode, chat_id)
+            self._discard(self._by_day, day, chat_id)
+        for key in minutes:
+            self._discard(self._by_minute, key, chat_id)
+        if stage is not None:
+            self._discard(self._by_stage, stage, chat_id)
+
+    def add(self, chat_id: int, record: dict):
+        entry = self._entry_for(record)
+        if self._entries.get(chat_id) == entry:
+            return
+        self.remove(chat_id)
+        mode, day, stage, minutes = entry
+        if mode is not None:
+            self._by_mode.setdefault(mode, set()).add(chat_id)
+            self._by_day.setdefault(day, set()).add(chat_id)
+        for key in minutes:
+            self._by_minute.setdefault(key, set()).add(chat_id)
+        if stage is not None:
+            self._by_stage.setdefault(stage, set()).add(chat_id)
+        self._entries[chat_id] = entry
+
+    def rebuild(self, users: dict, minutes_date=None):
+        self.__init__(minutes_date)
+        for chat_id, record in users.items():
+            self.add(chat_id, record)
+
+    def subscribed(self):
+        result = set()
+        for mode in ACTIVE_PRACTICE_MODES:
+            result |= self._by_mode.get(mode, set())
+        return result
+
+    def by_mode(self, mode: str):
+        return set(self._by_mode.get(mode, ()))
+
+    def by_day(self, day: int):
+        return set(self._by_day.get(day, ()))
+
+    def by_minute(self, part: str, minute: int):
+        return set(self._by_minute.get((part, minute), ()))
+
+    def schedule_buckets(self):
+        buckets = {part: {} for part in practice_times.PRACTICE_PARTS}
+        for (part, minute), chat_ids in self._by_minute.items():
+            buckets[part][minute] = len(chat_ids)
+        return buckets
+
+    def by_stage_prefix(self, prefix: str):
+        # Перебираются только различные значения stage, а не пользователи
+        result = set()
+        for stage, chat_ids in self._by_stage.items():
+            if stage.startswith(prefix):
+                result |= chat_ids
+        return result
+
+    def stats(self):
+        return {
+            "subscribed": sum(len(ids) for ids in self._by_mode.values()),
+            "by_mode": {mode: len(ids) for mode, ids in self._by_mode.items()},
+            "by_day": {day: len(ids) for day, ids in sorted(self._by_day.items())},
+            "awaiting_email": len(self.by_stage_prefix(AWAITING_EMAIL_STAGE_PREFIX)),
+        }
+
+
+class JsonUserStore:
+    """Весь users.json в памяти; изменения пишутся дельтами в журнал.
+
+    Каждое изменение - одна JSON-строка в журнале (append-only), поэтому
+    стоимость записи зависит от размера изменения, а не от числа пользователей.
+    При старте состояние = снапшот + проигрывание журнала. Когда журнал
+    перерастает compact_bytes, в фоне пишется свежий снапшот, а журнал обнуляется.
+    Формат снапшота и журнала задаёт codec (см. user_codec), при чтении он определяется сам.
+    """
+
+    def __init__(self, path: str, journal_path: str = None, flush_threshold: int = 200,
+                 compact_bytes: int = 5 * 1024 * 1024, durability: str = DURABILITY_GROUP,
+                 codec="auto"):
+        self.path = path
+        self.durability = durability
+        self.codec = user_codec.get_codec(codec) if isinstance(codec, str) else codec
+        self.journal_path = journal_path or f"{path}.journal"
+        self.compacting_path = f"{self.journal_path}.compacting"
+        self.flush_threshold = flush_threshold
+        self.compact_bytes = compact_bytes
+        self.lock = threading.RLock()
+        self._users = None
+        self._index = UserIndex()
+        self._pending = []  # строки журнала, ещё не записанные на диск
+        self._compaction_thread = None
+
+    # --- загрузка ---
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.path):
+            logger.info(f"{self.path} not found. Starting with an empty user base.")
+            return {}
+        try:
+            with open(self.path, 'rb') as f:
+                content = f.read()
+            if not content.strip():
+                logger.warning(f"{self.path} is empty. Starting with an empty snapshot.")
+                return {}
+            data = user_codec.codec_for_data(content).loads(content)
+            return {int(k): v for k, v in data.items()}
+        except (ValueError, IOError) as e:
+            # Не затираем файл: откладываем его в сторону, чтобы данные можно было восстановить руками
+            broken_path = f"{self.path}.corrupt-{int(time.time())}"
+            logger.error(f"Error loading users from {self.path}: {e}. Moving it to {broken_path}.")
+            try:
+                os.replace(self.path, broken_path)
+            except OSError as move_e:
+                logger.error(f"Failed to move corrupt {self.path} aside: {move_e}")
+            return {}
+
+    @staticmethod
+    def _apply(users: dict, entry: dict):
+        chat_id = int(entry["id"])
+        op = entry.get("op")
+        if op == "put":
+            users[chat_id] = entry["record"]
+        elif op == "set":
+            user = users.get(chat_id)
+            if user is not None:
+                user.update(entry["fields"])
+
+    def _replay(self, users: dict, journal_path: str):
+        if not os.path.exists(journal_path):
+            return 0
+        with open(journal_path, 'rb') as f:
+            data = f.read()
+        applied = 0
+        for entry in user_codec.codec_for_data(data).iter_entries(data, source=journal_path):
+            try:
+                self._apply(users, entry)
+                applied += 1
+            except (KeyError, ValueError, TypeError, AttributeError) as e:
+                logger.warning(f"Skipping malformed journal entry in {journal_path}: {e}")
+        return applied
+
+    def _journal_format(self):
+        if not os.path.exists(self.journal_path):
+            return None
+        with open(self.journal_path, 'rb') as f:
+            return user_codec.detect_format(f.read(len(user_codec.MSGPACK_MAGIC)))
+
+    def _cache(self):
+        with self.lock:
+            if self._users is None:
+                users = self._read_snapshot()
+                leftover = os.path.exists(self.compacting_path)
+                journal_format = self._journal_format()
+                replayed = self._replay(users, self.compacting_path) + self._replay(users, self.journal_path)
+                self._users = {chat_id: UserRecord(**record) for chat_id, record in users.items()}
+                self._index.rebuild(self._users)
+                logger.info(f"Loaded {len(users)} users from {self.path} (+{replayed} journal entries).")
+                if leftover:
+                    # Предыдущая компакция не доделана - доводим её синхронно
+                    self._compact_now()
+                elif journal_format not in (None, self.codec.format):
+                    # Журнал в другом формате (сменили USERS_CODEC) - дописывать в него нельзя
+                    logger.info(f"Journal {self.journal_path} is {journal_format}, converting to {self.codec.name}.")
+                    self._compact_now()
+            return self._users
+
+    # --- журнал ---
+
+    def _log(self, entry: dict):
+        self._pending.append(self.codec.encode_entry(entry))
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self.durability == DURABILITY_ALWAYS:
+            self.flush()
+        elif len(self._pending) >= self.flush_threshold:
+            logger.debug(f"Pending threshold {self.flush_threshold} reached, flushing journal.")
+            self.flush()
+
+    def _append_pending(self):
+        if not self._pending:
+            return 0
+        appended = len(self._pending)
+        is_new = not os.path.exists(self.journal_path)
+        with open(self.journal_path, 'ab') as f:
+            if is_new:
+                f.write(self.codec.header)
+            f.write(b"".join(self._pending))
+            # Один fsync на всю пачку (group commit) или на каждый вызов в режиме "always"
+            f.flush()
+            os.fsync(f.fileno())
+        if is_new:
+            _fsync_dir(self.journal_path)
+        self._pending.clear()
+        return appended
+
+    def flush(self) -> int:
+        with self.lock:
+            try:
+                flushed = self._append_pending()
+            except (IOError, OSError) as e:
+                logger.error(f"Error appending to journal {self.journal_path}: {e}")
+                return 0
+            if flushed:
+                logger.debug(f"Appended {flushed} entries to {self.journal_path}")
+                if os.path.getsize(self.journal_path) >= self.compact_bytes:
+                    self._start_compaction()
+            return flushed
+
+    # --- компакция ---
+
+    def _write_snapshot(self, users_data):
+        data_to_save = {str(k): v for k, v in users_data.items()}
+        atomic_write_bytes(self.path, self.codec.dumps(data_to_save))
+        logger.debug(f"Users snapshot saved to {self.path}")
+
+    def _rotate_journal(self):
+        """Под lock: дописывает хвост и отодвигает журнал, возвращает копию состояния."""
+        self._append_pending()
+        if os.path.exists(self.journal_path):
+            if os.path.exists(self.compacting_path):
+                # Недоделанная компакция: не теряем её журнал, а дописываем в него
+                with open(self.journal_path, 'rb') as src, \
+                        open(self.compacting_path, 'ab') as dst:
+                    dst.write(user_codec.strip_header(src.read()))
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.compacting_path)
+        return {chat_id: record.to_dict() for chat_id, record in self._users.items()}
+
+    def _finish_compaction(self, snapshot):
+        try:
+            self._write_snapshot(snapshot)
+            if os.path.exists(self.compacting_path):
+                os.remove(self.compacting_path)
+            logger.info(f"Compacted {len(snapshot)} users into {self.path}")
+        except (IOError, OSError) as e:
+            # Журнал .compacting остаётся на месте и будет проигран при следующем старте
+            logger.error(f"Journal compaction into {self.path} failed: {e}")
+
+    def _compact_now(self):
+        with self.lock:
+            if self._compaction_thread and self._compaction_thread.is_alive():
+                self._compaction_thread.join()
+            self._finish_compaction(self._rotate_journal())
+
+    def _start_compaction(self):
+        if self._compaction_thread and self._compaction_thread.is_alive():
+            return
+        if os.path.exists(self.compacting_path):
+            return
+        snapshot = self._rotate_journal()
+        self._compaction_thread = threading.Thread(
+            target=self._finish_compaction, args=(snapshot,), name="users-compaction", daemon=True
+        )
+        self._compaction_thread.start()
+
+    def load(self) -> int:
+        """Загружает снапшот и журнал (если ещё не загружены); возвращает число пользователей."""
+        with self.lock:
+            return len(self._cache())
+
+    def compact(self):
+        """Синхронная компакция: снапшот пишется текущим codec, проигранный журнал удаляется."""
+        with self.lock:
+            self._cache()
+            self._compact_now()
+
+    # --- интерфейс бэкенда ---
+
+    def get(self, chat_id: int):
+        with self.lock:
+            user = self._cache().get(chat_id)
+            return user.to_dict() if user is not None else None
+
+    def put(self, chat_id: int, record: dict):
+        with self.lock:
+            user = UserRecord.from_dict(record)
+            self._cache()[chat_id] = user
+            self._index.add(chat_id, user)
+            self._log({"op": "put", "id": chat_id, "record": user.to_dict()})
+
+    @contextlib.contextmanager
+    def atomic(self):
+        # Записи живут в памяти одного процесса - достаточно lock
+        with self.lock:
+            yield
+
+    def _set(self, chat_id: int, fields: dict) -> bool:
+        """Под lock: меняет запись и добавляет строку журнала в очередь, без flush."""
+        user = self._cache().get(chat_id)
+        if user is None:
+            return False
+        user.update(fields)
+        self._index.add(chat_id, user)
+        if "tests_taken" in fields:
+            # В журнал идёт уже сжатая история тестов, без текстов результатов
+            fields = dict(fields, tests_taken=user.tests_taken)
+        self._pending.append(self.codec.encode_entry({"op": "set", "id": chat_id, "fields": fields}))
+        return True
+
+    def update(self, chat_id: int, fields: dict) -> bool:
+        with self.lock:
+            if not self._set(chat_id, fields):
+                return False
+            self._maybe_flush()
+            return True
+
+    def update_many(self, updates: dict) -> int:
+        # Под одним lock; все строки журнала уходят на диск одной пачкой,
+        # в режиме "always" - с одним fsync на весь вызов, а не на каждую запись
+        with self.lock:
+            updated = sum(1 for chat_id, fields in updates.items() if self._set(chat_id, fields))
+            if updated:
+                self._maybe_flush()
+            return updated
+
+    def advance_days(self, days: dict, total_days: int) -> dict:
+        advanced = {}
+        with self.lock:
+            users = self._cache()
+            for chat_id, day in days.items():
+                user = users.get(chat_id)
+                if user is None or user.current_daily_day != day:
+                    continue
+                advanced[chat_id] = user.current_daily_day = day + 1 if day < total_days else 1
+                self._index.add(chat_id, user)
+                self._pending.append(self.codec.encode_entry(
+                    {"op": "set", "id": chat_id, "fields": {"current_daily_day": advanced[chat_id]}}))
+            if advanced:
+                self._maybe_flush()
+        return advanced
+
+    def all(self):
+        with self.lock:
+            return {chat_id: user.to_dict() for chat_id, user in self._cache().items()}
+
+    def replace_all(self, users: dict):
+        with self.lock:
+            self._cache()
+            self._pending.clear()
+            self._users = {int(k): UserRecord.from_dict(v) for k, v in users.items()}
+            self._index.rebuild(self._users)
+            self._compact_now()
+
+    def subscribed_users(self):
+        with self.lock:
+            users = self._cache()
+            return [users[chat_id].to_dict() for chat_id in self._index.subscribed()]
+
+    def chat_ids_by_mode(self, mode: str):
+        with self.lock:
+            self._cache()
+            return self._index.by_mode(mode)
+
+    def chat_ids_by_day(self, day: int):
+        with self.lock:
+            self._cache()
+            return self._index.by_day(day)
+
+    def chat_ids_by_stage_prefix(self, prefix: str):
+        with self.lock:
+            self._cache()
+            return self._index.by_stage_prefix(prefix)
+
+    def _schedule_index(self):
+        # Минуты считаются на конкретную дату: с новыми сутками UTC индекс пересчитывается
+        self._cache()
+        today = practice_times.utc_today()
+        if self._index.minutes_date != today:
+            self._index.rebuild(self._users, today)
+            logger.info(f"Schedule index rebuilt for {today.isoformat()}")
+        return self._index
+
+    def chat_ids_by_minute(self, part: str, minute: int):
+        with self.lock:
+            return self._schedule_index().by_minute(part, minute)
+
+    def schedule_buckets(self):
+        with self.lock:
+            return self._schedule_index().schedule_buckets()
+
+    def refresh_schedule_index(self):
+        with self.lock:
+            self._schedule_index()
+
+    def index_stats(self):
+        with self.lock:
+            self._cache()
+            return self._index.stats()
+
+    def close(self):
+        self.flush()
+        if self._compaction_thread:
+            self._compaction_thread.join()
+
+
+class SqliteUserStore:
+    """Одна строка на chat_id: горячие поля в отдельных колонках, остальное в JSON.
+
+    morning_minute/evening_minute - минута UTC практики подписчика (NULL, если её нет),
+    вычисляются из записи на дату _minutes_date и пересчитываются с новыми сутками UTC.
+    """
+
+    # Колонки, по которым нужны выборки; всё остальное лежит в data
+    HOT_COLUMNS = ("subscribed_to_daily", "daily_practice_mode", "current_daily_day", "stage")
+    MINUTE_COLUMNS = tuple(f"{part}_minute" for part in practice_times.PRACTICE_PARTS)
+
+    def __init__(self, path: str, import_from: JsonUserStore = None, durability: str = DURABILITY_GROUP):
+        self.path = path
+        self.lock = threading.RLock()
+        # Соединение одно на процесс, доступ сериализуется через self.lock
+        # timeout - ожидание блокировки записи другим процессом (воркеры доставки)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # В WAL режим NORMAL fsync'ит только на чекпойнтах (group commit), FULL - на каждый коммит
+        self._conn.execute("PRAGMA synchronous=FULL" if durability == DURABILITY_ALWAYS else "PRAGMA synchronous=NORMAL")
+        self._minutes_date = practice_times.utc_today()
+        self._atomic_depth = 0
+        self._create_schema()
+        if import_from is not None:
+            self._import_if_empty(import_from)
+
+    def _create_schema(self):
+        with self.lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    chat_id INTEGER PRIMARY KEY,
+                    subscribed_to_daily INTEGER NOT NULL DEFAULT 0,
+                    daily_practice_mode TEXT NOT NULL DEFAULT 'none',
+                    current_daily_day INTEGER NOT NULL DEFAULT 0,
+                    stage TEXT,
+                    data TEXT NOT NULL DEFAULT '{}',
+                    morning_minute INTEGER,
+                    evening_minute INTEGER
+                );
+            """)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+            missing = [column for column in self.MINUTE_COLUMNS if column not in columns]
+            for column in missing:
+                self._conn.execute(f"ALTER TABLE users ADD COLUMN {column} INTEGER")
+            self._conn.executescript("""
+                CREATE INDEX IF NOT EXISTS idx_users_subscription ON users(subscribed_to_daily, daily_practice_mode);
+                CREATE INDEX IF NOT EXISTS idx_users_day ON users(current_daily_day);
+                CREATE INDEX IF NOT EXISTS idx_users_stage ON users(stage);
+                CREATE INDEX IF NOT EXISTS idx_users_morning_minute ON users(morning_minute);
+                CREATE INDEX IF NOT EXISTS idx_users_evening_minute ON users(evening_minute);
+            """)
+            if missing:
+                # База от старой версии: заполняем минуты для уже существующих подписчиков
+                self._fill_minutes()
+
+    def _import_if_empty(self, source):
+        with self.lock:
+            has_rows = self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone()
+            if has_rows or not os.path.exists(source.path):
+                return
+            users = source.all()
+            self.replace_all(users)
+            logger.info(f"Imported {len(users)} users from {source.path} into {self.path}")
+
+    def _minutes_for(self, record: dict):
+        active = record.get("subscribed_to_daily") and record.get("daily_practice_mode") in ACTIVE_PRACTICE_MODES
+        minutes = practice_times.user_minutes(record, self._minutes_date) if active else {}
+        return tuple(minutes.get(part) for part in practice_times.PRACTICE_PARTS)
+
+    def _to_row(self, chat_id: int, record: dict):
+        # Через UserRecord: схема с умолчаниями и история тестов без копий текстов результатов
+        rest = UserRecord.from_dict(record).to_dict()
+        minutes = self._minutes_for(rest)
+        hot = [rest.pop(col, None) for col in self.HOT_COLUMNS]
+        return (
+            chat_id,
+            1 if hot[0] else 0,
+            hot[1] or "none",
+            hot[2] or 0,
+            hot[3],
+            json.dumps(rest, ensure_ascii=False),
+            *minutes,
+        )
+
+    @classmethod
+    def _from_row(cls, row):
+        chat_id, subscribed, mode, day, stage, data = row
+        record = json.loads(data)
+        record["subscribed_to_daily"] = bool(subscribed)
+        record["daily_practice_mode"] = mode
+        record["current_daily_day"] = day
+        record["stage"] = stage
+        return chat_id, record
+
+    _SELECT = "SELECT chat_id, subscribed_to_daily, daily_practice_mode, current_daily_day, stage, data FROM users"
+    _SUBSCRIBED = "subscribed_to_daily = 1 AND daily_practice_mode IN ({})".format(
+        ", ".join("?" for _ in ACTIVE_PRACTICE_MODES))
+
+    _UPSERT = ("INSERT OR REPLACE INTO users "
+               "(chat_id, subscribed_to_daily, daily_practice_mode, current_daily_day, stage, data, "
+               "morning_minute, evening_minute) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+    def get(self, chat_id: int):
+        with self.lock:
+            row = self._conn.execute(f"{self._SELECT} WHERE chat_id = ?", (chat_id,)).fetchone()
+        return self._from_row(row)[1] if row else None
+
+    def put(self, chat_id: int, record: dict):
+        with self.lock:
+            self._conn.execute(self._UPSERT, self._to_row(chat_id, record))
+
+    @contextlib.contextmanager
+    def atomic(self):
+        """BEGIN IMMEDIATE ... COMMIT: чтение и запись внутри - одна транзакция и для других
+        процессов с тем же файлом (воркеры доставки), иначе их изменения теряются. Вложенные
+        вызовы входят в уже открытую транзакцию."""
+        with self.lock:
+            if self._atomic_depth:
+                self._atomic_depth += 1
+                try:
+                    yield
+                finally:
+                    self._atomic_depth -= 1
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._atomic_depth = 1
+            try:
+                yield
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._atomic_depth = 0
+
+    def update(self, chat_id: int, fields: dict) -> bool:
+        with self.atomic():
+            record = self.get(chat_id)
+            if record is None:
+                return False
+            record.update(copy.deepcopy(fields))
+            self.put(chat_id, record)
+            return True
+
+    def update_many(self, updates: dict) -> int:
+        with self.atomic():
+            return sum(1 for chat_id, fields in updates.items() if self.update(chat_id, fields))
+
+    def advance_days(self, days: dict, total_days: int) -> dict:
+        advanced = {}
+        with self.atomic():
+            for chat_id, day in days.items():
+                new_day = day + 1 if day < total_days else 1
+                # Условие на текущий день: повтор или /setday между доставкой и переводом не собьют день
+                if self._conn.execute("UPDATE users SET current_daily_day = ? WHERE chat_id = ? AND current_daily_day = ?",
+                                      (new_day, chat_id, day)).rowcount:
+                    advanced[chat_id] = new_day
+            # Минута отправки зависит от дня только для особых дней (practice_times.SPECIAL_DAY_TIMES_UTC)
+            special_days = practice_times.special_days()
+            affected = [chat_id for chat_id, new_day in advanced.items()
+                        if new_day in special_days or days[chat_id] in special_days]
+            if affected:
+                self._fill_minutes(affected)
+        return advanced
+
+    def all(self):
+        with self.lock:
+            rows = self._conn.execute(self._SELECT).fetchall()
+        return dict(self._from_row(row) for row in rows)
+
+    def replace_all(self, users: dict):
+        with self.lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM users")
+                self._conn.executemany(self._UPSERT, (self._to_row(int(k), v) for k, v in users.items()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def subscribed_users(self):
+        with self.lock:
+            rows = self._conn.execute(f"{self._SELECT} WHERE {self._SUBSCRIBED}", ACTIVE_PRACTICE_MODES).fetchall()
+        return [self._from_row(row)[1] for row in rows]
+
+    def _chat_ids(self, where: str, params):
+        with self.lock:
+            rows = self._conn.execute(f"SELECT chat_id FROM users WHERE {where}", params).fetchall()
+        return {row[0] for row in rows}
+
+    def chat_ids_by_mode(self, mode: str):
+        if mode not in ACTIVE_PRACTICE_MODES:
+            return set()
+        return self._chat_ids("subscribed_to_daily = 1 AND daily_practice_mode = ?", (mode,))
+
+    def chat_ids_by_day(self, day: int):
+        return self._chat_ids(f"{self._SUBSCRIBED} AND current_daily_day = ?", (*ACTIVE_PRACTICE_MODES, day))
+
+    def chat_ids_by_stage_prefix(self, prefix: str):
+        # Диапазон вместо LIKE, чтобы работал индекс idx_users_stage
+        return self._chat_ids("stage >= ? AND stage < ?", (prefix, prefix + "\U0010ffff"))
+
+    def _fill_minutes(self, chat_ids=None):
+        """Пересчитывает минуты подписчиков (всех или только chat_ids) на _minutes_date одной транзакцией."""
+        with self.atomic():
+            if chat_ids is None:
+                rows = self._conn.execute(f"{self._SELECT} WHERE {self._SUBSCRIBED}", ACTIVE_PRACTICE_MODES).fetchall()
+                self._conn.execute("UPDATE users SET morning_minute = NULL, evening_minute = NULL")
+            else:
+                rows = [row for chat_id in chat_ids
+                        for row in self._conn.execute(f"{self._SELECT} WHERE chat_id = ?", (chat_id,)).fetchall()]
+            updates = []
+            for row in rows:
+                chat_id, record = self._from_row(row)
+                updates.append((*self._minutes_for(record), chat_id))
+            self._conn.executemany("UPDATE users SET morning_minute = ?, evening_minute = ? WHERE chat_id = ?", updates)
+        if chat_ids is None:
+            logger.info(f"Schedule minutes recalculated for {len(updates)} subscribers ({self._minutes_date.isoformat()})")
+
+    def refresh_schedule_index(self):
+        with self.lock:
+            today = practice_times.utc_today()
+            if self._minutes_date != today:
+                self._minutes_date = today
+                self._fill_minutes()
+
+    def chat_ids_by_minute(self, part: str, minute: int):
+        if part not in practice_times.PRACTICE_PARTS:
+            return set()
+        with self.lock:
+            self.refresh_schedule_index()
+            return self._chat_ids(f"{part}_minute = ?", (minute,))
+
+    def schedule_buckets(self):
+        with self.lock:
+            self.refresh_schedule_index()
+            return {
+                part: dict(self._conn.execute(
+                    f"SELECT {part}_minute, COUNT(*) FROM users WHERE {part}_minute IS NOT NULL GROUP BY {part}_minute"
+                ).fetchall())
+                for part in practice_times.PRACTICE_PARTS
+            }
+
+    def index_stats(self):
+        with self.lock:
+            by_mode = dict(self._conn.execute(
+                f"SELECT daily_practice_mode, COUNT(*) FROM users WHERE {self._SUBSCRIBED} GROUP BY daily_practice_mode",
+                ACTIVE_PRACTICE_MODES).fetchall())
+            by_day = dict(self._conn.execute(
+                f"SELECT current_daily_day, COUNT(*) FROM users WHERE {self._SUBSCRIBED} "
+                "GROUP BY current_daily_day ORDER BY current_daily_day",
+                ACTIVE_PRACTICE_MODES).fetchall())
+        return {
+            "subscribed": sum(by_mode.values()),
+            "by_mode": by_mode,
+            "by_day": by_day,
+            "awaiting_email": len(self.chat_ids_by_stage_prefix(AWAITING_EMAIL_STAGE_PREFIX)),
+        }
+
+    def flush(self) -> int:
+        # Каждая запись коммитится сразу, откладывать нечего
+        return 0
+
+    def close(self):
+        with self.lock:
+            self._conn.close()
+
+
+def create_store(backend: str, json_path: str, db_path: str, flush_threshold: int = 200,
+                 journal_path: str = None, compact_bytes: int = 5 * 1024 * 1024,
+                 durability: str = DURABILITY_GROUP, codec: str = "auto"):
+    if durability not in (DURABILITY_ALWAYS, DURABILITY_GROUP):
+        logger.warning(f"Unknown USERS_DURABILITY '{durability}', using '{DURABILITY_GROUP}'.")
+        durability = DURABILITY_GROUP
+    if backend == "sqlite":
+        logger.info(f"Using SQLite user storage: {db_path}")
+        return SqliteUserStore(db_path, import_from=JsonUserStore(json_path, journal_path=journal_path, codec=codec),
+                               durability=durability)
+    if backend != "json":
+        logger.warning(f"Unknown USER_STORAGE_BACKEND '{backend}', falling back to json.")
+    return JsonUserStore(json_path, journal_path=journal_path, flush_threshold=flush_threshold,
+                         compact_bytes=compact_bytes, durability=durability, codec=codec)